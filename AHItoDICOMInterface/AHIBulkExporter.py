@@ -0,0 +1,181 @@
+"""
+AHItoDICOM Module : This class contains the logic to export many ImageSets to the file system as a resumable batch job.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import argparse
+import logging
+import os
+import time
+from threading import Lock
+from .AHItoDICOM import AHItoDICOM
+from .AHIDICOMWriter import AHIDICOMWriter , DEFAULT_LAYOUT
+from .AHIExportManifest import AHIExportManifest
+
+
+class AHIBulkExporter:
+
+    helper = None
+    destination = None
+    manifest = None
+    logger = None
+
+    def __init__(self, helper : AHItoDICOM , destination : str , manifest_path : str = None , layout : str = DEFAULT_LAYOUT , header_only : bool = False , htj2k_passthrough : bool = False , writer_count : int = 4 , fsync_batch_size : int = 64 , max_image_sets_in_flight : int = 4 , max_instances_in_flight : int = None):
+        """
+        Exports ImageSets to the file system as DICOM Part10 files , recording each instance written in an AHIExportManifest.
+        Running the same export again after an interruption skips the ImageSets complete and the instances already written.
+
+        :param helper: The AHItoDICOM helper used to DICOMize the instances.
+        :param destination: The folder the files are written to.
+        :param manifest_path: Optional SQLite manifest file. Will default to .ahi-export-manifest.sqlite in destination.
+        :param layout: Optional path of each file relative to destination, formatted with the attributes of the instance. Will default to {StudyInstanceUID}/{SeriesInstanceUID}/{SOPInstanceUID}.dcm
+        :param writer_count: Optional number of writer threads. Will default to 4.
+        :param fsync_batch_size: Optional number of files flushed to the disk together before being renamed. Will default to 64, 0 to not flush them.
+        :param max_image_sets_in_flight: Optional maximum number of ImageSets being exported at the same time. Will default to 4.
+        :param max_instances_in_flight: Optional maximum number of instances being processed, across all the ImageSets.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.helper = helper
+        self.destination = destination
+        os.makedirs(destination , exist_ok = True)
+        if manifest_path is None:
+            manifest_path = os.path.join(destination , ".ahi-export-manifest.sqlite")
+        self.manifest = AHIExportManifest(manifest_path)
+        self.layout = layout
+        self.header_only = header_only
+        self.htj2k_passthrough = htj2k_passthrough
+        self.writer_count = writer_count
+        self.fsync_batch_size = fsync_batch_size
+        self.max_image_sets_in_flight = max_image_sets_in_flight
+        self.max_instances_in_flight = max_instances_in_flight
+        self.lock = Lock()
+
+    def export(self, datastore_id : str , image_set_ids : list = None , study_instance_uids : list = None , whole_datastore : bool = False) -> dict:
+        """
+        export(datastore_id : str , image_set_ids : list = None , study_instance_uids : list = None , whole_datastore : bool = False).
+        Exports the ImageSets listed , all the ImageSets of the studies listed , or all the ImageSets of the datastore.
+
+        :return: The number of ImageSets and instances exported and skipped , the number of instances which could not be exported , the bytes written , the elapsed time and the throughput in instances/s and MB/s.
+        """
+        start_time = time.perf_counter()
+        self.written = {}
+        sources = self.getSources(datastore_id , image_set_ids , study_instance_uids , whole_datastore)
+        report = { "ImageSets" : len(sources) , "ImageSetsSkipped" : 0 , "Instances" : 0 , "InstancesSkipped" : 0 , "Errors" : 0 , "Bytes" : 0 }
+        pending = []
+        for source in sources:
+            if self.manifest.isImageSetComplete(datastore_id , source["imagesetId"] , source["version"]):
+                report["ImageSetsSkipped"] += 1
+                continue
+            source["Exclude"] = self.manifest.getCompletedInstances(datastore_id , source["imagesetId"] , source["version"])
+            report["InstancesSkipped"] += len(source["Exclude"])
+            self.written[source["imagesetId"]] = 0
+            pending.append(source)
+        self.logger.info(f"[{__name__}] - {len(pending)} ImageSets to export , {report['ImageSetsSkipped']} ImageSets and {report['InstancesSkipped']} instances already exported.")
+        self.sources = { source["imagesetId"] : source for source in pending }
+        writer = AHIDICOMWriter(self.destination , self.layout , self.writer_count , self.fsync_batch_size , on_written = lambda tag , path , size : self._recordInstance(datastore_id , tag , path , size) , metrics = self.helper.metrics)
+        try:
+            if self.header_only: # the Part10 headers are built in-process , without the worker processes.
+                for job , ( fields , data ) in self.helper.iterDICOMizeSources(datastore_id , pending , header_only = True , max_image_sets_in_flight = self.max_image_sets_in_flight , output = "part10"):
+                    writer.submit(fields , ( job["imagesetId"] , job["SOPInstanceUID"] ) , data)
+            else:
+                for job , ds in self.helper.iterDICOMizeSources(datastore_id , pending , order = "completion" , max_instances_in_flight = self.max_instances_in_flight , max_image_sets_in_flight = self.max_image_sets_in_flight , htj2k_passthrough = self.htj2k_passthrough):
+                    writer.submit(ds , ( job["imagesetId"] , job["SOPInstanceUID"] ))
+        finally:
+            statistics = writer.close()
+            # the ImageSets whose instances were all exported by a previous run are only marked complete now.
+            for source in pending:
+                self._checkImageSet(datastore_id , source)
+            self.manifest.flush()
+        elapsed = time.perf_counter() - start_time
+        report["Instances"] = statistics["Files"]
+        report["Bytes"] = statistics["Bytes"]
+        report["Errors"] = sum( source.get("InstanceCount" , 0) - len(source["Exclude"]) for source in pending ) - statistics["Files"]
+        report["Elapsed"] = elapsed
+        report["InstancesPerSecond"] = statistics["Files"] / elapsed if elapsed > 0 else 0.0
+        report["MBPerSecond"] = statistics["Bytes"] / 1048576 / elapsed if elapsed > 0 else 0.0
+        self.logger.info(f"[{__name__}] - {report['Instances']} instances exported in {elapsed:.1f}s , {report['InstancesPerSecond']:.1f} instances/s , {report['MBPerSecond']:.1f} MB/s , {report['Errors']} errors.")
+        return report
+
+    def getSources(self, datastore_id : str , image_set_ids : list = None , study_instance_uids : list = None , whole_datastore : bool = False) -> list:
+        """
+        Returns one { "imagesetId" , "version" } dict per ImageSet to export , without duplicates.
+        """
+        client = self.helper._getClient()
+        summaries = []
+        if whole_datastore:
+            summaries += self.helper.searchImageSets(datastore_id , None , client)
+        for study_instance_uid in study_instance_uids or []:
+            summaries += self.helper.searchImageSets(datastore_id , study_instance_uid , client)
+        for image_set_id in image_set_ids or []:
+            try:
+                summaries.append({ "imageSetId" : image_set_id , "version" : self.helper.getImageSetVersion(datastore_id , image_set_id , client) })
+            except Exception as AHIErr:
+                self.logger.error(f"[{__name__}] - ImageSet {image_set_id} is skipped : {AHIErr}")
+        sources = {}
+        for summary in summaries:
+            if summary["imageSetId"] not in sources:
+                sources[summary["imageSetId"]] = { "imagesetId" : summary["imageSetId"] , "version" : str(summary.get("version")) }
+        return list(sources.values())
+
+    def close(self):
+        self.manifest.close()
+
+    def _recordInstance(self, datastore_id : str , tag , path : str , size : int):
+        imagesetId , SOPInstanceUID = tag
+        source = self.sources[imagesetId]
+        self.manifest.recordInstance(datastore_id , imagesetId , source["version"] , SOPInstanceUID , path , size)
+        with self.lock:
+            self.written[imagesetId] += 1
+        self._checkImageSet(datastore_id , source)
+
+    def _checkImageSet(self, datastore_id : str , source : dict):
+        # InstanceCount is set by AHItoDICOM once the metadata of the ImageSet is read.
+        with self.lock:
+            complete = "InstanceCount" in source and not source.get("Complete" , False) and len(source["Exclude"]) + self.written[source["imagesetId"]] >= source["InstanceCount"]
+            if complete:
+                source["Complete"] = True
+        if complete:
+            self.manifest.recordImageSet(datastore_id , source["imagesetId"] , source["version"] , source["InstanceCount"])
+
+
+def main():
+    """
+    ahi-bulk-export console script. The ImageSet IDs and study UIDs can be read from files with @file , one value per line.
+    """
+    parser = argparse.ArgumentParser(description = "Resumable export of AWS HealthImaging ImageSets to DICOM Part10 files." , fromfile_prefix_chars = "@")
+    parser.add_argument("--datastore-id" , required = True)
+    parser.add_argument("--image-set-ids" , nargs = "*" , default = [])
+    parser.add_argument("--study-uids" , nargs = "*" , default = [])
+    parser.add_argument("--all" , action = "store_true" , help = "Export all the ImageSets of the datastore.")
+    parser.add_argument("--destination" , required = True)
+    parser.add_argument("--manifest" , default = None , help = "SQLite manifest file. Will default to .ahi-export-manifest.sqlite in the destination folder.")
+    parser.add_argument("--layout" , default = DEFAULT_LAYOUT)
+    parser.add_argument("--endpoint" , default = None)
+    parser.add_argument("--fetcher-process-count" , type = int , default = None)
+    parser.add_argument("--dicomizer-process-count" , type = int , default = None)
+    parser.add_argument("--network-concurrency" , type = int , default = None)
+    parser.add_argument("--memory-budget-mb" , type = int , default = None , help = "MB the data in flight may hold , the fetches waiting for the previous instances to be written when it is exhausted.")
+    parser.add_argument("--start-method" , default = None , choices = [ "fork" , "spawn" , "forkserver" ] , help = "Start method of the worker processes. Will default to the default of the platform.")
+    parser.add_argument("--writer-count" , type = int , default = 4)
+    parser.add_argument("--fsync-batch-size" , type = int , default = 64)
+    parser.add_argument("--max-image-sets-in-flight" , type = int , default = 4)
+    parser.add_argument("--header-only" , action = "store_true")
+    parser.add_argument("--htj2k-passthrough" , action = "store_true")
+    args = parser.parse_args()
+    if not args.image_set_ids and not args.study_uids and not args.all:
+        parser.error("one of --image-set-ids , --study-uids or --all is required.")
+    logging.basicConfig(level = logging.INFO , format = "%(asctime)s %(levelname)s %(message)s")
+    with AHItoDICOM(AHI_endpoint = args.endpoint , fetcher_process_count = args.fetcher_process_count , dicomizer_process_count = args.dicomizer_process_count , network_concurrency = args.network_concurrency , start_method = args.start_method , memory_budget = args.memory_budget_mb * 1024 * 1024 if args.memory_budget_mb is not None else None) as helper:
+        exporter = AHIBulkExporter(helper , args.destination , args.manifest , args.layout , args.header_only , args.htj2k_passthrough , args.writer_count , args.fsync_batch_size , args.max_image_sets_in_flight)
+        try:
+            report = exporter.export(args.datastore_id , args.image_set_ids , args.study_uids , args.all)
+        finally:
+            exporter.close()
+    print(f"ImageSets : {report['ImageSets']} ({report['ImageSetsSkipped']} already exported)")
+    print(f"Instances : {report['Instances']} exported , {report['InstancesSkipped']} already exported , {report['Errors']} errors")
+    print(f"Throughput : {report['InstancesPerSecond']:.1f} instances/s , {report['MBPerSecond']:.1f} MB/s ({report['Bytes'] / 1048576:.1f} MB in {report['Elapsed']:.1f}s)")
+    return 0 if report["Errors"] == 0 else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -3,12 +3,26 @@ AHItoDICOM Module : This class contains the logic to create the AHI boto3 client
 
 SPDX-License-Identifier: Apache-2.0
 """
-import boto3
-import botocore
 import tempfile
 import logging
+import os
+import threading
 
 
+# clients of the current process , by credentials , endpoint , region and connection pool size. boto3 clients are thread safe , but not fork safe : the cache is emptied in the child processes.
+_clients = {}
+_clientsLock = threading.Lock()
+
+
+def _resetClients():
+    global _clientsLock
+    _clients.clear()
+    _clientsLock = threading.Lock()
+
+
+if hasattr(os , "register_at_fork"):
+    os.register_at_fork(after_in_child = _resetClients)
+
 
 class AHIClientFactory(object):
 
@@ -16,12 +30,41 @@ class AHIClientFactory(object):
     def __init__(self) -> None:
         pass
 
-    def __new__(self , aws_access_key : str = None , aws_secret_key : str = None , aws_accendpoint_url : str = None):
+    def __new__(self , aws_access_key : str = None , aws_secret_key : str = None , aws_accendpoint_url : str = None , region_name : str = None , max_pool_connections : int = 200):
+        """
+        Returns the medical-imaging client of the current process for these credentials , endpoint and region , created on first use : the service model is loaded and the endpoint resolved once per process instead of once per call.
+
+        :param aws_access_key: Optional IAM user access key. Will default to the credentials of the environment.
+        :param aws_secret_key: Optional IAM user secret key.
+        :param aws_accendpoint_url: Optional AHI endpoint URL.
+        :param region_name: Optional region. Will default to the region of the environment.
+        :param max_pool_connections: Optional size of the connection pool of the client , which should be at least the number of threads sending requests concurrently. Will default to 200.
+        """
+        # the environment is part of the key , so a client is not reused after the region or the profile changed.
+        key = ( aws_access_key , aws_secret_key , aws_accendpoint_url , region_name or os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION") , os.environ.get("AWS_PROFILE") , max_pool_connections )
+        AHIclient = _clients.get(key)
+        if AHIclient is not None:
+            return AHIclient
         try:
-            session = boto3.Session()
-            # session._loader.search_paths.extend([tempfile.gettempdir()])
-            AHIclient = boto3.client('medical-imaging',  aws_access_key_id = aws_access_key , aws_secret_access_key = aws_secret_key ,  endpoint_url=aws_accendpoint_url , config=botocore.config.Config(max_pool_connections=200)  ) 
+            with _clientsLock:
+                AHIclient = _clients.get(key)
+                if AHIclient is None:
+                    # boto3 is only imported with the first client , e.g. not at all when an ahi_client is given to AHItoDICOM.
+                    import boto3
+                    import botocore.config
+                    # session._loader.search_paths.extend([tempfile.gettempdir()])
+                    session = boto3.session.Session(aws_access_key_id = aws_access_key , aws_secret_access_key = aws_secret_key , region_name = region_name)
+                    AHIclient = session.client('medical-imaging' , endpoint_url=aws_accendpoint_url , config=botocore.config.Config(max_pool_connections=max_pool_connections))
+                    _clients[key] = AHIclient
             return AHIclient
         except Exception as AHIErr:
             logging.error(f"[AHIClientFactory] - {AHIErr}")
-            return None
\ No newline at end of file
+            return None
+
+    @staticmethod
+    def clear():
+        """
+        Forgets the clients created in the current process , e.g. after the credentials were rotated.
+        """
+        with _clientsLock:
+            _clients.clear()
@@ -0,0 +1,204 @@
+"""
+AHItoDICOM Module : This class contains the logic to write the DICOMized instances to the file system as DICOM Part10 files.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock , Semaphore
+import logging
+import os
+import tempfile
+import time
+import pydicom
+from pydicom import Dataset
+
+
+DEFAULT_LAYOUT = "{StudyInstanceUID}/{SeriesInstanceUID}/{SOPInstanceUID}.dcm"
+
+
+class LayoutFields(dict):
+    # values of the naming layout placeholders , read from the dataset attributes , e.g. {SeriesNumber} or {InstanceNumber:04d}.
+    def __init__(self, ds : Dataset):
+        super().__init__()
+        self.ds = ds
+
+    def __missing__(self, keyword : str):
+        value = self.ds.get(keyword , None)
+        if value is None:
+            return ""
+        if isinstance(value , (int , float)):
+            return value
+        if keyword in ["InstanceNumber" , "SeriesNumber" , "AcquisitionNumber"]:
+            try:
+                return int(value)
+            except (TypeError , ValueError):
+                pass
+        # the values are used as folder and file names.
+        return str(value).replace("/" , "_").replace("\\" , "_").replace(".." , "_")
+
+
+class AHIDICOMWriter:
+
+    destination = None
+    layout = None
+    logger = None
+
+    def __init__(self, destination : str , layout : str = DEFAULT_LAYOUT , writer_count : int = 4 , fsync_batch_size : int = 64 , on_written = None , metrics = None):
+        """
+        Writes the datasets submitted as DICOM Part10 files with a pool of writer threads.
+        Each file is written to a temporary file in its final folder and renamed once complete, so a file is either missing or complete under its final name.
+
+        :param destination: The folder the files are written to.
+        :param layout: Optional path of each file relative to destination, formatted with the attributes of the dataset. Will default to {StudyInstanceUID}/{SeriesInstanceUID}/{SOPInstanceUID}.dcm
+        :param writer_count: Optional number of writer threads. Will default to 4.
+        :param fsync_batch_size: Optional number of files flushed to the disk together before being renamed. Will default to 64, 0 to not flush them.
+        :param on_written: Optional function called as on_written(tag , path , size) from the writer threads once each file is renamed to its final name, tag being the value given to submit(). The paths are not kept by the writer when it is set.
+        :param metrics: Optional AHIMetrics the Serialize and Write durations of the files , and the bytes written , are recorded in.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.destination = destination
+        self.layout = layout
+        self.fsync_batch_size = fsync_batch_size
+        self.on_written = on_written
+        self.metrics = metrics
+        self.lock = Lock()
+        self.folders = set() # folders already created.
+        self.pending = [] # ( file , temporary path , path , size , tag ) written but not renamed yet.
+        self.statistics = { "Files" : 0 , "Bytes" : 0 , "Errors" : 0 }
+        self.written = []
+        # the datasets waiting for a writer hold their pixels in memory : submit() blocks when 2 per writer are waiting.
+        self.slots = Semaphore(2 * writer_count)
+        self.writers = ThreadPoolExecutor(max_workers = writer_count , thread_name_prefix = "AHIDICOMWriter")
+
+    def submit(self, ds : Dataset , tag = None , data : bytes = None):
+        """
+        Queues the dataset to be written , blocking while the writers are busy.
+
+        :param data: Optional content of the file already serialized , e.g. a Part10 header of AHIHeaderEncoder , written instead of the dataset. ds is then only read for the layout attributes , and can be any object with a get() method.
+        """
+        self.slots.acquire()
+        try:
+            self.writers.submit(self._write , ds , tag , data)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def close(self) -> dict:
+        """
+        Waits for all the datasets submitted to be written, and returns the number of files and bytes written and the number of errors.
+        """
+        self.writers.shutdown(wait = True)
+        with self.lock:
+            batch = self.pending
+            self.pending = []
+        self._commit(batch)
+        return dict(self.statistics , Paths = self.written)
+
+    def getPath(self, ds : Dataset) -> str:
+        return os.path.join(self.destination , self.layout.format_map(LayoutFields(ds)))
+
+    def _write(self, ds : Dataset , tag = None , data : bytes = None):
+        temp_path = None
+        try:
+            path = self.getPath(ds)
+            folder = os.path.dirname(path)
+            if folder not in self.folders:
+                os.makedirs(folder , exist_ok = True)
+                with self.lock:
+                    self.folders.add(folder)
+            fd , temp_path = tempfile.mkstemp(dir = folder , prefix = "." , suffix = ".tmp")
+            f = os.fdopen(fd , "wb")
+            try:
+                if data is not None:
+                    f.write(data)
+                else:
+                    serializeStart = time.perf_counter()
+                    saveAs(ds , f)
+                    if self.metrics is not None:
+                        self.metrics.observe("Serialize" , time.perf_counter() - serializeStart)
+                writeStart = time.perf_counter()
+                f.flush()
+                size = f.tell()
+            except:
+                f.close()
+                raise
+            if self.fsync_batch_size <= 0:
+                f.close()
+                os.replace(temp_path , path)
+                if self.metrics is not None:
+                    self.metrics.observe("Write" , time.perf_counter() - writeStart)
+                self._count(tag , path , size)
+                return
+            with self.lock:
+                self.pending.append((f , temp_path , path , size , tag))
+                batch = None
+                if len(self.pending) >= self.fsync_batch_size:
+                    batch = self.pending
+                    self.pending = []
+            if batch is not None:
+                self._commit(batch)
+        except Exception as err:
+            self.logger.error(f"[{__name__}] - Instance {ds.get('SOPInstanceUID' , '')} could not be written : {err}")
+            with self.lock:
+                self.statistics["Errors"] += 1
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+        finally:
+            self.slots.release()
+
+    def _commit(self, batch : list):
+        # the data of the whole batch is flushed before any file is renamed , then the folders are flushed so the renames are durable too.
+        folders = set()
+        commitStart = time.perf_counter()
+        for f , temp_path , path , size , tag in batch:
+            try:
+                os.fsync(f.fileno())
+                f.close()
+                os.replace(temp_path , path)
+                folders.add(os.path.dirname(path))
+                self._count(tag , path , size)
+            except Exception as err:
+                self.logger.error(f"[{__name__}] - {path} could not be written : {err}")
+                with self.lock:
+                    self.statistics["Errors"] += 1
+                if not f.closed:
+                    f.close()
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        for folder in folders:
+            try:
+                fd = os.open(folder , os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError: # folders can not be opened on Windows.
+                pass
+        if self.metrics is not None and len(batch) > 0:
+            # the files of a batch are flushed together , each is accounted the same share of the batch.
+            share = (time.perf_counter() - commitStart) / len(batch)
+            for x in range(len(batch)):
+                self.metrics.observe("Write" , share)
+
+    def _count(self, tag , path : str , size : int):
+        with self.lock:
+            self.statistics["Files"] += 1
+            self.statistics["Bytes"] += size
+            if self.on_written is None:
+                self.written.append(path)
+        if self.metrics is not None:
+            self.metrics.count("Files")
+            self.metrics.count("BytesWritten" , size)
+        if self.on_written is not None:
+            try:
+                self.on_written(tag , path , size)
+            except Exception as err:
+                self.logger.error(f"[{__name__}] - on_written failed for {path} : {err}")
+
+
+def saveAs(ds : Dataset , f):
+    # write_like_original is deprecated in pydicom 3 , replaced by enforce_file_format.
+    if int(pydicom.__version__.split(".")[0]) >= 3:
+        ds.save_as(f , enforce_file_format = True)
+    else:
+        ds.save_as(f , write_like_original = False)
@@ -3,39 +3,75 @@ AHItoDICOM Module : This class contains the logic to encapsulate the data and th
 
 SPDX-License-Identifier: Apache-2.0
 """
-from time import sleep
-from multiprocessing import Process , Queue , Value , Manager
-from ctypes import c_char_p
+from multiprocessing import Queue
+import multiprocessing
+from queue import Empty
+import time
 import pydicom
 import logging
 from pydicom.sequence import Sequence
 from pydicom import Dataset , DataElement , multival
 from pydicom.dataset import FileDataset, FileMetaDataset
 from pydicom.uid import UID
+from pydicom.encaps import encapsulate
 import base64
+import collections
+from .AHIFrameFetcher import GetReducedSize
+
+
+# VR of the standard tags , by keyword. Filled as the keywords are met , None for the keywords missing from the pydicom dictionary.
+DictionaryVRs = {}
+
+
+def getDictionaryVR(keyword : str):
+    try:
+        return DictionaryVRs[keyword]
+    except KeyError:
+        try:
+            vr = pydicom.datadict.dictionary_VR(keyword)
+        except: # private tag , or unknown keyword.
+            vr = None
+        DictionaryVRs[keyword] = vr
+        return vr
 
 
 class AHIDataDICOMizer():
 
     ds = Dataset()
     InstanceId  = None
-    thread_running = None
     AHI_metadata = None 
     process = None
     status = None
     logger = None
+    maxTemplates = 16
 
 
-    def __init__(self, InstanceId, AHI_metadata) -> None:
+    def __init__(self, InstanceId, AHI_metadata = None , DICOMizeJobsCompleted : Queue = None , DICOMizeJobs : Queue = None , context = None) -> None:
+        """
+        DICOMizer process. The DICOMized jobs are put in the DICOMizeJobsCompleted queue , with the ( seconds waited in the queue since their time.time() Enqueued , seconds spent DICOMizing ) in Timings and the time.time() they were completed at in Completed.
+        Both queues can be shared by several processes, in which case any idle process takes the next job.
+
+        :param context: Optional multiprocessing context the process is started from , the queues must be created by the same context. Will default to the default context.
+        """
+        # AHI_metadata is kept for backward compatibility only : the metadata is now sent along with each job, so the same process can DICOMize instances from any ImageSet.
         self.logger = logging.getLogger(__name__)
         self.InstanceId = InstanceId
-        self.DICOMizeJobs = Queue()
-        self.DICOMizeJobsCompleted = Queue()
+        context = context if context is not None else multiprocessing.get_context()
+        if DICOMizeJobs is None:
+            DICOMizeJobs = context.Queue()
+        self.DICOMizeJobs = DICOMizeJobs
+        if DICOMizeJobsCompleted is None:
+            DICOMizeJobsCompleted = context.Queue()
+        self.DICOMizeJobsCompleted = DICOMizeJobsCompleted
         self.AHI_metadata = AHI_metadata
-        manager = Manager()
-        self.thread_running = manager.Value('i', 1)
-        self.status = manager.Value(c_char_p, "idle")
-        self.process = Process(target = self.ProcessJobs , args=(self.DICOMizeJobs, self.DICOMizeJobsCompleted, self.status , self.thread_running , self.InstanceId))
+        self.templates = collections.OrderedDict() # per series template datasets, only used in the DICOMizer process.
+        self.status = context.Array('c', 16)
+        self.status.value = b"idle"
+        self.stopping = False
+        self.startTime = time.time()
+        self.busyTime = context.Value('d', 0.0)
+        self.jobsDone = context.Value('i', 0)
+        self.process = context.Process(target = self.ProcessJobs , args=(self.DICOMizeJobs, self.DICOMizeJobsCompleted, self.status , self.InstanceId , self.busyTime , self.jobsDone) , daemon = True)
         self.process.start()
 
 
@@ -43,107 +79,205 @@ class AHIDataDICOMizer():
 
     def AddDICOMizeJob(self,FetchJob):
             self.DICOMizeJobs.put(FetchJob)
-            self.logger.debug("[{__name__}][AddDICOMizeJob]["+self.InstanceId+"] - DICOMize Job added "+str(FetchJob)+".")
+            self.logger.debug("[%s][AddDICOMizeJob][%s] - DICOMize Job added %s.", __name__ , self.InstanceId , FetchJob["SOPInstanceUID"])
+
+    def __getstate__(self):
+        # the DICOMizer is pickled along with its ProcessJobs target by the spawn and forkserver start methods , the process handle stays in the parent.
+        state = self.__dict__.copy()
+        state.pop("process" , None)
+        return state
 
-    def ProcessJobs(self , DICOMizeJobs , DICOMizeJobsCompleted , status , thread_running , InstanceId):      
-        while(bool(thread_running.value)):
-            if not DICOMizeJobs.empty():
-                status.value ="busy"
+    def ProcessJobs(self , DICOMizeJobs , DICOMizeJobsCompleted , status , InstanceId , busyTime = None , jobsDone = None):      
+        while True:
+            ImageFrame = DICOMizeJobs.get()
+            if ImageFrame is None: # sentinel sent by Stop()
+                break
+            jobStart = time.perf_counter()
+            status.value = b"busy"
+            queueWait = time.time() - ImageFrame.pop("Enqueued" , time.time())
+            if ImageFrame.get("Error") is not None or ImageFrame.get("Target") is not None: # the instance could not be fetched , or its pixels were decoded in a volume : it is only reported back.
+                ImageFrame.pop("Metadata" , None)
+                ImageFrame["Dataset"] = None
+            else:
                 try:
-                    ImageFrame = DICOMizeJobs.get(block=False)
-                    vrlist = []       
-                    file_meta = FileMetaDataset()
-                    self.ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
-                    self.getDICOMVRs(self.AHI_metadata["Study"]["Series"][ImageFrame["SeriesUID"]]["Instances"][ImageFrame["SOPInstanceUID"]]["DICOMVRs"] , vrlist)
-                    PatientLevel = self.AHI_metadata["Patient"]["DICOM"]
-                    self.getTags(PatientLevel, self.ds , vrlist)
-                    StudyLevel = self.AHI_metadata["Study"]["DICOM"]
-                    self.getTags(StudyLevel, self.ds , vrlist)
-                    SeriesLevel=self.AHI_metadata["Study"]["Series"][ImageFrame["SeriesUID"]]["DICOM"]
-                    self.getTags(SeriesLevel, self.ds , vrlist)
-                    InstanceLevel=self.AHI_metadata["Study"]["Series"][ImageFrame["SeriesUID"]]["Instances"][ImageFrame["SOPInstanceUID"]]["DICOM"] 
-                    self.getTags(InstanceLevel ,  self.ds , vrlist)
-                    self.ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
-                    self.ds.is_little_endian = True
-                    self.ds.is_implicit_VR = False
-                    file_meta.MediaStorageSOPInstanceUID = UID(ImageFrame["SOPInstanceUID"])
-                    pixels = ImageFrame["PixelData"]
-                    if (pixels is not None):
-                        self.ds.PixelData = pixels
-                    vrlist.clear()
-                    DICOMizeJobsCompleted.put(self.ds)
+                    ImageFrame["Dataset"] = self.DICOMizeJob(ImageFrame)
                 except Exception as DICOMizeError:
-                    print("ERROR")
-                    DICOMizeJobsCompleted.put(None)
+                    ImageFrame["Dataset"] = None
+                    ImageFrame["Error"] = str(DICOMizeError)
                     self.logger.error(f"[{__name__}][{str(self.InstanceId)}] - {DICOMizeError}")
-            else:
-                status.value = 'idle'    
-                sleep(0.1)
-            self.logger.debug(f" DICOMizer Process {InstanceId} : {status.value}")
-        status.value ="stopped"
+            ImageFrame["Timings"] = ( queueWait , time.perf_counter() - jobStart )
+            ImageFrame["Completed"] = time.time()
+            DICOMizeJobsCompleted.put(ImageFrame)
+            busyTime.value += time.perf_counter() - jobStart
+            jobsDone.value += 1
+            status.value = b"idle"
+        status.value = b"stopped"
         self.logger.debug(f" DICOMizer Process {InstanceId} : {status.value}")
 
-    def getFramesDICOMized(self):
-        if not self.DICOMizeJobsCompleted.empty():
-            obj = self.DICOMizeJobsCompleted.get()
-            return obj
-        else:
+    def DICOMizeJob(self, ImageFrame):
+        """
+        Builds the pydicom dataset of one job : the series template , the instance level tags and the PixelData.
+        """
+        InstanceMetadata = ImageFrame.pop("Metadata")
+        vrmap = self.getDICOMVRs(InstanceMetadata["DICOMVRs"])
+        template = self.getSeriesTemplate(ImageFrame , InstanceMetadata , vrmap)
+        # the template elements are shared , not copied : the per instance changes below replace the elements instead of modifying them in place , and each dataset is pickled on its own when it is sent back.
+        self.ds = NewInstanceDataset(dict(template.items()) , ImageFrame["SOPInstanceUID"])
+        self.getTags(InstanceMetadata["Instance"] ,  self.ds , vrmap)
+        if ImageFrame.get("FrameIndexes") is not None:
+            self.selectFrames(self.ds , ImageFrame["FrameIndexes"])
+        if ImageFrame.get("ResolutionLevel"):
+            self.reduceResolution(self.ds , ImageFrame["ResolutionLevel"])
+        pixels = ImageFrame.pop("PixelData" , None)
+        if (pixels is not None) and ImageFrame.get("Passthrough" , False):
+            self.setEncapsulatedPixelData(self.ds , pixels , ImageFrame["TransferSyntaxUID"])
+        elif (pixels is not None):
+            if not isinstance(pixels , bytes): # pydicom only accepts bytes for PixelData.
+                pixels = bytes(pixels)
+            self.ds.PixelData = pixels
+        return self.ds
+
+    def selectFrames(self, ds , frameIndexes : list):
+        SelectFrames(ds , frameIndexes)
+
+    def reduceResolution(self, ds , resolution_level : int):
+        # the frames are decoded at a reduced resolution : the image size and the pixel spacing must describe the reduced frames.
+        factor = 2 ** resolution_level
+        # new elements : setting ds.Rows would modify the element of the series template shared by the other instances.
+        ds["Rows"] = DataElement("Rows" , "US" , GetReducedSize(ds.Rows , resolution_level))
+        ds["Columns"] = DataElement("Columns" , "US" , GetReducedSize(ds.Columns , resolution_level))
+        for keyword in ["PixelSpacing" , "ImagerPixelSpacing"]:
+            if keyword in ds and ds[keyword].VM == 2:
+                ds[keyword] = DataElement(keyword , "DS" , [ float(spacing) * factor for spacing in ds[keyword].value ])
+
+    def getSeriesTemplate(self, ImageFrame , InstanceMetadata , vrmap) -> Dataset:
+        """
+        Returns the dataset holding the Patient , Study and Series level tags of the job's series. 
+        It is compiled once per series and export , the jobs without ExportId are compiled every time.
+        """
+        exportId = ImageFrame.get("ExportId")
+        key = ( exportId , ImageFrame.get("imagesetId") , ImageFrame.get("SeriesUID") )
+        if exportId is not None and key in self.templates:
+            self.templates.move_to_end(key)
+            return self.templates[key]
+        template = Dataset()
+        self.getTags(InstanceMetadata["Patient"], template , vrmap)
+        self.getTags(InstanceMetadata["Study"], template , vrmap)
+        self.getTags(InstanceMetadata["Series"], template , vrmap)
+        if exportId is not None:
+            self.templates[key] = template
+            if len(self.templates) > self.maxTemplates:
+                self.templates.popitem(last=False)
+        return template
+
+    def getFramesDICOMized(self, timeout : float = None):
+        """
+        Blocks until a DICOMized job is available and returns it, the pydicom dataset being in its "Dataset" entry.
+        Returns None if the timeout expires first.
+        """
+        try:
+            return self.DICOMizeJobsCompleted.get(timeout = timeout)
+        except Empty:
             return None
 
+    def setEncapsulatedPixelData(self, ds , frames : list , transferSyntaxUID : str):
+        # the HTJ2K frames fetched from AHI are stored as they are : one fragment per frame, with a basic offset table.
+        for frame in frames:
+            if frame[:2] != b"\xff\x4f":
+                raise ValueError("The frame is not a JPEG 2000 codestream and can not be encapsulated.")
+        ds.file_meta.TransferSyntaxUID = UID(transferSyntaxUID)
+        ds.PixelData = encapsulate(frames , has_bot = True)
+        ds["PixelData"].VR = "OB"
+        ds["PixelData"].is_undefined_length = True
+
     def getDataset(self):
         return self.ds
 
         
-    def getDICOMVRs(self,taglevel, vrlist):
-        for theKey in taglevel:
-            vrlist.append( [ theKey , taglevel[theKey] ])
-            self.logger.debug(f"[{__name__}][getDICOMVRs] - List of private tags VRs: {vrlist}\r\n")
+    def getDICOMVRs(self,taglevel) -> dict:
+        # VRs of the private tags, by tag.
+        return dict(taglevel)
 
 
 
-    def getTags(self,tagLevel, ds , vrlist):    
-        for theKey in tagLevel:
-            try:
-                try:
-                    tagvr = pydicom.datadict.dictionary_VR(theKey)
-                except:  #In case the vr is not in the pydicom dictionnary, it might be a private tag , listed in the vrlist
-                    tagvr = None
-                    for vr in vrlist:
-                        if theKey == vr[0]:
-                            tagvr = vr[1]
-                datavalue=tagLevel[theKey]
-                #print(f"{theKey} : {datavalue}")
-                if(tagvr == 'SQ'):
-                    #self.logger.debug(f"{theKey} : {tagLevel[theKey]} , {vrlist}")
-                    seqs = []
-                    for underSeq in tagLevel[theKey]:
-                        seqds = Dataset()
-                        self.getTags(underSeq, seqds, vrlist)
-                        seqs.append(seqds)
-                    datavalue = Sequence(seqs)
-                if(tagvr == 'US or SS'):
-                    datavalue=tagLevel[theKey]
-                    if isinstance(datavalue, int):  #this could be a multi value element.
-                        if (int(datavalue) > 32767):
-                            tagvr = 'US'
-                        else:
-                            tagvr = 'SS'
-                    else:
-                        tagvr = 'US'
-                if( tagvr in  [ 'OB' , 'OD' , 'OF', 'OL', 'OW', 'UN' , 'OB or OW' ] ):
-                    base64_str = tagLevel[theKey]
-                    base64_bytes = base64_str.encode('utf-8')
-                    datavalue = base64.decodebytes(base64_bytes)
-                data_element = DataElement(theKey , tagvr , datavalue )
-                if data_element.tag.group != 2:
-                    try:
-                        ds.add(data_element) 
-                    except:
-                        continue
-            except Exception as err:
-                self.logger.warning(f"[{__name__}][getTags] - {err}")
-                continue
+    def getTags(self,tagLevel, ds , vrmap):    
+        GetTags(tagLevel , ds , vrmap)
+
+    def getUtilization(self) -> dict:
+        """
+        Returns the number of jobs processed by this process, the time spent processing them and the ratio of that time to the process lifetime.
+        """
+        elapsed = time.time() - self.startTime
+        return { "Worker" : f"dicomizer-{self.InstanceId}" , "JobsDone" : self.jobsDone.value , "BusyTime" : self.busyTime.value , "Utilization" : self.busyTime.value / elapsed if elapsed > 0 else 0.0 }
+
+    def Stop(self):
+        # With a shared job queue the sentinel is taken by any of the processes : Stop() must be called for all of them before they are disposed.
+        if not self.stopping:
+            self.DICOMizeJobs.put(None)
+            self.stopping = True
 
     def Dispose(self):
-        self.thread_running.value = 0
-        self.process.kill()
\ No newline at end of file
+        self.Stop()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+
+
+def GetTags(tagLevel , ds , vrmap):
+    # adds the elements of one level of the AHI metadata to the dataset , the file meta elements excepted.
+    for theKey in tagLevel:
+        try:
+            data_element = GetDataElement(theKey , tagLevel[theKey] , vrmap)
+            if data_element.tag.group != 2:
+                try:
+                    ds.add(data_element) 
+                except:
+                    continue
+        except Exception as err:
+            logging.getLogger(__name__).warning(f"[{__name__}][getTags] - {err}")
+            continue
+
+
+def GetDataElement(theKey : str , datavalue , vrmap) -> DataElement:
+    # the element of one keyword of the AHI metadata , raises an exception if it can not be converted.
+    tagvr = getDictionaryVR(theKey)
+    if tagvr is None:  #In case the vr is not in the pydicom dictionnary, it might be a private tag , listed in the vrmap
+        tagvr = vrmap.get(theKey)
+    if(tagvr == 'SQ'):
+        seqs = []
+        for underSeq in datavalue:
+            seqds = Dataset()
+            GetTags(underSeq, seqds, vrmap)
+            seqs.append(seqds)
+        datavalue = Sequence(seqs)
+    if(tagvr == 'US or SS'):
+        if isinstance(datavalue, int):  #this could be a multi value element.
+            if (int(datavalue) > 32767):
+                tagvr = 'US'
+            else:
+                tagvr = 'SS'
+        else:
+            tagvr = 'US'
+    if( tagvr in  [ 'OB' , 'OD' , 'OF', 'OL', 'OW', 'UN' , 'OB or OW' ] ):
+        datavalue = base64.decodebytes(datavalue.encode('utf-8'))
+    return DataElement(theKey , tagvr , datavalue )
+
+
+def NewInstanceDataset(elements : dict , SOPInstanceUID : str) -> FileDataset:
+    # the dataset of one instance , encoded in explicit VR little endian , from its elements by tag.
+    file_meta = FileMetaDataset()
+    ds = FileDataset(None, elements, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    file_meta.MediaStorageSOPInstanceUID = UID(SOPInstanceUID)
+    return ds
+
+
+def SelectFrames(ds , frameIndexes : list):
+    # only a subset of the frames is exported : the frame count and the per frame attributes must describe the frames kept.
+    # the elements are replaced , not modified in place , as they can be shared with the series template.
+    frameCount = int(ds.get("NumberOfFrames" , 1) or 1)
+    ds["NumberOfFrames"] = DataElement("NumberOfFrames" , "IS" , len(frameIndexes))
+    if "PerFrameFunctionalGroupsSequence" in ds and len(ds.PerFrameFunctionalGroupsSequence) == frameCount:
+        ds["PerFrameFunctionalGroupsSequence"] = DataElement("PerFrameFunctionalGroupsSequence" , "SQ" , Sequence([ ds.PerFrameFunctionalGroupsSequence[index] for index in frameIndexes ]))
@@ -0,0 +1,84 @@
+"""
+AHItoDICOM Module : This class contains the logic to record the instances exported by a bulk export, so an interrupted export can be resumed.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import logging
+import sqlite3
+import time
+from threading import Lock
+
+
+class AHIExportManifest:
+
+    path = None
+    logger = None
+
+    def __init__(self, path : str , commit_batch_size : int = 256):
+        """
+        SQLite manifest of a bulk export. The instances written are recorded by (datastoreId , imageSetId , version , SOPInstanceUID), and the ImageSets are marked complete once all their instances are written.
+        The records are committed by batches of commit_batch_size : after a crash the instances written since the last commit are exported again, which overwrites the same files.
+
+        :param path: The SQLite file of the manifest , created if it does not exist.
+        :param commit_batch_size: Optional number of records committed together. Will default to 256.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.commit_batch_size = commit_batch_size
+        self.lock = Lock()
+        self.uncommitted = 0
+        # the records come from the writer threads , all the accesses are serialized by the lock.
+        self.connection = sqlite3.connect(path , check_same_thread = False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS instances (datastore_id TEXT , image_set_id TEXT , version TEXT , sop_instance_uid TEXT , path TEXT , size INTEGER , completed_at REAL , PRIMARY KEY (datastore_id , image_set_id , version , sop_instance_uid))")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS image_sets (datastore_id TEXT , image_set_id TEXT , version TEXT , instance_count INTEGER , completed_at REAL , PRIMARY KEY (datastore_id , image_set_id , version))")
+        self.connection.commit()
+
+    def isImageSetComplete(self, datastoreId : str , imageSetId : str , version : str) -> bool:
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM image_sets WHERE datastore_id = ? AND image_set_id = ? AND version = ?" , (datastoreId , imageSetId , str(version))).fetchone()
+        return row is not None
+
+    def getCompletedInstances(self, datastoreId : str , imageSetId : str , version : str) -> set:
+        """
+        Returns the SOPInstanceUIDs of the instances of the ImageSet version already written.
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT sop_instance_uid FROM instances WHERE datastore_id = ? AND image_set_id = ? AND version = ?" , (datastoreId , imageSetId , str(version))).fetchall()
+        return set( row[0] for row in rows )
+
+    def recordInstance(self, datastoreId : str , imageSetId : str , version : str , SOPInstanceUID : str , path : str , size : int):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO instances VALUES (? , ? , ? , ? , ? , ? , ?)" , (datastoreId , imageSetId , str(version) , SOPInstanceUID , path , size , time.time()))
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_batch_size:
+                self.connection.commit()
+                self.uncommitted = 0
+
+    def recordImageSet(self, datastoreId : str , imageSetId : str , version : str , instanceCount : int):
+        """
+        Marks the ImageSet version complete : it is skipped by the next exports.
+        """
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO image_sets VALUES (? , ? , ? , ? , ?)" , (datastoreId , imageSetId , str(version) , instanceCount , time.time()))
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def getStatistics(self) -> dict:
+        """
+        Returns the number of ImageSets complete , and the number and size of the instances written, over all the exports recorded in the manifest.
+        """
+        with self.lock:
+            imageSets = self.connection.execute("SELECT COUNT(*) FROM image_sets").fetchone()[0]
+            instances , size = self.connection.execute("SELECT COUNT(*) , COALESCE(SUM(size) , 0) FROM instances").fetchone()
+        return { "ImageSets" : imageSets , "Instances" : instances , "Bytes" : size }
+
+    def flush(self):
+        with self.lock:
+            self.connection.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,146 @@
+"""
+AHItoDICOM Module : This class contains the logic to adapt the number of concurrent frame requests to the throttling and the latency of the service , and to retry the failed requests.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+from threading import Condition
+import logging
+import random
+import time
+
+
+# error codes returned by the service when the request rate is too high.
+THROTTLING_ERROR_CODES = { "ThrottlingException" , "Throttling" , "TooManyRequestsException" , "RequestLimitExceeded" , "SlowDown" , "ProvisionedThroughputExceededException" , "ServiceQuotaExceededException" }
+# latency increase in seconds under which the latency signal is ignored , so the jitter of very short requests does not decrease the limit.
+LATENCY_NOISE = 0.02
+
+
+class AHIFetchController:
+
+    logger = None
+
+    def __init__(self, max_concurrency : int = 64 , min_concurrency : int = 1 , initial_concurrency : int = None , decrease_ratio : float = 0.5 , latency_tolerance : float = 3.0 , max_attempts : int = 6 , base_delay : float = 0.05 , max_delay : float = 5.0):
+        """
+        Limits the number of frame requests in flight , across all the threads of the helper , with an AIMD controller : the limit grows by 1 every limit successful requests , and is multiplied by decrease_ratio
+        when a request is throttled , or when the smoothed latency grows over latency_tolerance times the lowest latency observed. The limit is decreased at most once per round of requests , the requests
+        sent before a decrease do not decrease it again. The throttled requests and the transient network errors are retried max_attempts times in total , after an exponential backoff with full jitter.
+        Any other error , or the last one , is raised to the caller.
+
+        :param max_concurrency: Optional maximum number of requests in flight. Will default to 64.
+        :param min_concurrency: Optional minimum number of requests in flight. Will default to 1.
+        :param initial_concurrency: Optional number of requests in flight to start with. Will default to max_concurrency , the limit only being decreased once the service pushes back.
+        :param decrease_ratio: Optional ratio the limit is multiplied by on throttling. Will default to 0.5.
+        :param latency_tolerance: Optional ratio of the smoothed latency to the lowest latency over which the limit is decreased , None to only react to throttling. Will default to 3.
+        :param max_attempts: Optional number of attempts of each request , the first one included. Will default to 6.
+        :param base_delay: Optional delay in seconds before the first retry , doubled for each retry. Will default to 0.05.
+        :param max_delay: Optional maximum delay in seconds before a retry. Will default to 5.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.max_concurrency = max(1 , max_concurrency)
+        self.min_concurrency = max(1 , min(min_concurrency , self.max_concurrency))
+        if initial_concurrency is None:
+            initial_concurrency = self.max_concurrency
+        self.limit = float(min(max(initial_concurrency , self.min_concurrency) , self.max_concurrency))
+        self.decrease_ratio = decrease_ratio
+        self.latency_tolerance = latency_tolerance
+        self.max_attempts = max(1 , max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.condition = Condition()
+        self.in_flight = 0
+        self.epoch = 0 # incremented by each decrease of the limit.
+        self.minLatency = None
+        self.smoothedLatency = None
+        self.statistics = { "Requests" : 0 , "Retries" : 0 , "Throttled" : 0 , "TransientErrors" : 0 , "Failures" : 0 , "Decreases" : 0 , "MaxInFlight" : 0 }
+
+    def call(self, function , *args , **kwargs):
+        """
+        Calls function(*args , **kwargs) once a request slot is available , and returns its result. The call is retried on throttling and transient errors.
+        """
+        attempt = 0
+        while True:
+            epoch = self.acquire()
+            start = time.perf_counter()
+            try:
+                result = function(*args , **kwargs)
+            except Exception as err:
+                throttled = IsThrottlingError(err)
+                transient = not throttled and IsTransientError(err)
+                self.release(epoch , throttled = throttled)
+                attempt += 1
+                with self.condition:
+                    if throttled:
+                        self.statistics["Throttled"] += 1
+                    elif transient:
+                        self.statistics["TransientErrors"] += 1
+                    if not (throttled or transient) or attempt >= self.max_attempts:
+                        self.statistics["Failures"] += 1
+                        raise
+                    self.statistics["Retries"] += 1
+                # full jitter : the retries of the requests throttled together are spread over the whole backoff window.
+                time.sleep(random.uniform(0 , min(self.max_delay , self.base_delay * 2 ** (attempt - 1))))
+                continue
+            self.release(epoch , latency = time.perf_counter() - start)
+            return result
+
+    def acquire(self) -> int:
+        # blocks until a request slot is available , and returns the epoch the request is sent in.
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            self.statistics["Requests"] += 1
+            self.statistics["MaxInFlight"] = max(self.statistics["MaxInFlight"] , self.in_flight)
+            return self.epoch
+
+    def release(self, epoch : int , latency : float = None , throttled : bool = False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self._decrease(epoch , "throttling")
+            elif latency is not None:
+                self.minLatency = latency if self.minLatency is None else min(self.minLatency , latency)
+                self.smoothedLatency = latency if self.smoothedLatency is None else 0.9 * self.smoothedLatency + 0.1 * latency
+                if self.latency_tolerance is not None and self.smoothedLatency > self.latency_tolerance * self.minLatency + LATENCY_NOISE:
+                    self._decrease(epoch , f"latency {self.smoothedLatency * 1000:.0f} ms")
+                else:
+                    # additive increase : about 1 more request in flight per round of limit requests.
+                    self.limit = min(self.max_concurrency , self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def _decrease(self, epoch : int , reason : str):
+        # called with the condition held. The requests sent before the last decrease do not decrease the limit again.
+        if epoch != self.epoch:
+            return
+        self.epoch += 1
+        self.limit = max(self.min_concurrency , self.limit * self.decrease_ratio)
+        self.statistics["Decreases"] += 1
+        if self.smoothedLatency is not None and reason != "throttling":
+            # the latency is measured again from the lower concurrency.
+            self.smoothedLatency = self.minLatency
+        self.logger.debug(f"[{__name__}] - Concurrency decreased to {int(self.limit)} on {reason}.")
+
+    def getStatistics(self) -> dict:
+        """
+        Returns the number of requests , retries , throttled requests , transient errors and failures since the controller was created , along with the current concurrency limit.
+        """
+        with self.condition:
+            return dict(self.statistics , Concurrency = int(self.limit) , InFlight = self.in_flight)
+
+
+def IsThrottlingError(err : Exception) -> bool:
+    # botocore is only imported once a request failed.
+    from botocore.exceptions import ClientError
+    if isinstance(err , ClientError):
+        return err.response.get("Error" , {}).get("Code") in THROTTLING_ERROR_CODES or err.response.get("ResponseMetadata" , {}).get("HTTPStatusCode") == 429
+    return False
+
+
+def IsTransientError(err : Exception) -> bool:
+    # network errors , and the server side errors of the service.
+    from botocore.exceptions import ClientError , ConnectionError as BotocoreConnectionError , ConnectionClosedError , ReadTimeoutError , ConnectTimeoutError
+    if isinstance(err , (BotocoreConnectionError , ConnectionClosedError , ReadTimeoutError , ConnectTimeoutError , ConnectionError , TimeoutError)):
+        return True
+    if isinstance(err , ClientError):
+        return err.response.get("ResponseMetadata" , {}).get("HTTPStatusCode" , 0) >= 500
+    return False
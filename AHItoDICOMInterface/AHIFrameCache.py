@@ -0,0 +1,164 @@
+"""
+AHItoDICOM Module : This class contains the logic to cache the frames fetched from AHI on the local file system.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from threading import Lock
+
+
+class AHIFrameCache:
+
+    cache_dir = None
+    max_size = None
+    cache_decoded = False
+    logger = None
+
+    def __init__(self, cache_dir : str , max_size : int = 10 * 1024 ** 3 , cache_decoded : bool = False):
+        """
+        Content addressed frame cache. The frames are stored in cache_dir under the hash of their (datastoreId , imageSetId , imageFrameId) key, as HTJ2K blobs and optionally as decoded pixels.
+        Files are written to a temporary file and renamed, so several processes can share the same cache_dir. The least recently used frames are evicted when the cache grows over max_size.
+
+        :param cache_dir: The folder where the frames are stored.
+        :param max_size: Optional maximum size of the cache in bytes. Will default to 10 GiB.
+        :param cache_decoded: Optional, if set to True the decoded pixels are cached too, so a warm export also skips the decode.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.cache_decoded = cache_decoded
+        self.lock = Lock()
+        self.evicting = False # only one thread evicts at a time , the others keep writing.
+        self.statistics = { "Hits" : 0 , "Misses" : 0 , "DecodedHits" : 0 , "DecodedMisses" : 0 , "Writes" : 0 , "Evictions" : 0 }
+        os.makedirs(cache_dir , exist_ok=True)
+        self.size = self._scan()[0]
+
+    def getBlob(self, datastoreId : str , imageSetId : str , imageFrameId : str):
+        """
+        Returns the HTJ2K blob of the frame, or None if it is not in the cache.
+        """
+        blob = self._read(self._path(datastoreId , imageSetId , imageFrameId , ".j2c"))
+        self._count("Hits" if blob is not None else "Misses")
+        return blob
+
+    def putBlob(self, datastoreId : str , imageSetId : str , imageFrameId : str , blob : bytes):
+        self._write(self._path(datastoreId , imageSetId , imageFrameId , ".j2c") , blob)
+
+    def getPixels(self, datastoreId : str , imageSetId : str , imageFrameId : str):
+        """
+        Returns the decoded pixels of the frame, or None if they are not in the cache.
+        """
+        pixels = self._read(self._path(datastoreId , imageSetId , imageFrameId , ".raw"))
+        self._count("DecodedHits" if pixels is not None else "DecodedMisses")
+        return pixels
+
+    def putPixels(self, datastoreId : str , imageSetId : str , imageFrameId : str , pixels):
+        self._write(self._path(datastoreId , imageSetId , imageFrameId , ".raw") , pixels)
+
+    def getStatistics(self) -> dict:
+        """
+        Returns the hits , misses , writes and evictions counted by this cache object, the ratio of frames served from the cache and the size of the cache in bytes.
+        """
+        with self.lock:
+            statistics = dict(self.statistics)
+            statistics["Size"] = self.size
+        # each frame is either found decoded , found compressed or downloaded.
+        frames = statistics["DecodedHits"] + statistics["Hits"] + statistics["Misses"]
+        statistics["HitRatio"] = (statistics["DecodedHits"] + statistics["Hits"]) / frames if frames > 0 else 0.0
+        return statistics
+
+    def clear(self):
+        for path , size , mtime in self._scan()[1]:
+            self._remove(path)
+        with self.lock:
+            self.size = 0
+
+    def _path(self, datastoreId : str , imageSetId : str , imageFrameId : str , extension : str) -> str:
+        key = hashlib.sha256(f"{datastoreId}/{imageSetId}/{imageFrameId}".encode()).hexdigest()
+        return os.path.join(self.cache_dir , key[:2] , key + extension)
+
+    def _read(self, path : str):
+        try:
+            with open(path , "rb") as f:
+                data = f.read()
+            os.utime(path) # the modification time is the last access time used by the LRU eviction.
+            return data
+        except OSError: # not cached , or evicted by another process.
+            return None
+
+    def _write(self, path : str , data):
+        try:
+            folder = os.path.dirname(path)
+            os.makedirs(folder , exist_ok=True)
+            fd , temp_path = tempfile.mkstemp(dir=folder , prefix=".tmp")
+            with os.fdopen(fd , "wb") as f:
+                f.write(data)
+            try: # the frame may already be cached , e.g. written by another thread or process : only the difference is added to the size.
+                replaced = os.stat(path).st_size
+            except OSError:
+                replaced = 0
+            os.replace(temp_path , path)
+        except OSError as err:
+            self.logger.warning(f"[{__name__}] - Frame could not be cached : {err}")
+            return
+        with self.lock:
+            self.statistics["Writes"] += 1
+            self.size += len(data) - replaced
+            evict = self.size > self.max_size and not self.evicting
+            if evict:
+                self.evicting = True
+        if evict:
+            try:
+                self._evict()
+            finally:
+                with self.lock:
+                    self.evicting = False
+
+    def _evict(self):
+        # Other processes may write to the same folder, the size is measured again before evicting down to 90% of max_size.
+        size , files = self._scan()
+        files.sort(key=lambda file: file[2])
+        evicted = 0
+        for path , file_size , mtime in files:
+            if size <= self.max_size * 0.9:
+                break
+            if self._remove(path):
+                size -= file_size
+                evicted += 1
+        with self.lock:
+            self.size = size
+            self.statistics["Evictions"] += evicted
+
+    def _scan(self):
+        size = 0
+        files = []
+        now = time.time()
+        for folder , subfolders , filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                path = os.path.join(folder , filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if filename.startswith(".tmp"):
+                    if now - stat.st_mtime > 3600: # left over by a process which was killed while writing.
+                        self._remove(path)
+                    continue
+                size += stat.st_size
+                files.append((path , stat.st_size , stat.st_mtime))
+        return size , files
+
+    def _remove(self, path : str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def _count(self, statistic : str):
+        with self.lock:
+            self.statistics[statistic] += 1
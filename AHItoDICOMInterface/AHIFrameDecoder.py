@@ -0,0 +1,105 @@
+"""
+AHItoDICOM Module : This class contains the logic to decode the HTJ2K frames fetched from AHI.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+from multiprocessing import Queue , Value , shared_memory
+import multiprocessing
+import logging
+import time
+from .AHIFrameFetcher import DecodeFrame , PreloadDecoders
+
+
+class AHIFrameDecoder:
+
+    DecodeJobs = None
+    DecodedFrames = None
+    InstanceId = None
+    process = None
+    logger = None
+
+    def __init__(self, InstanceId , DecodeJobs : Queue , DecodedFrames : Queue , context = None):
+        """
+        Frame decoder process, the CPU stage of the frame pipeline. It takes (instanceKey , frame_number , blob , segment , resolution_level , enqueued) jobs from the DecodeJobs queue and puts (instanceKey , frame_number , pixels , error , timings) results in the DecodedFrames queue,
+        timings being the ( seconds waited in the queue since the time.time() enqueued , seconds spent decoding ) of the frame.
+        When segment is a ("shm" , name , offset , length) shared memory handle the pixels are written in the segment and None is put in the queue instead. The segment is owned by the AHIFrameScheduler : the decoder only attaches to it.
+        When segment is a ("file" , path , offset , length) handle the pixels are written in the file at offset , e.g. in the memory mapped volume of AHItoDICOM.getVolume().
+        Both queues are meant to be shared by all the decoder processes.
+
+        :param context: Optional multiprocessing context the process is started from , the queues must be created by the same context. Will default to the default context.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.InstanceId = InstanceId
+        self.DecodeJobs = DecodeJobs
+        self.DecodedFrames = DecodedFrames
+        self.stopping = False
+        self.startTime = time.time()
+        context = context if context is not None else multiprocessing.get_context()
+        self.busyTime = context.Value('d', 0.0)
+        self.jobsDone = context.Value('i', 0)
+        self.process = context.Process(target = self.ProcessJobs , args=(self.DecodeJobs , self.DecodedFrames , self.busyTime , self.jobsDone) , daemon = True)
+        self.process.start()
+
+    def __getstate__(self):
+        # the decoder is pickled along with its ProcessJobs target by the spawn and forkserver start methods , the process handle stays in the parent.
+        state = self.__dict__.copy()
+        state.pop("process" , None)
+        return state
+
+    def ProcessJobs(self, DecodeJobs : Queue , DecodedFrames : Queue , busyTime : Value , jobsDone : Value):
+        PreloadDecoders()
+        while True:
+            job = DecodeJobs.get()
+            if job is None: # sentinel sent by Stop()
+                break
+            jobStart = time.perf_counter()
+            instanceKey , frame_number , blob , segment , resolution_level , enqueued = job
+            queueWait = time.time() - enqueued
+            try:
+                if segment is None:
+                    pixels = DecodeFrame(blob , resolution_level = resolution_level)
+                    DecodedFrames.put((instanceKey , frame_number , pixels , None , (queueWait , time.perf_counter() - jobStart)))
+                else:
+                    self.DecodeInSegment(frame_number , blob , *segment , resolution_level = resolution_level)
+                    DecodedFrames.put((instanceKey , frame_number , None , None , (queueWait , time.perf_counter() - jobStart)))
+            except Exception as e:
+                self.logger.error(f"[{__name__}][{self.InstanceId}] - Frame {frame_number} could not be decoded : {e}")
+                DecodedFrames.put((instanceKey , frame_number , None , str(e) , None))
+            busyTime.value += time.perf_counter() - jobStart
+            jobsDone.value += 1
+
+    def DecodeInSegment(self, frame_number : int , blob : bytes , kind : str , name : str , offset : int , length : int , resolution_level : int = 0):
+        pixels = DecodeFrame(blob , resolution_level = resolution_level)
+        if len(pixels) != length:
+            raise ValueError(f"Frame {frame_number} decoded to {len(pixels)} bytes , {length} bytes expected from the metadata.")
+        if kind == "file":
+            # the file is allocated by the parent process , the frame is written at its place.
+            with open(name , "r+b") as f:
+                f.seek(offset)
+                f.write(pixels)
+            return
+        # raises FileNotFoundError if the instance failed meanwhile and its segment was released.
+        segment = shared_memory.SharedMemory(name = name)
+        try:
+            segment.buf[offset : offset + length] = pixels
+        finally:
+            segment.close()
+
+    def getUtilization(self) -> dict:
+        """
+        Returns the number of frames decoded by this process, the time spent decoding them and the ratio of that time to the process lifetime.
+        """
+        elapsed = time.time() - self.startTime
+        return { "Worker" : f"decoder-{self.InstanceId}" , "JobsDone" : self.jobsDone.value , "BusyTime" : self.busyTime.value , "Utilization" : self.busyTime.value / elapsed if elapsed > 0 else 0.0 }
+
+    def Stop(self):
+        # With a shared job queue the sentinel is taken by any of the processes : Stop() must be called for all of them before they are disposed.
+        if not self.stopping:
+            self.DecodeJobs.put(None)
+            self.stopping = True
+
+    def Dispose(self):
+        self.Stop()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
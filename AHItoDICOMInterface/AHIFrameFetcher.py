@@ -3,115 +3,306 @@ AHItoDICOM Module : This class contains the logic to query the Image pixel raste
 
 SPDX-License-Identifier: Apache-2.0
 """
-from multiprocessing import Process , Queue
+from multiprocessing import Process , Queue , Value
 import logging
-from openjpeg import decode
-import io
 from .AHIClientFactory import * 
-import time
+from .AHIFetchController import AHIFetchController
 from multiprocessing.pool import ThreadPool
+from queue import Empty
+import time
+
+
+# openjpeg and imagecodecs are imported on the first frame decoded , so only the processes decoding frames pay for their import.
+_imagecodecs = None
+
+
+def GetImagecodecs():
+    """
+    Returns the imagecodecs module , or None when it is not installed. OpenJPH , through imagecodecs , decodes the HTJ2K frames at a reduced resolution without decoding the full resolution first.
+    """
+    global _imagecodecs
+    if _imagecodecs is None:
+        try:
+            import imagecodecs
+            _imagecodecs = imagecodecs
+        except ImportError:
+            _imagecodecs = False
+    return _imagecodecs or None
+
+
+def PreloadDecoders():
+    # called by the decoder processes when they start , so the import is not paid by the first frame.
+    import openjpeg
+    GetImagecodecs()
 
 
 class AHIFrameFetcher:
+    # Instance level fetch and decode process. AHItoDICOM now schedules frames through AHIFrameScheduler and AHIFrameDecoder instead, this class is kept for the code using it directly.
 
-    
-    status = 'idle'
     FetchJobs = None
     FetchJobsCompleted = None
-    FetchJobsInError = None
     InstanceId= None
     client = None
-    thread_running = True
     process = None
     aws_access_key = None
     aws_secret_key = None
     AHI_endpoint = None
     logger = None
 
-    def __init__(self, InstanceId , aws_access_key , aws_secret_key , AHI_endpoint = None , ahi_client = None):
+    def __init__(self, InstanceId , aws_access_key , aws_secret_key , AHI_endpoint = None , ahi_client = None , FetchJobsCompleted : Queue = None , FetchJobs : Queue = None):
+        """
+        Frame fetcher process. The fetched instances, or the instances in error, are put in the FetchJobsCompleted queue.
+        Both queues can be shared by several processes, in which case any idle process takes the next job.
+        """
         self.logger = logging.getLogger(__name__)
         self.InstanceId = InstanceId
-        self.FetchJobs = Queue()
-        self.FetchJobsCompleted = Queue()
-        self.FetchJobsInError = Queue()
-        self.aws_secret_key = aws_access_key
+        if FetchJobs is None:
+            FetchJobs = Queue()
+        self.FetchJobs = FetchJobs
+        if FetchJobsCompleted is None:
+            FetchJobsCompleted = Queue()
+        self.FetchJobsCompleted = FetchJobsCompleted
+        self.aws_access_key = aws_access_key
         self.aws_secret_key = aws_secret_key
         self.AHI_endpoint = AHI_endpoint
         self.ahi_client = ahi_client
-        self.process = Process(target = self.ProcessJobs , args=(self.FetchJobs,self.FetchJobsCompleted, self.FetchJobsInError ,  self.aws_access_key , self.aws_secret_key , self.AHI_endpoint , self.ahi_client))
+        self.stopping = False
+        self.startTime = time.time()
+        self.busyTime = Value('d', 0.0)
+        self.jobsDone = Value('i', 0)
+        self.process = Process(target = self.ProcessJobs , args=(self.FetchJobs,self.FetchJobsCompleted,  self.aws_access_key , self.aws_secret_key , self.AHI_endpoint , self.ahi_client , self.busyTime , self.jobsDone) , daemon = True)
         self.process.start()
    
     def AddFetchJob(self,FetchJob):
             self.FetchJobs.put(FetchJob)
-            self.logger.debug("[{__name__}]["+self.InstanceId+"] - Fetch Job added "+str(FetchJob)+".")
+            self.logger.debug("[%s][%s] - Fetch Job added %s.", __name__ , self.InstanceId , FetchJob["SOPInstanceUID"])
 
-    def ProcessJobs(self,FetchJobs : Queue, FetchJobsCompleted : Queue , FetchJobsInError : Queue ,   aws_access_key : str = None , aws_secret_key : str = None , AHI_endpoint : str = None , ahi_client = None):  
+    def ProcessJobs(self,FetchJobs : Queue, FetchJobsCompleted : Queue , aws_access_key : str = None , aws_secret_key : str = None , AHI_endpoint : str = None , ahi_client = None , busyTime : Value = None , jobsDone : Value = None):  
         if ahi_client is None: 
             ahi_client = AHIClientFactory( aws_access_key= aws_access_key , aws_secret_key=aws_secret_key ,  aws_accendpoint_url=AHI_endpoint )
-        while(self.thread_running):
-            if not FetchJobs.empty():
-                try:
-                    entry = FetchJobs.get(block=False)
-                    if(len(entry["frameIds"]) > 2):
-                        self.logger.debug("Multiframes fetch via threadPool")
-                        map_ite = []
-                        i = 1
-                        for frameId in entry["frameIds"]:
-                            function_args = (entry["datastoreId"], entry["imagesetId"], frameId , i , ahi_client )
-                            map_ite.append(function_args)
-                            i = i + 1
-                        with ThreadPool(100) as pool:
-                            framesToOrder = []
-                            results = pool.map_async(GetFramePixels, map_ite , chunksize=5 )
-                            results.wait()
-                        for result in results.get():
-                            frame_number , pixels = result
-                            framesToOrder.append({ "frame_number" : frame_number , "pixels" : pixels}) 
-                        framesToOrder.sort(key=lambda x: x["frame_number"])
-                        entry["PixelData"] = b''
-                        for frame in framesToOrder:
-                            result = frame["pixels"]
-                            entry["PixelData"] = entry["PixelData"] + result
-                    else:
-                        self.logger.debug(f"single frame fetch for {entry['datastoreId']}/{entry['imagesetId']}/{entry['frameIds'][0]}")
-                        frame_number , entry["PixelData"] = GetFramePixels( (entry["datastoreId"], entry["imagesetId"], entry["frameIds"][0] , 1 , ahi_client))
-                    FetchJobsCompleted.put(entry)
-                except Exception as e:
-                    self.logger.error("[{__name__}]["+self.InstanceId+"] - Error while processing job "+str(entry)+" : "+str(e))
-                    FetchJobsInError.put(entry)
-            else:
-                time.sleep(0.1)
-
-    def getFramesFetched(self):
-        if  not self.FetchJobsCompleted.empty() :
-            obj = self.FetchJobsCompleted.get(block=False)
-            return obj
-        else:
+        # the requests of all the instances of the process share one concurrency limit , adapted to the throttling.
+        controller = AHIFetchController(max_concurrency = 100)
+        while True:
+            entry = FetchJobs.get()
+            if entry is None: # sentinel sent by Stop()
+                break
+            jobStart = time.perf_counter()
+            try:
+                if(len(entry["frameIds"]) > 2):
+                    self.logger.debug("Multiframes fetch via threadPool")
+                    map_ite = []
+                    i = 1
+                    for frameId in entry["frameIds"]:
+                        function_args = (entry["datastoreId"], entry["imagesetId"], frameId , i , ahi_client , None , controller )
+                        map_ite.append(function_args)
+                        i = i + 1
+                    with ThreadPool(100) as pool:
+                        framesToOrder = []
+                        results = pool.map_async(GetFramePixels, map_ite , chunksize=5 )
+                        results.wait()
+                    for result in results.get():
+                        frame_number , pixels = result
+                        framesToOrder.append({ "frame_number" : frame_number , "pixels" : pixels}) 
+                    framesToOrder.sort(key=lambda x: x["frame_number"])
+                    entry["PixelData"] = b"".join([ frame["pixels"] for frame in framesToOrder ])
+                else:
+                    self.logger.debug(f"single frame fetch for {entry['datastoreId']}/{entry['imagesetId']}/{entry['frameIds'][0]}")
+                    frame_number , entry["PixelData"] = GetFramePixels( (entry["datastoreId"], entry["imagesetId"], entry["frameIds"][0] , 1 , ahi_client , None , controller))
+                FetchJobsCompleted.put(entry)
+            except Exception as e:
+                self.logger.error(f"[{__name__}][{self.InstanceId}] - Error while processing job {entry['SOPInstanceUID']} : {e}")
+                entry["PixelData"] = None
+                entry["Error"] = str(e)
+                FetchJobsCompleted.put(entry)
+            busyTime.value += time.perf_counter() - jobStart
+            jobsDone.value += 1
+
+    def getFramesFetched(self, timeout : float = None):
+        """
+        Blocks until a fetched instance is available and returns it. Instances which could not be fetched are returned with an "Error" entry.
+        Returns None if the timeout expires first.
+        """
+        try:
+            return self.FetchJobsCompleted.get(timeout = timeout)
+        except Empty:
             return None
 
+    def getUtilization(self) -> dict:
+        """
+        Returns the number of jobs processed by this process, the time spent processing them and the ratio of that time to the process lifetime.
+        """
+        elapsed = time.time() - self.startTime
+        return { "Worker" : f"fetcher-{self.InstanceId}" , "JobsDone" : self.jobsDone.value , "BusyTime" : self.busyTime.value , "Utilization" : self.busyTime.value / elapsed if elapsed > 0 else 0.0 }
+
+    def Stop(self):
+        # With a shared job queue the sentinel is taken by any of the processes : Stop() must be called for all of them before they are disposed.
+        if not self.stopping:
+            self.FetchJobs.put(None)
+            self.stopping = True
+
     def Dispose(self):
-        self.thread_running = False
-        self.process.kill()
+        self.Stop()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
 
 
 def GetFramePixels( val ):
+    # raises the errors , so an instance with a missing frame is reported in error instead of being assembled without it.
     datastoreId = val[0]
     imagesetId = val[1]
     imageFrameId = val[2]
     frame_number = val[3]
     client = val[4]
+    frame_cache = val[5] if len(val) > 5 else None
+    controller = val[6] if len(val) > 6 else None
 
     try:
-        res = client.get_image_frame(
-            datastoreId=datastoreId,
-            imageSetId=imagesetId,
-            imageFrameInformation= {'imageFrameId' : imageFrameId})
-        b = io.BytesIO()
-        b.write(res['imageFrameBlob'].read())
-        b.seek(0)
-        d = decode(b).tobytes()
+        if frame_cache is not None and frame_cache.cache_decoded:
+            d = frame_cache.getPixels(datastoreId , imagesetId , imageFrameId)
+            if d is not None:
+                return frame_number , d
+        d = DecodeFrame(GetFrameBlob(datastoreId , imagesetId , imageFrameId , client , frame_cache , controller)).tobytes()
+        if frame_cache is not None and frame_cache.cache_decoded:
+            frame_cache.putPixels(datastoreId , imagesetId , imageFrameId , d)
         return frame_number , d
     except Exception as e:
-        logging.error("[{__name__}] - Frame could not be decoded.")
-        logging.error(e)
-        return None
\ No newline at end of file
+        logging.error(f"[{__name__}] - Frame {imageFrameId} could not be fetched or decoded : {e}")
+        raise
+
+
+def GetFrameBlob( datastoreId , imagesetId , imageFrameId , client , frame_cache = None , controller = None ) -> bytes:
+    """
+    Network part of the frame retrieval : returns the HTJ2K compressed frame as stored in AHI.
+    If an AHIFrameCache is provided the frame is read from it when present, and added to it otherwise.
+    If an AHIFetchController is provided the request waits for a slot of its concurrency limit , and is retried on throttling and transient errors. The errors left are raised.
+    """
+    if frame_cache is not None:
+        blob = frame_cache.getBlob(datastoreId , imagesetId , imageFrameId)
+        if blob is not None:
+            return blob
+    if controller is not None:
+        blob = controller.call(ReadFrameBlob , datastoreId , imagesetId , imageFrameId , client)
+    else:
+        blob = ReadFrameBlob(datastoreId , imagesetId , imageFrameId , client)
+    if frame_cache is not None:
+        frame_cache.putBlob(datastoreId , imagesetId , imageFrameId , blob)
+    return blob
+
+
+def ReadFrameBlob( datastoreId , imagesetId , imageFrameId , client ) -> bytes:
+    # the body is read in the same attempt as the request , so an interrupted download is retried too.
+    res = client.get_image_frame(
+        datastoreId=datastoreId,
+        imageSetId=imagesetId,
+        imageFrameInformation= {'imageFrameId' : imageFrameId})
+    return res['imageFrameBlob'].read()
+
+
+def DecodeFrame( blob : bytes , out = None , resolution_level : int = 0 ):
+    """
+    CPU part of the frame retrieval : returns the raw pixels of an HTJ2K compressed frame as a flat uint8 numpy array, without copying them.
+    If out is provided (a writable buffer of exactly one frame, e.g. a memoryview on the frame offset of the instance PixelData buffer), the pixels are written in it and out is returned.
+    If resolution_level is more than 0 the frame is decoded with its width and height divided by 2 ** resolution_level , rounded up. See DecodeReducedFrame.
+    """
+    if resolution_level > 0:
+        pixels = DecodeReducedFrame(blob , resolution_level)
+    else:
+        from openjpeg import decode
+        pixels = decode(blob , reshape = False)
+    if out is None:
+        return pixels
+    import numpy as np
+    np.frombuffer(out , dtype = np.uint8)[:] = pixels
+    return out
+
+
+def DecodeReducedFrame( blob : bytes , resolution_level : int ):
+    """
+    Returns the raw pixels of the frame at a reduced resolution , as a flat uint8 numpy array.
+    The HTJ2K frames are decoded by OpenJPH skipping the resolution_level highest resolutions when imagecodecs is installed , which divides the decode CPU and memory by about 4 ** resolution_level.
+    The other frames , or all of them without imagecodecs , are decoded at full resolution by OpenJPEG and averaged down by blocks of 2 ** resolution_level pixels : only the memory used after the decode is reduced.
+    """
+    import numpy as np
+    skipped = 0
+    pixels = None
+    imagecodecs = GetImagecodecs()
+    if imagecodecs is not None and IsHTJ2K(blob):
+        # a codestream can not be reduced by more than its number of decomposition levels , the rest is averaged down.
+        skipped = min(resolution_level , GetDecompositionLevels(blob))
+        if skipped > 0:
+            pixels = imagecodecs.htj2k_decode(blob , skipres = skipped)
+    if pixels is None:
+        from openjpeg import decode
+        skipped = 0
+        pixels = decode(blob)
+    factor = 2 ** (resolution_level - skipped)
+    if factor > 1:
+        pixels = DownsampleFrame(pixels , factor)
+    return np.ascontiguousarray(pixels).reshape(-1).view(np.uint8)
+
+
+def DownsampleFrame( pixels : "np.ndarray" , factor : int ) -> "np.ndarray":
+    # mean of each factor x factor block , the last rows and columns being repeated up to a multiple of factor.
+    import numpy as np
+    rows , columns = pixels.shape[0] , pixels.shape[1]
+    padding = [ (0 , -rows % factor) , (0 , -columns % factor) ] + [ (0 , 0) ] * (pixels.ndim - 2)
+    padded = np.pad(pixels , padding , mode = "edge")
+    blocks = padded.reshape((padded.shape[0] // factor , factor , padded.shape[1] // factor , factor) + pixels.shape[2:])
+    return np.rint(blocks.mean(axis = (1 , 3) , dtype = np.float32)).astype(pixels.dtype)
+
+
+def GetMainHeaderMarkers( blob : bytes ) -> dict:
+    # offsets of the marker segments of the codestream main header , which ends at the first SOT marker , by marker code.
+    markers = {}
+    offset = 2 # after the SOC marker.
+    while offset + 4 <= len(blob):
+        marker = int.from_bytes(blob[offset : offset + 2] , "big")
+        if marker == 0xFF90 or marker < 0xFF00:
+            break
+        markers.setdefault(marker , offset)
+        offset += 2 + int.from_bytes(blob[offset + 2 : offset + 4] , "big")
+    return markers
+
+
+def IsHTJ2K( blob : bytes ) -> bool:
+    # HTJ2K codestreams have a CAP marker in their main header.
+    return 0xFF50 in GetMainHeaderMarkers(blob)
+
+
+def GetDecompositionLevels( blob : bytes ) -> int:
+    # number of decomposition levels of the COD marker segment , 0 if it can not be read.
+    cod = GetMainHeaderMarkers(blob).get(0xFF52)
+    if cod is None or len(blob) <= cod + 9:
+        return 0
+    return blob[cod + 9]
+
+
+def GetReducedSize( size : int , resolution_level : int ) -> int:
+    """
+    Returns the number of rows or columns of a frame decoded at resolution_level.
+    """
+    return -(-int(size) // 2 ** resolution_level)
+
+
+def GetResolutionLevel( rows : int , columns : int , target_size : int , max_level : int = 8 ) -> int:
+    """
+    Returns the highest resolution level at which the largest of rows and columns is still target_size or more , 0 if the frame is smaller than target_size.
+    """
+    level = 0
+    while level < max_level and max(GetReducedSize(rows , level + 1) , GetReducedSize(columns , level + 1)) >= target_size:
+        level += 1
+    return level
+
+
+def GetFrameLength( dicomTags : dict , resolution_level : int = 0 ):
+    """
+    Returns the size in bytes of one decoded frame, computed from the Rows, Columns, BitsAllocated and SamplesPerPixel of the instance metadata, or None if it can not be computed.
+    """
+    try:
+        bitsAllocated = int(dicomTags["BitsAllocated"])
+        if bitsAllocated % 8 != 0: # bit packed frames are not byte aligned.
+            return None
+        return GetReducedSize(dicomTags["Rows"] , resolution_level) * GetReducedSize(dicomTags["Columns"] , resolution_level) * int(dicomTags.get("SamplesPerPixel" , 1)) * bitsAllocated // 8
+    except (KeyError , TypeError , ValueError):
+        return None
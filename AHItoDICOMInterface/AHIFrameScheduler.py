@@ -0,0 +1,265 @@
+"""
+AHItoDICOM Module : This class contains the logic to schedule the frames of all the instances being exported through the network and decode stages.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+from multiprocessing import Queue , shared_memory
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread , Lock
+import logging
+import time
+from .AHIFrameFetcher import GetFrameBlob
+
+
+class AHIFrameScheduler:
+
+    ahi_client = None
+    DecodeJobs = None
+    DecodedFrames = None
+    DICOMizeJobs = None
+    logger = None
+
+    def __init__(self, ahi_client , DecodeJobs : Queue , DecodedFrames : Queue , DICOMizeJobs : Queue , network_concurrency : int = 64 , frame_cache = None , use_shared_memory : bool = True , controller = None , metrics = None , memory_budget = None):
+        """
+        Frame level scheduler. Each instance added is split in frame jobs : the frames are downloaded by a pool of network_concurrency threads, decoded by the AHIFrameDecoder processes reading the DecodeJobs queue,
+        and the instance is handed to the DICOMizeJobs queue once all its frames are decoded. Both stages are shared by all the instances in flight, whatever their number of frames.
+
+        :param ahi_client: The medical-imaging client used by the network threads. boto3 clients are thread safe.
+        :param DecodeJobs: The queue read by the decoder processes.
+        :param DecodedFrames: The queue the decoder processes put the decoded frames in.
+        :param DICOMizeJobs: The queue read by the DICOMizer processes.
+        :param network_concurrency: The number of frames downloaded concurrently.
+        :param frame_cache: Optional AHIFrameCache the frames are read from and added to.
+        :param use_shared_memory: Optional, if set to True (default) the PixelData of each instance is allocated in a shared memory segment : the decoders write the frames in it and only the segment handle goes through the queues.
+        :param controller: Optional AHIFetchController limiting the requests in flight under network_concurrency , and retrying the throttled ones.
+        :param metrics: Optional AHIMetrics the fetch and decode durations of the frames are recorded in.
+        :param memory_budget: Optional AHIMemoryBudget bounding the bytes of the compressed frames fetched and waiting to be decoded : the network threads wait for the decoders when it is exhausted.
+
+        The shared memory segments are owned by the scheduler : it creates them , and it is the only one to unlink them , in ReleaseInstance() once the DICOMized instance is back in the parent process, in _failInstance() , or in Dispose().
+        The decoder processes only attach to the segments while they write a frame , and the DICOMizer processes do not touch them.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.ahi_client = ahi_client
+        self.DecodeJobs = DecodeJobs
+        self.DecodedFrames = DecodedFrames
+        self.DICOMizeJobs = DICOMizeJobs
+        self.frame_cache = frame_cache
+        self.use_shared_memory = use_shared_memory
+        self.controller = controller
+        self.metrics = metrics
+        self.memory_budget = memory_budget
+        self.queuedBytes = {} # bytes reserved in memory_budget by the frames waiting to be decoded , by ( instanceKey , frame_number ).
+        self.segments = {} # shared memory segments not released yet , by name.
+        self.instances = {}
+        self.nextInstanceKey = 0
+        self.lock = Lock()
+        self.networkPool = ThreadPoolExecutor(max_workers = network_concurrency , thread_name_prefix = "AHIFrameScheduler")
+        self.collector = Thread(target = self.CollectDecodedFrames , daemon = True)
+        self.collector.start()
+
+    def AddInstance(self, entry : dict):
+        """
+        Schedules the download and decode of all the frames of the instance. The frames of the instances added first are fetched first.
+        """
+        with self.lock:
+            instanceKey = self.nextInstanceKey
+            self.nextInstanceKey += 1
+            state = { "entry" : entry , "frameLength" : entry.get("FrameLength") , "buffer" : None , "frames" : None , "remaining" : len(entry["frameIds"]) }
+            if entry.get("Target") is not None:
+                # the decoders write each frame at its offset in the target file , nothing is assembled here.
+                state["target"] = entry["Target"]
+            elif state["frameLength"] is not None and not entry.get("Passthrough" , False):
+                # the PixelData of the instance is allocated once, each decoded frame is copied at its offset.
+                size = state["frameLength"] * len(entry["frameIds"])
+                if self.use_shared_memory and size > 0:
+                    state["segment"] = shared_memory.SharedMemory(create = True , size = size)
+                    self.segments[state["segment"].name] = state["segment"]
+                    state["buffer"] = state["segment"].buf
+                else:
+                    state["buffer"] = bytearray(size)
+                import numpy as np
+                state["view"] = np.frombuffer(state["buffer"] , dtype = np.uint8 , count = size)
+            else:
+                state["frames"] = [None] * len(entry["frameIds"])
+            self.instances[instanceKey] = state
+        for frame_number , frameId in enumerate(entry["frameIds"]):
+            self.networkPool.submit(self.FetchFrame , instanceKey , frame_number , frameId)
+
+    def FetchFrame(self, instanceKey : int , frame_number : int , frameId : str):
+        state = self.instances.get(instanceKey)
+        if state is None: # another frame of this instance failed.
+            return
+        entry = state["entry"]
+        try:
+            if self.frame_cache is not None and self.frame_cache.cache_decoded and not entry.get("Passthrough" , False) and not entry.get("ResolutionLevel"):
+                pixels = self.frame_cache.getPixels(entry["datastoreId"] , entry["imagesetId"] , frameId)
+                if pixels is not None:
+                    self._storeFrame(instanceKey , frame_number , pixels)
+                    return
+            fetchStart = time.perf_counter()
+            blob = GetFrameBlob(entry["datastoreId"] , entry["imagesetId"] , frameId , self.ahi_client , self.frame_cache , self.controller)
+            if self.metrics is not None:
+                self.metrics.observe("FrameFetch" , time.perf_counter() - fetchStart)
+                self.metrics.count("FrameBytes" , len(blob))
+            if self.memory_budget is not None and not entry.get("Passthrough" , False):
+                # the thread waits while the frames already fetched are decoded , instead of piling up compressed frames in the DecodeJobs queue.
+                if not self.memory_budget.acquire(len(blob)):
+                    return # disposed meanwhile.
+                with self.lock:
+                    self.queuedBytes[(instanceKey , frame_number)] = len(blob)
+            if entry.get("Passthrough" , False):
+                # the compressed frame is kept as is, the decode stage is skipped.
+                self._storeFrame(instanceKey , frame_number , blob)
+            elif state.get("target") is not None:
+                self.DecodeJobs.put((instanceKey , frame_number , blob , ("file" , state["target"] , entry["FrameOffsets"][frame_number] , state["frameLength"]) , entry.get("ResolutionLevel" , 0) , time.time()))
+            elif state.get("segment") is not None:
+                # the decoder writes the pixels at the frame offset in the segment.
+                frameLength = state["frameLength"]
+                self.DecodeJobs.put((instanceKey , frame_number , blob , ("shm" , state["segment"].name , frame_number * frameLength , frameLength) , entry.get("ResolutionLevel" , 0) , time.time()))
+            else:
+                self.DecodeJobs.put((instanceKey , frame_number , blob , None , entry.get("ResolutionLevel" , 0) , time.time()))
+        except Exception as e:
+            self.logger.error(f"[{__name__}] - Frame {frameId} of instance {entry['SOPInstanceUID']} could not be fetched : {e}")
+            self._failInstance(instanceKey , str(e))
+
+    def CollectDecodedFrames(self):
+        while True:
+            result = self.DecodedFrames.get()
+            if result is None: # sentinel sent by Dispose()
+                break
+            instanceKey , frame_number , pixels , error , timings = result
+            if self.memory_budget is not None:
+                with self.lock:
+                    size = self.queuedBytes.pop((instanceKey , frame_number) , 0)
+                self.memory_budget.release(size)
+            if error is not None:
+                self._failInstance(instanceKey , error)
+                continue
+            if self.metrics is not None:
+                self.metrics.observe("DecodeQueueWait" , timings[0])
+                self.metrics.observe("Decode" , timings[1])
+                self.metrics.count("Frames")
+                state = self.instances.get(instanceKey)
+                self.metrics.count("DecodedBytes" , len(pixels) if pixels is not None else (state["frameLength"] or 0) if state is not None else 0)
+            if self.frame_cache is not None and self.frame_cache.cache_decoded:
+                self._cachePixels(instanceKey , frame_number , pixels)
+            self._storeFrame(instanceKey , frame_number , pixels)
+
+    def _cachePixels(self, instanceKey : int , frame_number : int , pixels):
+        state = self.instances.get(instanceKey)
+        if state is not None and not state["entry"].get("ResolutionLevel") and state.get("target") is None: # only the full resolution pixels assembled here are cached.
+            entry = state["entry"]
+            if pixels is None: # decoded in the shared memory segment.
+                frameLength = state["frameLength"]
+                pixels = state["view"][frame_number * frameLength : (frame_number + 1) * frameLength].tobytes()
+            self.frame_cache.putPixels(entry["datastoreId"] , entry["imagesetId"] , entry["frameIds"][frame_number] , pixels)
+
+    def _storeFrame(self, instanceKey : int , frame_number : int , pixels):
+        with self.lock:
+            state = self.instances.get(instanceKey)
+        if state is None:
+            return
+        try:
+            if pixels is None: # already written in the shared memory segment , or the target file , by the decoder.
+                pass
+            elif state.get("target") is not None: # read from the decoded frames cache.
+                if len(pixels) != state["frameLength"]:
+                    raise ValueError(f"Frame {frame_number} decoded to {len(pixels)} bytes , {state['frameLength']} bytes expected from the metadata.")
+                with open(state["target"] , "r+b") as f:
+                    f.seek(state["entry"]["FrameOffsets"][frame_number])
+                    f.write(pixels)
+            elif state["buffer"] is not None:
+                frameLength = state["frameLength"]
+                if len(pixels) != frameLength:
+                    raise ValueError(f"Frame {frame_number} decoded to {len(pixels)} bytes , {frameLength} bytes expected from the metadata.")
+                state["view"][frame_number * frameLength : (frame_number + 1) * frameLength] = memoryview(pixels).cast("B")
+            else:
+                state["frames"][frame_number] = pixels
+        except Exception as e:
+            self.logger.error(f"[{__name__}] - Instance {state['entry']['SOPInstanceUID']} could not be assembled : {e}")
+            self._failInstance(instanceKey , str(e))
+            return
+        with self.lock:
+            state["remaining"] -= 1
+            if state["remaining"] > 0 or self.instances.pop(instanceKey , None) is None:
+                return
+        entry = state["entry"]
+        if state.get("target") is not None:
+            entry["PixelData"] = None
+        elif state.get("segment") is not None:
+            # only the handle is sent , the pixels are moved in the dataset by ReleaseInstance() once the instance is DICOMized.
+            del state["view"]
+            entry["PixelData"] = None
+            entry["SharedPixelData"] = (state["segment"].name , state["segment"].size)
+        elif state["buffer"] is not None:
+            del state["view"]
+            entry["PixelData"] = state["buffer"]
+        elif entry.get("Passthrough" , False):
+            entry["PixelData"] = state["frames"] # one compressed frame per fragment, encapsulated by the DICOMizer.
+        else:
+            entry["PixelData"] = b"".join(state["frames"])
+        entry["Enqueued"] = time.time()
+        self.DICOMizeJobs.put(entry)
+
+    def _failInstance(self, instanceKey : int , error : str):
+        # the instance is reported once, through the DICOMizer processes which pass the jobs in error through.
+        with self.lock:
+            state = self.instances.pop(instanceKey , None)
+        if state is not None:
+            if state.get("segment") is not None:
+                # the decoders may still write frames in the segment : it is unlinked now , and unmapped once the last view on it is released.
+                state.pop("view" , None)
+                self._unlinkSegment(state["segment"].name)
+                try:
+                    state["segment"].close()
+                except BufferError:
+                    pass
+            entry = state["entry"]
+            entry["PixelData"] = None
+            entry["Error"] = error
+            self.DICOMizeJobs.put(entry)
+
+    def ReleaseInstance(self, entry : dict):
+        """
+        Called by the parent process for every job read from the DICOMizer processes : moves the pixels of the instance from its shared memory segment to the pydicom dataset, and releases the segment.
+        """
+        handle = entry.pop("SharedPixelData" , None)
+        if handle is None:
+            return
+        name , size = handle
+        with self.lock:
+            segment = self.segments.pop(name , None)
+        if segment is None:
+            return
+        try:
+            if entry.get("Dataset") is not None:
+                # the one copy left : pydicom only accepts bytes for PixelData ( a bytearray is read as a multi-valued element , a memoryview can not be pickled ) ,
+                # and a view would keep the segment mapped and its bytes reserved in the memory budget for the lifetime of the dataset.
+                entry["Dataset"].PixelData = bytes(segment.buf[:size])
+        finally:
+            segment.close()
+            segment.unlink()
+
+    def _unlinkSegment(self, name : str):
+        with self.lock:
+            segment = self.segments.pop(name , None)
+        if segment is not None:
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+
+    def Dispose(self):
+        if self.memory_budget is not None:
+            self.memory_budget.close()
+        self.networkPool.shutdown(wait = False , cancel_futures = True)
+        self.DecodedFrames.put(None)
+        self.collector.join(timeout = 5)
+        # segments of the instances still in flight , or DICOMized but never read back.
+        for name in list(self.segments.keys()):
+            segment = self.segments.get(name)
+            self._unlinkSegment(name)
+            try:
+                segment.close()
+            except BufferError: # still viewed by a frame being assembled.
+                pass
@@ -0,0 +1,301 @@
+"""
+AHItoDICOM Module : This class contains the logic to build the DICOM headers of the instances in-process , as pydicom datasets , DICOM JSON or DICOM Part10 files without PixelData.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import collections
+import copy
+import json
+import logging
+import re
+import struct
+import pydicom
+from pydicom.charset import convert_encodings
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_data_element
+from pydicom.multival import MultiValue
+from pydicom.uid import UID , ExplicitVRLittleEndian , PYDICOM_IMPLEMENTATION_UID
+from .AHIDataDICOMizer import GetDataElement , NewInstanceDataset , SelectFrames , getDictionaryVR
+from .AHIDICOMWriter import saveAs
+
+
+PART10_PREFIX = b"\0" * 128 + b"DICM"
+
+# VRs of the elements whose DICOM JSON and Part10 encoding are written directly from their values , when all of them are ASCII strings without padding : the other elements are written by pydicom.
+SIMPLE_VRS = { "AS" , "CS" , "DA" , "DS" , "DT" , "IS" , "LO" , "SH" , "TM" , "UI" }
+INTEGER_STRING = re.compile(r"[+-]?[0-9]+")
+DECIMAL_STRING = re.compile(r"[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?")
+
+# tags of the standard keywords , filled as the keywords are met.
+KeywordTags = {}
+
+
+class EncodedElement:
+    # one element of the headers , along with its DICOM JSON and its explicit VR little endian encoding once they are needed.
+    # the pydicom element of the simple elements is only created when a dataset is built.
+    __slots__ = ( "tag" , "element" , "source" , "simple" , "json" , "encoded" , "encodings" )
+
+    def __init__(self, tag : int , element = None , source = None , simple = None):
+        self.tag = tag # sorted as an int , much faster than as a pydicom tag.
+        self.element = element
+        self.source = source
+        self.simple = simple
+        self.json = None
+        self.encoded = None
+        self.encodings = None
+
+    def getElement(self):
+        if self.element is None:
+            self.element = GetDataElement(*self.source)
+        return self.element
+
+
+class HeaderFields:
+    # read only view of the elements of a header , by keyword , e.g. to name its file with LayoutFields without building its dataset.
+    def __init__(self, elements : dict):
+        self.elements = elements
+
+    def get(self, keyword : str , default = None):
+        tag = GetKeywordTag(keyword)
+        entry = self.elements.get(tag) if tag is not None else None
+        if entry is None:
+            return default
+        if entry.simple is not None and len(entry.simple[1]) == 1:
+            return entry.simple[1][0]
+        return entry.getElement().value
+
+
+class AHIHeaderEncoder:
+
+    logger = None
+    maxElements = 200000
+    maxSeries = 16
+
+    def __init__(self):
+        """
+        Builds the headers of the instances from their metadata , without any worker process. The Patient , Study and Series levels are converted once per series , and each element of the Instance level
+        once per distinct value : most of them , e.g. Rows or PixelSpacing , have the same value for all the instances of a series. The DICOM JSON and the Part10 encoding of each element are cached along with it ,
+        so building the header of an instance mostly consists of sorting the elements of its series and of its own.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.elements = {} # instance level elements , by ( keyword , VR of the private tag , value ).
+        self.series = collections.OrderedDict() # Patient , Study and Series level elements , by series.
+        self.fileMeta = {} # file meta elements but the MediaStorageSOPInstanceUID , by SOPClassUID.
+        self.statistics = { "Instances" : 0 , "ElementsEncoded" : 0 , "ElementsReused" : 0 }
+
+    def getElements(self, ImageFrame : dict) -> dict:
+        """
+        Returns the elements of the header of the instance , by tag , from the "Metadata" of its job.
+        """
+        InstanceMetadata = ImageFrame["Metadata"]
+        vrmap = InstanceMetadata["DICOMVRs"]
+        elements = dict(self.getSeriesElements(ImageFrame , InstanceMetadata , vrmap))
+        cache = self.elements
+        reused = 0
+        for keyword , value in InstanceMetadata["Instance"].items():
+            key = GetValueKey(value)
+            if key is not None:
+                key = ( keyword , vrmap.get(keyword) , key )
+                entry = cache.get(key)
+                if entry is not None:
+                    reused += 1
+                    elements[entry.tag] = entry
+                    continue
+            entry = self._encodeElement(keyword , value , vrmap)
+            if entry is None:
+                continue
+            elements[entry.tag] = entry
+            if key is not None:
+                if len(cache) >= self.maxElements:
+                    cache.clear()
+                cache[key] = entry
+        self.statistics["Instances"] += 1
+        self.statistics["ElementsReused"] += reused
+        return elements
+
+    def getSeriesElements(self, ImageFrame : dict , InstanceMetadata : dict , vrmap) -> dict:
+        # the levels are the same dicts for all the instances of a series , compared by identity so a new version of the metadata is converted again.
+        key = ( ImageFrame.get("imagesetId") , ImageFrame.get("SeriesUID") )
+        levels = ( InstanceMetadata["Patient"] , InstanceMetadata["Study"] , InstanceMetadata["Series"] )
+        cached = self.series.get(key)
+        if cached is not None and all(level is cachedLevel for level , cachedLevel in zip(levels , cached[0])):
+            self.series.move_to_end(key)
+            return cached[1]
+        elements = {}
+        for level in levels:
+            for keyword , value in level.items():
+                entry = self._encodeElement(keyword , value , vrmap)
+                if entry is not None:
+                    elements[entry.tag] = entry
+        self.series[key] = ( levels , elements )
+        if len(self.series) > self.maxSeries:
+            self.series.popitem(last=False)
+        return elements
+
+    def getDataset(self, ImageFrame : dict , elements : dict = None):
+        """
+        Returns the header of the instance as a pydicom dataset , the same as the one DICOMized by AHIDataDICOMizer with header_only. Its elements are copies of the cached ones , so it can be modified.
+        """
+        if elements is None:
+            elements = self.getElements(ImageFrame)
+        ds = NewInstanceDataset({ element.tag : element for element in ( CopyElement(entry.getElement()) for entry in elements.values() ) } , ImageFrame["SOPInstanceUID"])
+        if ImageFrame.get("FrameIndexes") is not None:
+            SelectFrames(ds , ImageFrame["FrameIndexes"])
+        return ds
+
+    def getJSON(self, ImageFrame : dict , elements : dict = None) -> str:
+        """
+        Returns the header of the instance as a DICOM JSON object ( PS3.18 F.2 ) , serialized. The binary values are inlined in base64.
+        """
+        if ImageFrame.get("FrameIndexes") is not None: # the frame count and per frame elements are changed.
+            return json.dumps(self.getDataset(ImageFrame , elements).to_json_dict(bulk_data_threshold = 2 ** 31))
+        if elements is None:
+            elements = self.getElements(ImageFrame)
+        fragments = []
+        for tag in sorted(elements):
+            entry = elements[tag]
+            if entry.json is None:
+                if entry.simple is not None:
+                    vr , values = entry.simple
+                    if vr == "IS":
+                        values = [ int(value) for value in values ]
+                    elif vr == "DS":
+                        values = [ float(value) for value in values ]
+                    entry.json = f'"{tag:08X}":{json.dumps({ "vr" : vr , "Value" : values })}'
+                else:
+                    entry.json = f'"{tag:08X}":{json.dumps(entry.element.to_json_dict(None , 2 ** 31))}'
+            fragments.append(entry.json)
+        return "{" + ",".join(fragments) + "}"
+
+    def getPart10(self, ImageFrame : dict , elements : dict = None) -> bytes:
+        """
+        Returns the header of the instance as a DICOM Part10 file in explicit VR little endian , byte for byte the one written by saveAs() for the dataset of getDataset().
+        """
+        if ImageFrame.get("FrameIndexes") is not None:
+            f = DicomBytesIO()
+            saveAs(self.getDataset(ImageFrame , elements) , f)
+            return f.getvalue()
+        if elements is None:
+            elements = self.getElements(ImageFrame)
+        charset = elements.get(0x00080005)
+        encodings = convert_encodings(charset.getElement().value) if charset is not None else None
+        encoded = [ PART10_PREFIX , self.getFileMeta(elements , ImageFrame["SOPInstanceUID"]) ]
+        f = None
+        for tag in sorted(elements):
+            entry = elements[tag]
+            if entry.encoded is None and entry.simple is not None: # ASCII , the same whatever the character set.
+                vr , values = entry.simple
+                value = "\\".join(values).encode("ascii")
+                if len(value) % 2 == 1:
+                    value += b"\0" if vr == "UI" else b" "
+                entry.encoded = struct.pack("<HH2sH" , tag >> 16 , tag & 0xFFFF , vr.encode("ascii") , len(value)) + value
+            elif entry.simple is None and ( entry.encoded is None or entry.encodings != encodings ):
+                if f is None:
+                    f = NewBuffer()
+                start = f.tell()
+                write_data_element(f , entry.element , encodings)
+                entry.encoded = f.getvalue()[start:]
+                entry.encodings = encodings
+            encoded.append(entry.encoded)
+        return b"".join(encoded)
+
+    def getFileMeta(self, elements : dict , SOPInstanceUID : str) -> bytes:
+        # the File Meta Information group , as completed by pydicom when it writes a file.
+        SOPClass = elements.get(0x00080016)
+        SOPClassUID = str(SOPClass.getElement().value) if SOPClass is not None else ""
+        cached = self.fileMeta.get(SOPClassUID)
+        if cached is None:
+            f = NewBuffer()
+            write_data_element(f , pydicom.DataElement(0x00020001 , "OB" , b"\x00\x01"))
+            write_data_element(f , pydicom.DataElement(0x00020002 , "UI" , UID(SOPClassUID)))
+            prefix = f.getvalue()
+            f = NewBuffer()
+            write_data_element(f , pydicom.DataElement(0x00020010 , "UI" , ExplicitVRLittleEndian))
+            write_data_element(f , pydicom.DataElement(0x00020012 , "UI" , UID(PYDICOM_IMPLEMENTATION_UID)))
+            write_data_element(f , pydicom.DataElement(0x00020013 , "SH" , f"PYDICOM {pydicom.__version__}"))
+            cached = self.fileMeta[SOPClassUID] = ( prefix , f.getvalue() )
+        value = SOPInstanceUID.encode("ascii")
+        if len(value) % 2 == 1:
+            value += b"\0"
+        group = b"".join([ cached[0] , struct.pack("<HH2sH" , 0x0002 , 0x0003 , b"UI" , len(value)) , value , cached[1] ])
+        return struct.pack("<HH2sHL" , 0x0002 , 0x0000 , b"UL" , 4 , len(group)) + group
+
+    def getStatistics(self) -> dict:
+        """
+        Returns the number of headers built , and the number of instance level elements converted and reused from the cache.
+        """
+        return dict(self.statistics , CachedElements = len(self.elements) , CachedSeries = len(self.series))
+
+    def _encodeElement(self, keyword : str , value , vrmap) -> EncodedElement:
+        # the same elements as AHIDataDICOMizer.getTags , None for the keywords which can not be converted.
+        simple = GetSimpleValues(keyword , value)
+        if simple is not None:
+            tag = GetKeywordTag(keyword)
+            if tag is not None:
+                self.statistics["ElementsEncoded"] += 1
+                return EncodedElement(tag , source = ( keyword , value , vrmap ) , simple = simple) if tag >> 16 != 2 else None
+        try:
+            element = GetDataElement(keyword , value , vrmap)
+        except Exception as err:
+            self.logger.warning(f"[{__name__}][getTags] - {err}")
+            return None
+        if element.tag.group == 2:
+            return None
+        self.statistics["ElementsEncoded"] += 1
+        return EncodedElement(int(element.tag) , element = element)
+
+
+def GetKeywordTag(keyword : str) -> int:
+    try:
+        return KeywordTags[keyword]
+    except KeyError:
+        tag = KeywordTags[keyword] = pydicom.datadict.tag_for_keyword(keyword)
+        return tag
+
+
+def GetSimpleValues(keyword : str , value):
+    # ( VR , values ) of the elements of the SIMPLE_VRS whose values are non empty ASCII strings , written the same by pydicom , None for the other elements.
+    vr = getDictionaryVR(keyword)
+    if vr not in SIMPLE_VRS:
+        return None
+    values = [ value ] if value.__class__ is str else value
+    if values.__class__ is not list or len(values) == 0:
+        return None
+    for item in values:
+        if item.__class__ is not str or not item or not item.isascii() or "\\" in item or item.strip() != item:
+            return None
+        if vr == "IS" and INTEGER_STRING.fullmatch(item) is None:
+            return None
+        if vr == "DS" and DECIMAL_STRING.fullmatch(item) is None:
+            return None
+    return ( vr , values )
+
+
+def CopyElement(element):
+    # a copy of the element , so the changes made to a dataset do not leak into the next headers. The values of a multi-valued element are copied too.
+    if element.VR == "SQ":
+        return copy.deepcopy(element)
+    if isinstance(element.value , MultiValue):
+        return pydicom.DataElement(element.tag , element.VR , list(element.value))
+    return copy.copy(element)
+
+
+def NewBuffer() -> DicomBytesIO:
+    f = DicomBytesIO()
+    f.is_little_endian = True
+    f.is_implicit_VR = False
+    return f
+
+
+def GetValueKey(value):
+    # a hashable key of the value of an instance level element , None for the values not worth caching , e.g. the sequences.
+    if value.__class__ is str:
+        return value
+    if value.__class__ is int or value.__class__ is float:
+        return ( value.__class__ , value )
+    if value.__class__ is list and len(value) <= 16:
+        classes = tuple(map(type , value))
+        if dict in classes or list in classes:
+            return None
+        return ( classes , tuple(value) )
+    return None
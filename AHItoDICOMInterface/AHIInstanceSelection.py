@@ -0,0 +1,66 @@
+"""
+AHItoDICOM Module : This class contains the logic to select a subset of the instances and frames of an ImageSet to be exported.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import logging
+
+
+class AHIInstanceSelection:
+
+    logger = None
+
+    def __init__(self, series_instance_uids : list = None , sop_instance_uids : list = None , instance_numbers : tuple = None , every_nth : int = 1 , middle_only : bool = False , frames = None):
+        """
+        Subset of the instances of an ImageSet to export. The filters are applied to each series in this order : series , SOPInstanceUIDs , InstanceNumber range , every Nth instance , middle instance.
+        The instances not selected are never fetched nor decoded.
+
+        :param series_instance_uids: Optional list of the SeriesInstanceUIDs to export. Will default to all the series.
+        :param sop_instance_uids: Optional list of the SOPInstanceUIDs to export.
+        :param instance_numbers: Optional ( first , last ) range of the InstanceNumbers to export , both included. Either bound can be None.
+        :param every_nth: Optional , only one instance every every_nth instances of each series is exported , starting with the first one. Will default to 1.
+        :param middle_only: Optional , only the middle instance of each series is exported if set to True.
+        :param frames: Optional frame indexes (0 based) of the multi-frame instances to export , as a list , a range or a slice. The NumberOfFrames and PerFrameFunctionalGroupsSequence of the instances are reduced to the frames selected.
+        """
+        self.logger = logging.getLogger(__name__)
+        if every_nth < 1:
+            raise ValueError(f"every_nth must be 1 or more , not {every_nth}")
+        self.series_instance_uids = None if series_instance_uids is None else set(series_instance_uids)
+        self.sop_instance_uids = None if sop_instance_uids is None else set(sop_instance_uids)
+        self.instance_numbers = instance_numbers
+        self.every_nth = every_nth
+        self.middle_only = middle_only
+        self.frames = frames
+
+    def isSeriesSelected(self, seriesUid : str) -> bool:
+        return self.series_instance_uids is None or seriesUid in self.series_instance_uids
+
+    def selectInstances(self, ImageFrames : list) -> list:
+        """
+        Returns the ImageFrames selected among the ImageFrames of one series , ordered by InstanceNumber.
+        """
+        selected = list(ImageFrames)
+        if self.sop_instance_uids is not None:
+            selected = [ ImageFrame for ImageFrame in selected if ImageFrame["SOPInstanceUID"] in self.sop_instance_uids ]
+        if self.instance_numbers is not None:
+            first , last = self.instance_numbers
+            selected = [ ImageFrame for ImageFrame in selected if (first is None or int(ImageFrame["InstanceNumber"]) >= first) and (last is None or int(ImageFrame["InstanceNumber"]) <= last) ]
+        if self.every_nth > 1:
+            selected = selected[::self.every_nth]
+        if self.middle_only and len(selected) > 0:
+            selected = [ selected[len(selected) // 2] ]
+        return selected
+
+    def selectFrames(self, frame_count : int) -> list:
+        """
+        Returns the indexes of the frames selected among the frame_count frames of an instance , or None if all the frames are selected.
+        """
+        if self.frames is None:
+            return None
+        if isinstance(self.frames , slice):
+            indexes = list(range(frame_count)[self.frames])
+        else:
+            indexes = sorted(set( index for index in self.frames if 0 <= index < frame_count ))
+        if len(indexes) == frame_count:
+            return None
+        return indexes
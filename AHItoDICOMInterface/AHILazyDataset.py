@@ -0,0 +1,97 @@
+"""
+AHItoDICOM Module : This class contains the logic of the datasets whose PixelData is only fetched when it is first accessed.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+from threading import Lock
+from pydicom import DataElement
+from pydicom.datadict import dictionary_VR
+from pydicom.dataset import FileDataset
+from pydicom.encaps import encapsulate
+from pydicom.tag import Tag
+from pydicom.uid import UID
+
+
+PIXEL_DATA_TAG = Tag("PixelData")
+
+
+class AHILazyDataset(FileDataset):
+
+    def __init__(self, ds : FileDataset , entry : dict , loader):
+        """
+        DICOMized instance without its PixelData : the frames are fetched and decoded by the AHIPixelDataLoader the first time ds.PixelData , ds["PixelData"] or ds.pixel_array is read , or when the dataset is saved.
+        Iterating over the elements does not load the PixelData , call loadPixelData() first to get it in the iteration.
+
+        :param ds: The dataset DICOMized with the headers only.
+        :param entry: The job of the instance , holding its datastoreId , imagesetId , frameIds , FrameLength and TransferSyntaxUID.
+        :param loader: The AHIPixelDataLoader shared by the lazy datasets of the helper.
+        """
+        super().__init__(None , ds , preamble = ds.preamble , file_meta = ds.file_meta)
+        entry = { key : entry[key] for key in ["datastoreId" , "imagesetId" , "frameIds" , "FrameLength" , "TransferSyntaxUID" , "Passthrough" , "ResolutionLevel" , "SOPInstanceUID"] if key in entry }
+        # reset to None once the PixelData is loaded , so the loaded dataset is copied and pickled as any other one.
+        object.__setattr__(self , "_lazyPixelData" , (entry , loader , Lock()))
+
+    def isPixelDataLoaded(self) -> bool:
+        return self.__dict__.get("_lazyPixelData") is None
+
+    def loadPixelData(self):
+        """
+        Fetches and decodes the PixelData of the instance , if it was not loaded yet.
+        """
+        lazy = self.__dict__.get("_lazyPixelData")
+        if lazy is None:
+            return
+        entry , loader , lock = lazy
+        with lock:
+            if self.isPixelDataLoaded(): # loaded by another thread meanwhile.
+                return
+            pixels = loader.load(entry)
+            # the element is added directly : ds.PixelData = ... would look the pending PixelData up again.
+            if entry.get("Passthrough" , False):
+                # the compressed frames are encapsulated as the DICOMizer does it.
+                self.file_meta.TransferSyntaxUID = UID(entry["TransferSyntaxUID"])
+                element = DataElement(PIXEL_DATA_TAG , "OB" , encapsulate(pixels , has_bot = True))
+                element.is_undefined_length = True
+            else:
+                element = DataElement(PIXEL_DATA_TAG , dictionary_VR(PIXEL_DATA_TAG) , pixels)
+            self.add(element)
+            object.__setattr__(self , "_lazyPixelData" , None)
+
+    def __getattr__(self, name : str):
+        if name == "PixelData" and not self.isPixelDataLoaded():
+            self.loadPixelData()
+        return super().__getattr__(name)
+
+    def __getitem__(self, key):
+        if not isinstance(key , slice) and not self.isPixelDataLoaded() and self._isPixelDataTag(key):
+            self.loadPixelData()
+        return super().__getitem__(key)
+
+    def __contains__(self, name) -> bool:
+        if not self.isPixelDataLoaded() and self._isPixelDataTag(name):
+            return True
+        return super().__contains__(name)
+
+    def __getstate__(self):
+        # the loader is not sent along with the dataset : the PixelData is loaded before it is pickled or copied.
+        self.loadPixelData()
+        return self.__dict__
+
+    def __deepcopy__(self, memo):
+        self.loadPixelData()
+        return super().__deepcopy__(memo)
+
+    @property
+    def pixel_array(self):
+        self.loadPixelData()
+        return super().pixel_array
+
+    def save_as(self, *args , **kwargs):
+        self.loadPixelData()
+        return super().save_as(*args , **kwargs)
+
+    def _isPixelDataTag(self, key) -> bool:
+        try:
+            return Tag(key) == PIXEL_DATA_TAG
+        except (ValueError , TypeError , OverflowError):
+            return False
@@ -0,0 +1,83 @@
+"""
+AHItoDICOM Module : This class contains the logic to bound the bytes held by the data in flight in the export pipeline.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+from threading import Condition
+import logging
+
+
+class AHIMemoryBudget:
+
+    limit = None
+    logger = None
+
+    def __init__(self, limit : int):
+        """
+        Counts the bytes reserved by the data in flight , up to limit bytes. A reservation larger than the whole budget is only granted when nothing else is reserved , so an instance larger than the budget
+        is exported alone instead of blocking the export.
+
+        :param limit: Number of bytes which can be reserved at the same time.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.limit = max(1 , int(limit))
+        self.condition = Condition()
+        self.used = 0
+        self.closed = False
+        self.statistics = { "Reservations" : 0 , "Waits" : 0 , "OverBudget" : 0 , "Peak" : 0 }
+
+    def tryAcquire(self, size : int) -> bool:
+        """
+        Reserves size bytes and returns True if they fit in the budget , or returns False without waiting.
+        """
+        with self.condition:
+            if self._acquire(size):
+                return True
+            self.statistics["Waits"] += 1
+            return False
+
+    def acquire(self, size : int) -> bool:
+        """
+        Reserves size bytes , waiting until they fit in the budget. Returns False without reserving them if the budget is closed meanwhile.
+        """
+        with self.condition:
+            if not self._acquire(size):
+                self.statistics["Waits"] += 1
+                while not self.closed and not self._acquire(size):
+                    self.condition.wait()
+            return not self.closed
+
+    def release(self, size : int):
+        with self.condition:
+            self.used = max(0 , self.used - size)
+            self.condition.notify_all()
+
+    def close(self):
+        """
+        Wakes up the threads waiting in acquire() , e.g. when the export is stopped. The following calls to acquire() return False.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _acquire(self, size : int) -> bool:
+        # called with the condition held.
+        if self.closed:
+            return True
+        if self.used > 0 and self.used + size > self.limit:
+            return False
+        if size > self.limit:
+            self.statistics["OverBudget"] += 1
+            if self.statistics["OverBudget"] == 1: # logged once , all the instances of a series usually have the same size.
+                self.logger.warning(f"[{__name__}] - {size} bytes are reserved over the budget of {self.limit} bytes , the data is processed alone.")
+        self.used += size
+        self.statistics["Reservations"] += 1
+        self.statistics["Peak"] = max(self.statistics["Peak"] , self.used)
+        return True
+
+    def getStatistics(self) -> dict:
+        """
+        Returns the number of bytes reserved and the limit , the peak number of bytes reserved , and the number of reservations , of waits for the budget and of reservations larger than the budget.
+        """
+        with self.condition:
+            return dict(self.statistics , Used = self.used , Limit = self.limit)
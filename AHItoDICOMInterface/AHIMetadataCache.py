@@ -0,0 +1,260 @@
+"""
+AHItoDICOM Module : This class contains the logic to cache and parse the ImageSet metadata fetched from AHI.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import collections
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from threading import Lock
+
+try:
+    import orjson
+except ImportError: # optional , json is used instead.
+    orjson = None
+
+
+def loadJSON(data):
+    """
+    Parses a JSON document with orjson when it is installed , or with the json module otherwise.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def loadMetadata(blob : bytes):
+    """
+    Decompresses and parses the gzip ImageSet metadata blob returned by get_image_set_metadata.
+    """
+    return loadJSON(gzip.decompress(blob))
+
+
+def loadMetadataSummary(blob : bytes):
+    """
+    Returns the series level summary of the gzip ImageSet metadata blob. See summarizeMetadata.
+    """
+    # the whole document is parsed and the instances are dropped : the C parsers can not skip a member , and a streaming parser in Python is slower than parsing everything in C.
+    return summarizeMetadata(loadMetadata(blob))
+
+
+def summarizeMetadata(AHI_metadata : dict) -> dict:
+    """
+    Returns a copy of the ImageSet metadata without the instances : each series holds its DICOM attributes and an InstanceCount instead.
+    """
+    summary = { key : value for key , value in AHI_metadata.items() if key != "Study" }
+    summary["Study"] = { key : value for key , value in AHI_metadata["Study"].items() if key != "Series" }
+    summary["Study"]["Series"] = {}
+    for seriesUid , series in AHI_metadata["Study"]["Series"].items():
+        summary["Study"]["Series"][seriesUid] = { key : value for key , value in series.items() if key != "Instances" }
+        summary["Study"]["Series"][seriesUid]["Instances"] = {}
+        summary["Study"]["Series"][seriesUid]["InstanceCount"] = len(series.get("Instances" , {}))
+    return summary
+
+
+class AHIMetadataCache:
+
+    max_memory_size = None
+    cache_dir = None
+    max_disk_size = None
+    max_summaries = 1024
+    logger = None
+
+    def __init__(self, max_memory_size : int = 512 * 1024 ** 2 , cache_dir : str = None , max_disk_size : int = 2 * 1024 ** 3):
+        """
+        ImageSet metadata cache, keyed by (datastoreId , imageSetId , version) so an updated ImageSet is never served from a stale entry.
+        The parsed metadata is kept in memory , and the gzip blobs are optionally kept in cache_dir. The least recently used entries are evicted when either cache grows over its maximum size.
+
+        :param max_memory_size: Optional maximum size in bytes of the uncompressed metadata kept in memory. Will default to 512 MiB.
+        :param cache_dir: Optional folder where the gzip metadata blobs are stored. Nothing is stored on disk by default.
+        :param max_disk_size: Optional maximum size of cache_dir in bytes. Will default to 2 GiB.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.max_memory_size = max_memory_size
+        self.cache_dir = cache_dir
+        self.max_disk_size = max_disk_size
+        self.lock = Lock()
+        self.entries = collections.OrderedDict() # key -> ( metadata , size ) , least recently used first.
+        self.summaries = collections.OrderedDict() # key -> summary.
+        self.memory_size = 0
+        self.statistics = { "Hits" : 0 , "DiskHits" : 0 , "Misses" : 0 , "Evictions" : 0 }
+        if cache_dir is not None:
+            os.makedirs(cache_dir , exist_ok=True)
+
+    def getMetadata(self, datastoreId : str , imageSetId : str , version : str):
+        """
+        Returns the parsed metadata of the ImageSet version, or None if it is not in the cache.
+        The returned structure is shared by all the callers and must not be modified.
+        """
+        key = self._key(datastoreId , imageSetId , version)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.statistics["Hits"] += 1
+                return self.entries[key][0]
+        blob = self._read(key)
+        if blob is not None:
+            try:
+                data = gzip.decompress(blob)
+                metadata = loadJSON(data)
+                self._count("DiskHits")
+                self._store(key , metadata , len(data))
+                return metadata
+            except Exception as err:
+                self.logger.warning(f"[{__name__}] - Cached metadata could not be parsed : {err}")
+        self._count("Misses")
+        return None
+
+    def getSummary(self, datastoreId : str , imageSetId : str , version : str):
+        """
+        Returns the series level summary of the ImageSet version, or None if neither the summary nor the metadata are in the cache.
+        """
+        key = self._key(datastoreId , imageSetId , version)
+        with self.lock:
+            if key in self.summaries:
+                self.summaries.move_to_end(key)
+                self.statistics["Hits"] += 1
+                return self.summaries[key]
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                metadata = self.entries[key][0]
+            else:
+                metadata = None
+        if metadata is not None:
+            summary = summarizeMetadata(metadata)
+        else:
+            blob = self._read(key)
+            if blob is None:
+                self._count("Misses")
+                return None
+            summary = loadMetadataSummary(blob)
+        self.putSummary(datastoreId , imageSetId , version , summary)
+        self._count("Hits" if metadata is not None else "DiskHits")
+        return summary
+
+    def putMetadata(self, datastoreId : str , imageSetId : str , version : str , metadata : dict , blob : bytes = None , size : int = 0):
+        """
+        Adds the parsed metadata of the ImageSet version to the cache.
+
+        :param blob: Optional gzip metadata blob, stored in cache_dir when there is one.
+        :param size: Optional size in bytes of the uncompressed metadata , used to bound the memory cache.
+        """
+        key = self._key(datastoreId , imageSetId , version)
+        if blob is not None:
+            self._write(key , blob)
+        self._store(key , metadata , size)
+
+    def putBlob(self, datastoreId : str , imageSetId : str , version : str , blob : bytes):
+        """
+        Stores the gzip metadata blob of the ImageSet version in cache_dir , without keeping its parsed metadata in memory.
+        """
+        self._write(self._key(datastoreId , imageSetId , version) , blob)
+
+    def putSummary(self, datastoreId : str , imageSetId : str , version : str , summary : dict):
+        # the summaries are small and derived from the metadata , they are only kept in memory.
+        key = self._key(datastoreId , imageSetId , version)
+        with self.lock:
+            self.summaries[key] = summary
+            self.summaries.move_to_end(key)
+            while len(self.summaries) > self.max_summaries:
+                self.summaries.popitem(last=False)
+
+    def getStatistics(self) -> dict:
+        """
+        Returns the hits , disk hits , misses and evictions counted by this cache object, and the size of the metadata kept in memory in bytes.
+        """
+        with self.lock:
+            statistics = dict(self.statistics)
+            statistics["Entries"] = len(self.entries)
+            statistics["MemorySize"] = self.memory_size
+        return statistics
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.summaries.clear()
+            self.memory_size = 0
+        for path , size , mtime in self._scan():
+            self._remove(path)
+
+    def _key(self, datastoreId : str , imageSetId : str , version : str) -> str:
+        return f"{datastoreId}/{imageSetId}/{version}"
+
+    def _store(self, key : str , metadata : dict , size : int):
+        with self.lock:
+            if key in self.entries:
+                self.memory_size -= self.entries[key][1]
+            self.entries[key] = (metadata , size)
+            self.entries.move_to_end(key)
+            self.memory_size += size
+            # the entry just added is kept even if it is larger than the cache on its own.
+            while self.memory_size > self.max_memory_size and len(self.entries) > 1:
+                evicted_key , (evicted_metadata , evicted_size) = self.entries.popitem(last=False)
+                self.memory_size -= evicted_size
+                self.statistics["Evictions"] += 1
+
+    def _path(self, key : str) -> str:
+        return os.path.join(self.cache_dir , hashlib.sha256(key.encode()).hexdigest() + ".json.gz")
+
+    def _read(self, key : str):
+        if self.cache_dir is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path , "rb") as f:
+                blob = f.read()
+            os.utime(path) # the modification time is the last access time used by the LRU eviction.
+            return blob
+        except OSError:
+            return None
+
+    def _write(self, key : str , blob : bytes):
+        if self.cache_dir is None:
+            return
+        try:
+            fd , temp_path = tempfile.mkstemp(dir=self.cache_dir , prefix=".tmp")
+            with os.fdopen(fd , "wb") as f:
+                f.write(blob)
+            os.replace(temp_path , self._path(key))
+        except OSError as err:
+            self.logger.warning(f"[{__name__}] - Metadata could not be cached : {err}")
+            return
+        files = self._scan()
+        size = sum(file[1] for file in files)
+        if size > self.max_disk_size:
+            files.sort(key=lambda file: file[2])
+            for path , file_size , mtime in files:
+                if size <= self.max_disk_size * 0.9:
+                    break
+                if self._remove(path):
+                    size -= file_size
+
+    def _scan(self):
+        files = []
+        if self.cache_dir is None:
+            return files
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".json.gz"):
+                continue
+            path = os.path.join(self.cache_dir , filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((path , stat.st_size , stat.st_mtime))
+        return files
+
+    def _remove(self, path : str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def _count(self, statistic : str):
+        with self.lock:
+            self.statistics[statistic] += 1
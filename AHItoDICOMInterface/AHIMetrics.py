@@ -0,0 +1,139 @@
+"""
+AHItoDICOM Module : This class contains the per stage histograms , counters and tracing hooks of the export pipeline.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+from contextlib import nullcontext
+from threading import Lock
+import bisect
+import logging
+import time
+
+
+# upper bounds in seconds of the histogram buckets , from 0.1 ms to 105 s doubling each time , the last bucket counting the longer durations.
+BUCKETS = [ 0.0001 * 2 ** x for x in range(21) ]
+
+# the stages timed by the pipeline.
+STAGES = [
+    "MetadataFetch" , "MetadataGunzip" , "MetadataParse" , # parent process , per ImageSet.
+    "FrameFetch" , # network threads , per frame : the request , its retries and the download , or the read from the frame cache.
+    "DecodeQueueWait" , "Decode" , # decoder processes , per frame.
+    "DICOMizeQueueWait" , "DICOMize" , "ResultQueueWait" , # DICOMizer processes and back to the parent , per instance.
+    "Instance" , # parent process , per instance : from its admission in the pipeline until it is returned.
+    "Serialize" , "Write" , # writer threads , per file : the Part10 encoding to the temporary file , then its flush and rename.
+]
+
+
+class AHIHistogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value : float):
+        self.counts[bisect.bisect_left(BUCKETS , value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min , value)
+        self.max = value if self.max is None else max(self.max , value)
+
+    def getPercentile(self, percentile : float) -> float:
+        # upper bound of the bucket holding the percentile , capped by the maximum observed.
+        rank = percentile / 100 * self.count
+        seen = 0
+        for index , count in enumerate(self.counts):
+            seen += count
+            if count > 0 and seen >= rank:
+                return min(BUCKETS[index] , self.max) if index < len(BUCKETS) else self.max
+        return self.max
+
+    def getSnapshot(self) -> dict:
+        if self.count == 0:
+            return { "Count" : 0 , "Sum" : 0.0 }
+        return { "Count" : self.count , "Sum" : self.sum , "Mean" : self.sum / self.count , "Min" : self.min , "Max" : self.max , "P50" : self.getPercentile(50) , "P90" : self.getPercentile(90) , "P99" : self.getPercentile(99) ,
+                 "Buckets" : { f"{bound:g}" : count for bound , count in zip(BUCKETS + [float("inf")] , self.counts) if count > 0 } }
+
+
+class AHIMetrics:
+
+    callback = None
+    tracer = None
+    logger = None
+
+    def __init__(self, callback = None , interval : float = 10.0 , tracer = None):
+        """
+        Collects the duration of each stage of the pipeline in histograms , and the counters of the bytes read and written. The helper adds the queue depths , the worker busy times and the fetch retries to each snapshot , see AHItoDICOM.getMetrics().
+
+        :param callback: Optional function called with each snapshot , every interval seconds while an export is running and once at its end , e.g. to push them to CloudWatch or Prometheus.
+        :param interval: Optional number of seconds between two calls of callback. Will default to 10.
+        :param tracer: Optional OpenTelemetry Tracer , or any object with the same start_span(name , attributes = ...) and start_as_current_span(name , attributes = ...) methods. A span is recorded for each ImageSet exported and each metadata download.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.callback = callback
+        self.interval = interval
+        self.tracer = tracer
+        self.lock = Lock()
+        self.lastPush = time.monotonic()
+        self.reset()
+
+    def reset(self):
+        """
+        Clears the histograms and the counters.
+        """
+        with self.lock:
+            self.histograms = { stage : AHIHistogram() for stage in STAGES }
+            self.counters = { "MetadataBytes" : 0 , "FrameBytes" : 0 , "DecodedBytes" : 0 , "BytesWritten" : 0 , "Frames" : 0 , "Instances" : 0 , "InstanceErrors" : 0 , "Files" : 0 }
+            self.startTime = time.time()
+
+    def observe(self, stage : str , seconds : float):
+        with self.lock:
+            self.histograms[stage].observe(seconds)
+
+    def count(self, counter : str , value : int = 1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter , 0) + value
+
+    def span(self, name : str , attributes : dict = None):
+        """
+        Returns a context manager recording a span of the tracer around the code it wraps , or doing nothing if there is no tracer.
+        """
+        if self.tracer is None:
+            return nullcontext()
+        return self.tracer.start_as_current_span(name , attributes = attributes)
+
+    def startSpan(self, name : str , attributes : dict = None):
+        # for the spans which do not follow the call stack , e.g. an ImageSet exported while the caller iterates its instances.
+        if self.tracer is None:
+            return None
+        return self.tracer.start_span(name , attributes = attributes)
+
+    def endSpan(self, span , attributes : dict = None):
+        if span is None:
+            return
+        for key , value in (attributes or {}).items():
+            span.set_attribute(key , value)
+        span.end()
+
+    def getSnapshot(self) -> dict:
+        with self.lock:
+            elapsed = time.time() - self.startTime
+            return { "Time" : time.time() , "Elapsed" : elapsed , "Stages" : { stage : histogram.getSnapshot() for stage , histogram in self.histograms.items() } , "Counters" : dict(self.counters) }
+
+    def push(self, snapshot_function , force : bool = False):
+        """
+        Calls the callback with snapshot_function() if interval seconds elapsed since the last call , or if force is set.
+        """
+        if self.callback is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if not force and now - self.lastPush < self.interval:
+                return
+            self.lastPush = now
+        try:
+            self.callback(snapshot_function())
+        except Exception as err:
+            self.logger.error(f"[{__name__}] - The metrics callback failed : {err}")
@@ -0,0 +1,62 @@
+"""
+AHItoDICOM Module : This class contains the logic to fetch the PixelData of the lazy datasets when it is first accessed.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+from .AHIFrameFetcher import GetFrameBlob , DecodeFrame
+
+
+class AHIPixelDataLoader:
+
+    ahi_client = None
+    frame_cache = None
+    logger = None
+
+    def __init__(self, ahi_client , frame_cache = None , network_concurrency : int = 16 , controller = None):
+        """
+        Fetches and decodes the frames of one instance at a time , in the calling process. The pool of network_concurrency threads is shared by all the lazy datasets of the helper,
+        so datasets loaded from several threads share the same concurrency limit.
+
+        :param ahi_client: The medical-imaging client used by the threads. boto3 clients are thread safe.
+        :param frame_cache: Optional AHIFrameCache the frames are read from and added to.
+        :param network_concurrency: Optional number of frames downloaded and decoded concurrently. Will default to 16.
+        :param controller: Optional AHIFetchController the requests go through , shared with the frame scheduler of the helper.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.ahi_client = ahi_client
+        self.frame_cache = frame_cache
+        self.controller = controller
+        self.pool = ThreadPoolExecutor(max_workers = network_concurrency , thread_name_prefix = "AHIPixelDataLoader")
+
+    def load(self, entry : dict):
+        """
+        Returns the PixelData of the instance described by the job entry : the decoded pixels as bytes , or the list of the compressed frames if the entry is a passthrough one.
+        """
+        frameIds = entry["frameIds"]
+        if entry.get("Passthrough" , False):
+            return list(self.pool.map(lambda frameId : GetFrameBlob(entry["datastoreId"] , entry["imagesetId"] , frameId , self.ahi_client , self.frame_cache , self.controller) , frameIds))
+        frameLength = entry.get("FrameLength")
+        frames = list(self.pool.map(lambda frameId : self._getPixels(entry , frameId) , frameIds))
+        if frameLength is not None:
+            for frame_number , pixels in enumerate(frames):
+                if len(pixels) != frameLength:
+                    raise ValueError(f"Frame {frame_number} decoded to {len(pixels)} bytes , {frameLength} bytes expected from the metadata.")
+        # the decoded frames are joined in a single copy : pydicom only accepts bytes for PixelData , and no bytes object can be filled in place.
+        return b"".join(frames)
+
+    def _getPixels(self, entry : dict , frameId : str):
+        # only the full resolution pixels are cached.
+        cache_decoded = self.frame_cache is not None and self.frame_cache.cache_decoded and not entry.get("ResolutionLevel")
+        if cache_decoded:
+            pixels = self.frame_cache.getPixels(entry["datastoreId"] , entry["imagesetId"] , frameId)
+            if pixels is not None:
+                return pixels
+        pixels = DecodeFrame(GetFrameBlob(entry["datastoreId"] , entry["imagesetId"] , frameId , self.ahi_client , self.frame_cache , self.controller) , resolution_level = entry.get("ResolutionLevel" , 0))
+        if cache_decoded:
+            self.frame_cache.putPixels(entry["datastoreId"] , entry["imagesetId"] , frameId , pixels)
+        return pixels
+
+    def close(self):
+        self.pool.shutdown(wait = False , cancel_futures = True)
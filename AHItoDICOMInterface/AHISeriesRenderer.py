@@ -0,0 +1,165 @@
+"""
+AHItoDICOM Module : This class contains the logic to render whole series as PNG , JPEG or WebP images.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+import numpy as np
+from pydicom import Dataset
+
+
+IMAGE_FORMATS = { "png" : "PNG" , "jpeg" : "JPEG" , "jpg" : "JPEG" , "webp" : "WEBP" }
+
+
+class AHISeriesRenderer:
+
+    process_count = None
+    image_format = None
+    logger = None
+
+    def __init__(self, process_count : int = None , image_format : str = "png" , quality : int = 90 , compress_level : int = 1):
+        """
+        Renders the instances of a series as 8 bits images. The Modality LUT (RescaleSlope and RescaleIntercept) and the VOI window are applied to the whole series at once,
+        through one lookup table per rescale for the integer pixels , so all the slices share the same brightness. The images are encoded by a pool of process_count processes.
+
+        :param process_count: Optional number of encoder processes. Will default to the CPU count.
+        :param image_format: Optional format of the images , "png" , "jpeg" or "webp". Will default to "png".
+        :param quality: Optional quality of the JPEG and WebP images. Will default to 90.
+        :param compress_level: Optional zlib compression level of the PNG images , from 0 to 9. Will default to 1 , the higher levels being 2 to 3 times slower for a few percents smaller files.
+        """
+        self.logger = logging.getLogger(__name__)
+        if image_format.lower() not in IMAGE_FORMATS:
+            raise ValueError(f"image_format must be one of {list(IMAGE_FORMATS.keys())} , not '{image_format}'")
+        self.process_count = process_count if process_count is not None else int(os.cpu_count())
+        self.image_format = image_format.lower()
+        self.quality = quality
+        self.compress_level = compress_level
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def renderSeries(self, datasets : list , destination : str , window : tuple = None) -> list:
+        """
+        renderSeries(datasets : list , destination : str).
+        Saves one image per frame of the datasets as destination/SOPInstanceUID.ext , or destination/SOPInstanceUID_frame.ext for the multi-frame instances.
+
+        :param datasets: The pydicom datasets of one series , with the same Rows and Columns.
+        :param destination: The folder the images are saved to.
+        :param window: Optional ( center , width ) VOI window. Will default to the WindowCenter and WindowWidth of the first dataset , or to the range of the rescaled values of the whole series.
+        :return: The paths of the images saved , None for the frames which could not be saved.
+        """
+        if len(datasets) == 0:
+            return []
+        os.makedirs(destination , exist_ok = True)
+        extension = "jpg" if self.image_format == "jpeg" else self.image_format
+        volume , slopes , intercepts , names = self.getVolume(datasets)
+        images = self.applyLUTs(volume , slopes , intercepts , window if window is not None else self.getWindow(datasets[0]) , datasets[0].get("PhotometricInterpretation" , "") == "MONOCHROME1")
+        paths = [ os.path.join(destination , f"{name}.{extension}") for name in names ]
+        return self.encodeImages(images , paths)
+
+    def getVolume(self, datasets : list):
+        # all the frames of the series in one array , with the rescale of each frame.
+        frames = []
+        slopes = []
+        intercepts = []
+        names = []
+        for ds in datasets:
+            pixels = ds.pixel_array
+            frameCount = int(ds.get("NumberOfFrames" , 1) or 1)
+            if frameCount == 1:
+                pixels = pixels[np.newaxis]
+            frames.append(pixels)
+            slopes += [ float(ds.get("RescaleSlope" , 1) or 1) ] * frameCount
+            intercepts += [ float(ds.get("RescaleIntercept" , 0) or 0) ] * frameCount
+            names += [ str(ds.SOPInstanceUID) ] if frameCount == 1 else [ f"{ds.SOPInstanceUID}_{frame + 1}" for frame in range(frameCount) ]
+        return np.concatenate(frames) , np.array(slopes , dtype = np.float32) , np.array(intercepts , dtype = np.float32) , names
+
+    def getWindow(self, ds : Dataset):
+        try:
+            center = ds.WindowCenter
+            width = ds.WindowWidth
+        except AttributeError:
+            return None
+        # several windows can be listed , the first one is used.
+        if not isinstance(center , (int , float)):
+            center = center[0]
+        if not isinstance(width , (int , float)):
+            width = width[0]
+        return float(center) , float(width)
+
+    def applyLUTs(self, volume : np.ndarray , slopes : np.ndarray , intercepts : np.ndarray , window : tuple = None , invert : bool = False) -> np.ndarray:
+        """
+        Returns the uint8 images of the volume , after the Modality LUT of each frame and the VOI window common to all the frames.
+        """
+        if volume.ndim == 4: # color frames are only converted to 8 bits.
+            return volume if volume.dtype == np.uint8 else (volume >> (8 * volume.dtype.itemsize - 8)).astype(np.uint8)
+        rescales = sorted(set(zip(slopes.tolist() , intercepts.tolist())))
+        if window is None:
+            # the range of the rescaled values of the whole series , so all the frames are displayed the same way.
+            low , high = volume.min() , volume.max()
+            values = np.array([ value * slope + intercept for slope , intercept in rescales for value in (low , high) ] , dtype = np.float32)
+            window = ( (float(values.min()) + float(values.max())) / 2 + 0.5 , max(float(values.max()) - float(values.min()) , 1.0) + 1 )
+        center , width = window
+        if volume.dtype.kind in "iu" and volume.dtype.itemsize <= 2:
+            # one table per rescale , indexed by the stored values : one lookup per pixel , without float conversion of the volume.
+            # the signed values are looked up through their unsigned view , in a table rolled accordingly.
+            offset = int(np.iinfo(volume.dtype).min)
+            stored = np.arange(offset , int(np.iinfo(volume.dtype).max) + 1 , dtype = np.float32)
+            indexes = volume.view(np.dtype(f"u{volume.dtype.itemsize}"))
+            images = np.empty(volume.shape , dtype = np.uint8)
+            for slope , intercept in rescales:
+                table = np.roll(self.window(stored * slope + intercept , center , width , invert) , -offset)
+                if len(rescales) == 1:
+                    np.take(table , indexes , out = images)
+                else:
+                    frames = np.flatnonzero((slopes == slope) & (intercepts == intercept))
+                    images[frames] = np.take(table , indexes[frames])
+            return images
+        rescaled = volume.astype(np.float32) * slopes[: , np.newaxis , np.newaxis] + intercepts[: , np.newaxis , np.newaxis]
+        return self.window(rescaled , center , width , invert)
+
+    def window(self, values : np.ndarray , center : float , width : float , invert : bool = False) -> np.ndarray:
+        # linear VOI LUT function , DICOM PS3.3 C.11.2.1.2.1 , in float32.
+        scaled = (values - np.float32(center - 0.5)) / np.float32(max(width - 1 , 1)) + np.float32(0.5)
+        images = (np.clip(scaled , 0 , 1) * np.float32(255) + np.float32(0.5)).astype(np.uint8)
+        return 255 - images if invert else images
+
+    def encodeImages(self, images : np.ndarray , paths : list) -> list:
+        # the frames are sent to the encoder processes by chunks , 4 per process.
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers = self.process_count)
+        chunkSize = max(1 , -(-len(paths) // (4 * self.process_count)))
+        futures = [ self.pool.submit(encodeImages , images[start : start + chunkSize] , paths[start : start + chunkSize] , IMAGE_FORMATS[self.image_format] , self.quality , self.compress_level) for start in range(0 , len(paths) , chunkSize) ]
+        saved = []
+        for future in futures:
+            saved += future.result()
+        return saved
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait = True)
+            self.pool = None
+
+
+def encodeImages(images : np.ndarray , paths : list , image_format : str , quality : int = 90 , compress_level : int = 1) -> list:
+    # runs in the encoder processes , the only ones importing PIL.
+    from PIL import Image
+    saved = []
+    for image , path in zip(images , paths):
+        try:
+            if image_format == "PNG":
+                Image.fromarray(image).save(path , image_format , compress_level = compress_level)
+            else:
+                Image.fromarray(image).save(path , image_format , quality = quality)
+            saved.append(path)
+        except Exception as err:
+            logging.getLogger(__name__).error(f"[{__name__}] - {path} could not be saved : {err}")
+            saved.append(None)
+    return saved
@@ -0,0 +1,171 @@
+"""
+AHItoDICOM Module : This class contains the geometry of a series and the layout of its frames in a single 3D array.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import logging
+import numpy as np
+from .AHIFrameFetcher import GetFrameLength , GetReducedSize
+
+
+class AHIVolume:
+
+    Volume = None
+    Spacing = None
+    Origin = None
+    Orientation = None
+    SliceDirection = None
+    RescaleSlopes = None
+    RescaleIntercepts = None
+    SOPInstanceUIDs = None
+    FrameNumbers = None
+    SeriesInstanceUID = None
+    logger = None
+
+    def __init__(self, ImageFrames : list , resolution_level : int = 0):
+        """
+        Geometry of the frames of one series , read from the AHI metadata of its instances. The frames are sorted along the normal of their ImageOrientationPatient by their ImagePositionPatient,
+        or by InstanceNumber and frame number when a position is missing. Volume is set by AHItoDICOM.getVolume() once all the frames are decoded at their place.
+
+        :param ImageFrames: The job entries of the instances of the series , as returned by AHItoDICOM.getImageFrames().
+        :param resolution_level: Optional , the frames are decoded with their width and height divided by 2 ** resolution_level. Will default to 0 , the full resolution.
+        raises ValueError if there is no frame , or if the instances do not share the same pixel format.
+        """
+        self.logger = logging.getLogger(__name__)
+        if len(ImageFrames) == 0:
+            raise ValueError("The series has no frame to arrange in a volume.")
+        self.SeriesInstanceUID = ImageFrames[0]["SeriesUID"]
+        self.resolution_level = resolution_level
+        frames = []
+        pixelFormat = None
+        for ImageFrame in ImageFrames:
+            tags = dict(ImageFrame["Metadata"]["Series"] , **ImageFrame["Metadata"]["Instance"])
+            instanceFormat = tuple( int(tags.get(name , default)) for name , default in [ ("Rows" , 0) , ("Columns" , 0) , ("BitsAllocated" , 0) , ("PixelRepresentation" , 0) , ("SamplesPerPixel" , 1) ] )
+            if pixelFormat is None:
+                pixelFormat = instanceFormat
+            elif instanceFormat != pixelFormat:
+                raise ValueError(f"Instance {ImageFrame['SOPInstanceUID']} is {instanceFormat[0]}x{instanceFormat[1]} , {instanceFormat[2]} bits and {instanceFormat[4]} samples , the first instance of the series is {pixelFormat[0]}x{pixelFormat[1]} , {pixelFormat[2]} bits and {pixelFormat[4]} samples.")
+            frameIndexes = ImageFrame.get("FrameIndexes" , range(len(ImageFrame["frameIds"])))
+            for frame_number , frameIndex in enumerate(frameIndexes):
+                frames.append(dict(self.getFrameGeometry(tags , frameIndex) , ImageFrame = ImageFrame , FrameNumber = frame_number , InstanceNumber = int(ImageFrame["InstanceNumber"])))
+        rows , columns , bitsAllocated , pixelRepresentation , samplesPerPixel = pixelFormat
+        if bitsAllocated not in (8 , 16 , 32):
+            raise ValueError(f"{bitsAllocated} bits allocated pixels can not be arranged in a volume.")
+        self.dtype = np.dtype(f"<{'i' if pixelRepresentation == 1 else 'u'}{bitsAllocated // 8}")
+        self.FrameLength = GetFrameLength({ "Rows" : rows , "Columns" : columns , "BitsAllocated" : bitsAllocated , "SamplesPerPixel" : samplesPerPixel } , resolution_level)
+        reducedRows , reducedColumns = GetReducedSize(rows , resolution_level) , GetReducedSize(columns , resolution_level)
+        self.shape = ( len(frames) , reducedRows , reducedColumns ) + (( samplesPerPixel , ) if samplesPerPixel > 1 else ())
+        frames = self.sortFrames(frames)
+        self.SOPInstanceUIDs = [ frame["ImageFrame"]["SOPInstanceUID"] for frame in frames ]
+        self.FrameNumbers = [ frame["FrameNumber"] for frame in frames ]
+        self.RescaleSlopes = np.array([ frame["RescaleSlope"] for frame in frames ] , dtype = np.float32)
+        self.RescaleIntercepts = np.array([ frame["RescaleIntercept"] for frame in frames ] , dtype = np.float32)
+        self.Origin = frames[0]["Position"]
+        self.Orientation = frames[0]["Orientation"]
+        pixelSpacing = frames[0]["PixelSpacing"]
+        if pixelSpacing is None:
+            self.logger.warning(f"[{__name__}] - Series {self.SeriesInstanceUID} has no PixelSpacing , 1 mm is used.")
+            pixelSpacing = np.ones(2)
+        # the frames decoded at a reduced resolution cover the same area with fewer pixels.
+        pixelSpacing = pixelSpacing * np.array([ rows / reducedRows , columns / reducedColumns ])
+        self.Spacing = ( self.getSliceSpacing(frames) , float(pixelSpacing[0]) , float(pixelSpacing[1]) )
+        # the offsets of the frames of each instance in the volume , in the order of its frameIds.
+        self.FrameOffsets = {}
+        for position , frame in enumerate(frames):
+            offsets = self.FrameOffsets.setdefault(frame["ImageFrame"]["SOPInstanceUID"] , [None] * len(frame["ImageFrame"]["frameIds"]))
+            offsets[frame["FrameNumber"]] = position * self.FrameLength
+
+    def getFrameGeometry(self, tags : dict , frameIndex : int) -> dict:
+        # the attributes of the frame are read from its functional groups first for the multi-frame instances , then from the shared functional groups and the instance itself.
+        perFrame = tags.get("PerFrameFunctionalGroupsSequence") or []
+        groups = [ perFrame[frameIndex] if frameIndex < len(perFrame) else {} , (tags.get("SharedFunctionalGroupsSequence") or [{}])[0] ]
+        def lookup(sequence , name):
+            for group in groups:
+                items = group.get(sequence) or []
+                if len(items) > 0 and items[0].get(name) is not None:
+                    return items[0][name]
+            return tags.get(name)
+        sliceSpacing = lookup("PixelMeasuresSequence" , "SpacingBetweenSlices")
+        if sliceSpacing is None:
+            sliceSpacing = lookup("PixelMeasuresSequence" , "SliceThickness")
+        return {
+            "Position" : toFloats(lookup("PlanePositionSequence" , "ImagePositionPatient") , 3),
+            "Orientation" : toFloats(lookup("PlaneOrientationSequence" , "ImageOrientationPatient") , 6),
+            "PixelSpacing" : toFloats(lookup("PixelMeasuresSequence" , "PixelSpacing") , 2),
+            "SliceSpacing" : toFloats(sliceSpacing , 1),
+            "RescaleSlope" : float(toFloats(lookup("PixelValueTransformationSequence" , "RescaleSlope") , 1 , [1.0])[0]),
+            "RescaleIntercept" : float(toFloats(lookup("PixelValueTransformationSequence" , "RescaleIntercept") , 1 , [0.0])[0]),
+        }
+
+    def sortFrames(self, frames : list) -> list:
+        if any( frame["Position"] is None or frame["Orientation"] is None for frame in frames ):
+            self.logger.warning(f"[{__name__}] - Some frames of series {self.SeriesInstanceUID} have no ImagePositionPatient or ImageOrientationPatient , the frames are sorted by InstanceNumber.")
+            return sorted(frames , key = lambda frame : ( frame["InstanceNumber"] , frame["FrameNumber"] ))
+        orientation = frames[0]["Orientation"]
+        normal = np.cross(orientation[:3] , orientation[3:])
+        for frame in frames:
+            frame["Distance"] = float(np.dot(frame["Position"] , normal))
+        frames = sorted(frames , key = lambda frame : ( frame["Distance"] , frame["InstanceNumber"] , frame["FrameNumber"] ))
+        if len(set( frame["Distance"] for frame in frames )) < len(frames):
+            self.logger.warning(f"[{__name__}] - Several frames of series {self.SeriesInstanceUID} share the same position , e.g. several phases or echoes.")
+        return frames
+
+    def getSliceSpacing(self, frames : list) -> float:
+        # the distance between the positions of the frames when they are known , else the spacing or thickness of the first frame , in this order.
+        # the frames sharing the same position , e.g. several phases , are counted once.
+        distances = np.unique([ frame["Distance"] for frame in frames ]) if "Distance" in frames[0] else []
+        if len(distances) > 1:
+            steps = np.diff(distances)
+            spacing = float(np.median(steps))
+            if np.max(np.abs(steps - spacing)) > 0.01 * spacing:
+                self.logger.warning(f"[{__name__}] - The frames of series {self.SeriesInstanceUID} are not evenly spaced , from {np.min(steps):.3f} to {np.max(steps):.3f} mm : the median {spacing:.3f} mm is used.")
+            if len(distances) == len(frames):
+                # the actual step between the positions , which is not along the normal for gantry tilted acquisitions.
+                self.SliceDirection = (frames[-1]["Position"] - frames[0]["Position"]) / (len(frames) - 1)
+            return spacing
+        if frames[0]["SliceSpacing"] is not None:
+            return float(frames[0]["SliceSpacing"][0])
+        return 1.0
+
+    def getAffine(self) -> np.ndarray:
+        """
+        Returns the 4x4 matrix mapping the ( slice , row , column ) indexes of Volume to the patient coordinates in mm , or None if the orientation or the origin of the series is unknown.
+        """
+        if self.Orientation is None or self.Origin is None:
+            return None
+        sliceSpacing , rowSpacing , columnSpacing = self.Spacing
+        sliceDirection = self.SliceDirection if self.SliceDirection is not None else np.cross(self.Orientation[:3] , self.Orientation[3:]) * sliceSpacing
+        affine = np.eye(4)
+        # the row direction cosines of ImageOrientationPatient are the direction along a row , i.e. of increasing column index.
+        affine[:3 , 0] = sliceDirection
+        affine[:3 , 1] = self.Orientation[3:] * rowSpacing
+        affine[:3 , 2] = self.Orientation[:3] * columnSpacing
+        affine[:3 , 3] = self.Origin
+        return affine
+
+    def getRescaledVolume(self, dtype = np.float32) -> np.ndarray:
+        """
+        Returns a copy of Volume with the Modality LUT of each frame applied , e.g. in Hounsfield units for a CT series.
+        """
+        shape = ( -1 , ) + ( 1 , ) * (len(self.shape) - 1)
+        rescaled = self.Volume.astype(dtype)
+        rescaled *= self.RescaleSlopes.reshape(shape).astype(dtype)
+        rescaled += self.RescaleIntercepts.reshape(shape).astype(dtype)
+        return rescaled
+
+
+def toFloats(value , count : int , default = None):
+    # DS values are stored as numbers , strings or backslash separated strings in the AHI metadata.
+    if value is None:
+        return None if default is None else np.array(default , dtype = np.float64)
+    if isinstance(value , str):
+        value = value.split("\\")
+    elif not isinstance(value , (list , tuple)):
+        value = [value]
+    try:
+        values = np.array([ float(v) for v in value ] , dtype = np.float64)
+    except (TypeError , ValueError):
+        return None if default is None else np.array(default , dtype = np.float64)
+    if len(values) < count:
+        return None if default is None else np.array(default , dtype = np.float64)
+    return values[:count]
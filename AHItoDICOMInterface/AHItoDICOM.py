@@ -6,201 +6,865 @@ SPDX-License-Identifier: Apache-2.0
 
 from .AHIDataDICOMizer import *
 from .AHIFrameFetcher import *
+from .AHIFrameDecoder import *
+from .AHIFrameScheduler import *
+from .AHIFrameCache import *
+from .AHIMetadataCache import *
+from .AHIDICOMWriter import *
+from .AHIInstanceSelection import *
+from .AHIFetchController import *
+from .AHIMetrics import *
+from .AHIMemoryBudget import *
+from .AHIHeaderEncoder import *
 from .AHIClientFactory import * 
 import json
 import logging
 import collections
-from threading import Thread
-from time import sleep
-from PIL import Image
+from queue import Empty
 import gzip
 import tempfile
+import time
 import os
 import shutil
 import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import resource_tracker
 
 
 
 
+# Transfer syntax of the frames stored by AHI , used for the HTJ2K passthrough when the instance metadata does not carry a StoredTransferSyntaxUID.
+HTJ2K_LOSSLESS_RPCL = "1.2.840.10008.1.2.4.202"
+
+# bytes held in the parent process by the metadata and the dataset of an instance in flight , besides its pixels.
+INSTANCE_HEADER_BYTES = 32 * 1024
+
+# outputs of the header only exports built in-process , see iterImageSetHeaders.
+HEADER_OUTPUTS = [ "json" , "part10" , "dataset" ]
+
+# path of the DICOM JSON file of each series relative to the destination , see exportImageSetToDICOMJSON.
+DEFAULT_JSON_LAYOUT = "{StudyInstanceUID}/{SeriesInstanceUID}.json"
+
+# modules imported once by the fork server , so the worker processes forked from it start with them already imported.
+WORKER_PRELOAD_MODULES = [ f"{__package__}.AHIFrameDecoder" , f"{__package__}.AHIDataDICOMizer" , "openjpeg" , "imagecodecs" ]
+
+
 class AHItoDICOM:
 
     AHIclient = None
-    frameFetcherThreadList = []
+    frameDecoderThreadList = []
     frameDICOMizerThreadList = []
+    frameScheduler = None
     fetcherProcessCount = None
     DICOMizerProcessCount = None
-    ImageFrames = None
-    frameToDICOMize = None
-    FrameDICOMizerPoolManager = None
-    DICOMizedFrames = None
-    CountToDICOMize = 0
-    still_processing = False
+    networkConcurrency = None
+    frameCache = None
+    metadataCache = None
+    pixelDataLoader = None
+    headerEncoder = None
+    fetchController = None
+    metrics = None
+    memoryBudget = None
+    memoryBudgetSize = None
+    sharedMemoryTransport = True
+    context = None
+    DecodeJobs = None
+    DecodedFrames = None
+    DICOMizeJobs = None
+    CompletedJobs = None
+    exportId = 0
     aws_access_key = None
     aws_secret_key = None
     AHI_endpoint = None
     logger = None
+    processes_started = False
 
-    def __init__(self, aws_access_key : str =  None, aws_secret_key : str = None , AHI_endpoint : str = None , fetcher_process_count : int = None , dicomizer_process_count : int = None ) -> None:
+    def __init__(self, aws_access_key : str =  None, aws_secret_key : str = None , AHI_endpoint : str = None , fetcher_process_count : int = None , dicomizer_process_count : int = None , ahi_client = None , network_concurrency : int = None , frame_cache : AHIFrameCache = None , metadata_cache : AHIMetadataCache = None , shared_memory_transport : bool = True , fetch_controller : AHIFetchController = None , metrics : AHIMetrics = None , start_method : str = None , memory_budget : int = None ) -> None:
         """
         Helper class constructor.
 
         :param aws_access_key: Optional IAM user access key.
         :param aws_secret_key: Optional IAM user secret key.
         :param AHI_endpoint: Optional AHI endpoint URL. Only useful to AWS employees.
-        :param fetcher_process_count: Optional number of processes to use for fetching frames. Will default to CPU count x 8
+        :param fetcher_process_count: Optional number of processes to use for decoding the frames fetched. Will default to CPU count.
         :param dicomizer_process_count: Optional number of processes to use for DICOMizing frames.Will default to CPU count.
+        :param ahi_client: Optional medical-imaging client to use instead of the one created by AHIClientFactory, e.g. a local stand-in for benchmarks.
+        :param network_concurrency: Optional number of frames downloaded concurrently, across all the instances in flight. Will default to 64.
+        :param frame_cache: Optional AHIFrameCache. The frames found in the cache are not downloaded again.
+        :param metadata_cache: Optional AHIMetadataCache. The ImageSet metadata found in the cache is not downloaded and parsed again.
+        :param shared_memory_transport: Optional, if set to True (default) the decoded pixels are written in shared memory instead of being pickled through the queues between the processes.
+        :param fetch_controller: Optional AHIFetchController adapting the number of frame requests in flight to the throttling of the service , and retrying the throttled requests. Will default to one limited to network_concurrency.
+        :param metrics: Optional AHIMetrics the durations of the stages of the pipeline are recorded in , e.g. with a callback or a tracer. Will default to one without callback nor tracer , see getMetrics().
+        :param start_method: Optional start method of the worker processes , "fork" , "spawn" or "forkserver". Will default to the default of the platform. With "forkserver" the worker modules are imported once by the fork server and each worker is forked from it :
+        the workers start as fast as with "fork" , without inheriting the threads and the memory of the calling process.
+        :param memory_budget: Optional number of bytes the data in flight may hold. Three quarters bound the instances admitted in the pipeline , estimated from their frame dimensions , and one quarter the compressed frames waiting to be decoded :
+        the instances are admitted , and the frames fetched , only when the previous ones are returned or decoded. An instance larger than the budget is exported alone. Will default to no budget , max_instances_in_flight only bounding the instances in flight.
         """ 
         self.logger = logging.getLogger(__name__)
-        self.ImageFrames = collections.deque()
-        self.frameToDICOMize = collections.deque()
-        self.DICOMizedFrames = collections.deque()
+        self.frameDecoderThreadList = []
+        self.frameDICOMizerThreadList = []
+        self.createdFolders = set()
         self.aws_access_key = aws_access_key
         self.aws_secret_key =  aws_secret_key
         self.AHI_endpoint = AHI_endpoint
+        self.AHIclient = ahi_client
+        self.frameCache = frame_cache
+        self.metadataCache = metadata_cache
+        self.sharedMemoryTransport = shared_memory_transport
         if fetcher_process_count is None:
-            self.fetcherProcessCount = int(os.cpu_count()) * 8 
+            self.fetcherProcessCount = int(os.cpu_count())
         else:
             self.fetcherProcessCount = fetcher_process_count
         if dicomizer_process_count is None:
             self.DICOMizerProcessCount = int(os.cpu_count())
         else:
             self.DICOMizerProcessCount = dicomizer_process_count
+        if network_concurrency is None:
+            self.networkConcurrency = 64
+        else:
+            self.networkConcurrency = network_concurrency
         
-        self.logger.debug(f"[{__name__}] - Fetcher process count : {self.fetcherProcessCount} , DICOMizer process count : {self.DICOMizerProcessCount}")
-        #mp.set_start_method('fork')
+        self.fetchController = fetch_controller if fetch_controller is not None else AHIFetchController(max_concurrency = self.networkConcurrency)
+        self.metrics = metrics if metrics is not None else AHIMetrics()
+        self.memoryBudgetSize = memory_budget
+        if memory_budget is not None:
+            self.memoryBudget = AHIMemoryBudget(memory_budget - memory_budget // 4)
+        self.context = mp.get_context(start_method)
+        if start_method == "forkserver":
+            # only effective until the fork server is started , by the first worker process.
+            self.context.set_forkserver_preload(WORKER_PRELOAD_MODULES)
+        self.logger.debug(f"[{__name__}] - Fetcher process count : {self.fetcherProcessCount} , DICOMizer process count : {self.DICOMizerProcessCount} , network concurrency : {self.networkConcurrency}")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def start(self):
+        """
+        start().
+        Starts the frame fetcher and DICOMizer processes once, so they can be reused by all the subsequent DICOMize calls until close() is called.
+        Called automatically when the helper is used as a context manager : with AHItoDICOM() as helper: ...
+        """ 
+        if not self.processes_started:
+            self._initFetchAndDICOMizeProcesses()
+        return self
+
+    def close(self):
+        """
+        close().
+        Stops the frame fetcher and DICOMizer processes started by start().
+        """ 
+        if not self.processes_started:
+            return
+        for utilization in self.getWorkerUtilization():
+            self.logger.debug(f"[{__name__}] - {utilization['Worker']} : {utilization['JobsDone']} jobs , {utilization['BusyTime']:.3f}s busy , {utilization['Utilization']:.1%} utilization")
+        self.frameScheduler.Dispose()
+        # the jobs queues are shared, so all the sentinels are sent before any process is waited for.
+        for worker in self.frameDecoderThreadList + self.frameDICOMizerThreadList:
+            worker.Stop()
+        for x in range(len(self.frameDecoderThreadList)):
+            self.logger.debug(f"[{__name__}] - Disposing frame decoder process # {x}")
+            self.frameDecoderThreadList[x].Dispose()
+        for x in range(len(self.frameDICOMizerThreadList)):
+            self.logger.debug(f"[{__name__}] - Disposing DICOMizer process # {x}")
+            self.frameDICOMizerThreadList[x].Dispose()
+        self.frameDecoderThreadList.clear()
+        self.frameDICOMizerThreadList.clear()
+        self.processes_started = False
         
-    def DICOMizeByStudyInstanceUID(self, datastore_id : str = None , study_instance_uid : str = None , header_only : bool = False):
+    def DICOMizeByStudyInstanceUID(self, datastore_id : str = None , study_instance_uid : str = None , header_only : bool = False , htj2k_passthrough : bool = False , max_image_sets_in_flight : int = 4 , selection : AHIInstanceSelection = None , lazy : bool = False , resolution_level : int = 0 , preview_size : int = None):
         """
         DICOMizeByStudyInstanceUID(datastore_id : str = None , study_instance_uid : str = None).
 
         :param datastore_id: The datastoreId containtaining the DICOM Study.
         :param study_instance_uid: The StudyInstanceUID (0020,000d) of the Study to be DICOMized from AHI.
-        :return: A list of pydicom DICOM objects.
+        :param max_image_sets_in_flight: Optional maximum number of ImageSets being exported at the same time. Will default to 4.
+        :param selection: Optional AHIInstanceSelection of the series , instances and frames to export , applied to each ImageSet. Will default to all of them.
+        :param lazy: Optional , if set to True the PixelData of each dataset is only fetched when it is first accessed. See DICOMizeImageSet.
+        :param resolution_level: Optional , the frames are decoded with their width and height divided by 2 ** resolution_level. See DICOMizeImageSet.
+        :param preview_size: Optional , the frames are decoded at the lowest resolution level whose width or height is still preview_size or more. See DICOMizeImageSet.
+        :return: A list of pydicom DICOM objects, grouped by series and ordered by InstanceNumber.
         """ 
-        search_criteria = {
-            'filters': [
-                {
-                    'values': [
-                        {
-                            'DICOMStudyInstanceUID': study_instance_uid
-                        }
-                    ],
-                    'operator': 'EQUAL'
-                }
-            ]
-        }
-        client = AHIClientFactory(self.aws_access_key ,  self.aws_secret_key , self.AHI_endpoint )
-        search_result = client.search_image_sets(datastoreId=datastore_id, searchCriteria = search_criteria) ### in theory we should check if a continuation token is returned and loop until we have all the results...
-        instances = []
-        for imageset in search_result["imageSetsMetadataSummaries"]:
-            current_imageset = imageset["imageSetId"]
-            self.logger.debug(f"[{__name__}] - Exporting {current_imageset} instances in memory.")
-            instances += self.DICOMizeImageSet(datastore_id=datastore_id , image_set_id=current_imageset , header_only=header_only)
+        client = self._getClient()
+        sources = [ { "imagesetId" : imageset["imageSetId"] , "version" : imageset.get("version") , "Selection" : selection } for imageset in self.searchImageSets(datastore_id , study_instance_uid , client) ]
+        DICOMized = list(self._iterDICOMize(datastore_id , sources , header_only , order = "completion" , htj2k_passthrough = htj2k_passthrough , max_image_sets_in_flight = max_image_sets_in_flight , lazy = lazy , resolution_level = resolution_level , preview_size = preview_size))
+        DICOMized.sort(key = self.getSeriesRankAndInstanceNumber)
+        return [ ds for job , ds in DICOMized ]
 
-        return instances
+    def iterDICOMizeStudy(self, datastore_id : str = None , study_instance_uid : str = None , header_only : bool = False , order : str = "instance_number" , max_instances_in_flight : int = None , max_image_sets_in_flight : int = 4 , htj2k_passthrough : bool = False , selection : AHIInstanceSelection = None , lazy : bool = False , resolution_level : int = 0 , preview_size : int = None):
+        """
+        iterDICOMizeStudy(datastore_id : str = None , study_instance_uid : str = None).
+        Generator version of DICOMizeByStudyInstanceUID. All the ImageSets of the study are found by following the search pages , and all their series are exported.
+        Up to max_image_sets_in_flight ImageSets are exported at the same time : their metadata is fetched in parallel and their instances share the same fetch and decode pipeline, taking turns.
 
-    def DICOMizeImageSet(self, datastore_id : str = None , imageset_id : str = None, image_set_id : str = None , header_only = False):
+        :param datastore_id: The datastoreId containing the DICOM Study.
+        :param study_instance_uid: The StudyInstanceUID (0020,000d) of the Study to be DICOMized from AHI.
+        :param header_only: Optional, only the DICOM headers are DICOMized if set to True.
+        :param order: Optional, "instance_number" (default) to yield the instances of each series ordered by InstanceNumber, or "completion" to yield them as soon as they are ready.
+        :param max_instances_in_flight: Optional maximum number of instances being processed or waiting to be reordered, across all the ImageSets.
+        :param max_image_sets_in_flight: Optional maximum number of ImageSets being exported at the same time. Will default to 4.
+        :param htj2k_passthrough: Optional, if set to True the HTJ2K frames are not decoded : they are stored as encapsulated PixelData with the HTJ2K transfer syntax.
+        :param selection: Optional AHIInstanceSelection of the series , instances and frames to export , applied to each ImageSet. Will default to all of them.
+        :param lazy: Optional , if set to True the PixelData of each dataset is only fetched when it is first accessed. See DICOMizeImageSet.
+        :param resolution_level: Optional , the frames are decoded with their width and height divided by 2 ** resolution_level. See DICOMizeImageSet.
+        :param preview_size: Optional , the frames are decoded at the lowest resolution level whose width or height is still preview_size or more. See DICOMizeImageSet.
+        :return: A generator of pydicom DICOM objects.
+        """ 
+        if order not in ["instance_number" , "completion"]:
+            raise ValueError(f"order must be 'instance_number' or 'completion' , not '{order}'")
+        client = self._getClient()
+        sources = [ { "imagesetId" : imageset["imageSetId"] , "version" : imageset.get("version") , "Selection" : selection } for imageset in self.searchImageSets(datastore_id , study_instance_uid , client) ]
+        for job , ds in self._iterDICOMize(datastore_id , sources , header_only , order , max_instances_in_flight , htj2k_passthrough , max_image_sets_in_flight , lazy , resolution_level , preview_size):
+            yield ds
+
+    def iterDICOMizeSources(self, datastore_id : str , sources : list , header_only : bool = False , order : str = "completion" , max_instances_in_flight : int = None , max_image_sets_in_flight : int = 4 , htj2k_passthrough : bool = False , output : str = "dataset" , lazy : bool = False , resolution_level : int = 0 , preview_size : int = None):
+        """
+        iterDICOMizeSources(datastore_id : str , sources : list).
+        Same as iterDICOMizeStudy , for any list of ImageSets , e.g. the ImageSets of several studies or the ones left to export by a resumed bulk export. Yields ( job , header ) tuples ,
+        the job being the dict describing the instance , with its "imagesetId" , "SeriesUID" and "SOPInstanceUID".
+
+        :param datastore_id: The datastoreId containing the ImageSets.
+        :param sources: One dict per ImageSet : its "imagesetId" , and optionally its "version" , its "Metadata" if it was already fetched , the AHIInstanceSelection to export in "Selection" and a set of SOPInstanceUIDs to skip in "Exclude".
+        Once the metadata of the ImageSet is fetched , its number of instances is set in "InstanceCount".
+        :param header_only: Optional, only the DICOM headers are DICOMized if set to True.
+        :param order: Optional, "completion" (default) to yield the instances as soon as they are ready , or "instance_number" to yield the instances of each series ordered by InstanceNumber.
+        :param max_instances_in_flight: Optional maximum number of instances being processed or waiting to be reordered, across all the ImageSets.
+        :param max_image_sets_in_flight: Optional maximum number of ImageSets being exported at the same time. Will default to 4.
+        :param htj2k_passthrough: Optional, if set to True the HTJ2K frames are not decoded. See DICOMizeImageSet.
+        :param output: Optional , only with header_only : "dataset" (default) for a pydicom dataset , "json" or "part10" for a ( HeaderFields , header ) tuple , the header being encoded as by iterImageSetHeaders and the HeaderFields
+        giving the values of its attributes by keyword , e.g. to name its file.
+        :param lazy: Optional , if set to True the PixelData of each dataset is only fetched when it is first accessed. See DICOMizeImageSet.
+        :param resolution_level: Optional , the frames are decoded with their width and height divided by 2 ** resolution_level. See DICOMizeImageSet.
+        :param preview_size: Optional , the frames are decoded at the lowest resolution level whose width or height is still preview_size or more. See DICOMizeImageSet.
+        :return: A generator of ( job , header ) tuples.
+        """
+        if order not in ["instance_number" , "completion"]:
+            raise ValueError(f"order must be 'instance_number' or 'completion' , not '{order}'")
+        if output not in HEADER_OUTPUTS:
+            raise ValueError(f"output must be one of {HEADER_OUTPUTS} , not '{output}'")
+        if output != "dataset" and not header_only:
+            raise ValueError(f"output '{output}' is only available with header_only")
+        if header_only and output != "dataset":
+            yield from self._iterHeaders(datastore_id , sources , output , max_image_sets_in_flight , fields = True)
+        else:
+            yield from self._iterDICOMize(datastore_id , sources , header_only , order , max_instances_in_flight , htj2k_passthrough , max_image_sets_in_flight , lazy , resolution_level , preview_size)
+
+    def DICOMizeImageSet(self, datastore_id : str = None , imageset_id : str = None, image_set_id : str = None , header_only = False , htj2k_passthrough : bool = False , version_id : str = None , selection : AHIInstanceSelection = None , lazy : bool = False , resolution_level : int = 0 , preview_size : int = None):
         """
         DICOMizeImageSet(datastore_id : str = None , imageset_id : str = None).
 
         :param datastore_id: The datastoreId containing the DICOM Study.
         :param imageset_id: The ImageSetID of the data to be DICOMized from AHI.
-        :return: A list of pydicom DICOM objects.
+        :param htj2k_passthrough: Optional, if set to True the HTJ2K frames are not decoded : they are stored as encapsulated PixelData with the HTJ2K transfer syntax.
+        :param version_id: Optional version of the ImageSet. Will default to the latest version.
+        :param selection: Optional AHIInstanceSelection of the series , instances and frames to export , e.g. AHIInstanceSelection(middle_only = True). Will default to all of them.
+        :param lazy: Optional , if set to True only the headers are DICOMized and the PixelData of each dataset is fetched and decoded the first time it is accessed, through a pool of threads shared by all the lazy datasets of the helper. The pixels of the datasets never accessed are never downloaded.
+        :param resolution_level: Optional , the frames are decoded with their width and height divided by 2 ** resolution_level , for previews. Rows , Columns and PixelSpacing are set accordingly. Will default to 0 , the full resolution. Ignored with htj2k_passthrough.
+        :param preview_size: Optional , the frames are decoded at the lowest resolution level whose width or height is still preview_size or more. Overrides resolution_level.
+        :return: A list of pydicom DICOM objects, grouped by series and ordered by InstanceNumber.
         """ 
 
         #this is to prevent breaking changes in imageset_id paramater name.
         if image_set_id is not None and imageset_id is None:
             imageset_id = image_set_id
 
-        self.ImageFrames = collections.deque()
-        self.frameToDICOMize = collections.deque()
-        self.DICOMizedFrames = collections.deque()
-        client = AHIClientFactory(self.aws_access_key ,  self.aws_secret_key , self.AHI_endpoint )
-        self.still_processing = True
-        self.FrameDICOMizerPoolManager = Thread(target = self.AssignDICOMizeJob)
-        AHI_metadata = self.getMetadata(datastore_id, imageset_id, client) 
+        client = self._getClient()
+        AHI_metadata = self.getMetadata(datastore_id, imageset_id, client , version_id) 
         if AHI_metadata is None:
             self.logger.error(f"[{__name__}] - No metadata found for datastore_id : {datastore_id} , imageset_id : {imageset_id}")
             return None
-        #threads init for Frame fetching and DICOM encapsulation
-        self._initFetchAndDICOMizeProcesses(AHI_metadata=AHI_metadata )
-        series = self.getSeriesList(AHI_metadata , imageset_id)[0]
-        self.ImageFrames.extendleft(self.getImageFrames(datastore_id, imageset_id , AHI_metadata , series["SeriesInstanceUID"])) 
-        instanceCount = len(self.ImageFrames) 
-        self.logger.debug(f"[{__name__}] - Importing {instanceCount} instances in memory.")
-        self.CountToDICOMize = instanceCount
-        self.FrameDICOMizerPoolManager.start()
-        
-        #Assigning jobs to the Frame fetching thread pool.
-        if ( header_only == False):
-            threadId = 0
-            while(len(self.ImageFrames)> 0):
-                self.frameFetcherThreadList[threadId].AddFetchJob(self.ImageFrames.popleft())
-                threadId+=1
-                if threadId == self.fetcherProcessCount :
-                    threadId = 0  
-            instanceFetchedCount = 0
-            while(instanceFetchedCount < (instanceCount)):
-                    self.logger.debug(f"Done {instanceFetchedCount}/{instanceCount}")
-                    for x in range(self.fetcherProcessCount):
-                        entry=self.frameFetcherThreadList[x].getFramesFetched()
-                        if entry is not None:
-                            instanceFetchedCount+=1
-                            self.frameToDICOMize.append(entry)  
-                    sleep(0.01)
-            self.logger.debug("All frames Fetched and submitted to the DICOMizer queue") 
+        DICOMized = list(self._iterDICOMize(datastore_id , [ { "imagesetId" : imageset_id , "Metadata" : AHI_metadata , "Selection" : selection } ] , header_only , order = "completion" , htj2k_passthrough = htj2k_passthrough , lazy = lazy , resolution_level = resolution_level , preview_size = preview_size))
+        DICOMized.sort(key = self.getSeriesRankAndInstanceNumber)
+        return [ ds for job , ds in DICOMized ]
+
+    def iterDICOMizeImageSet(self, datastore_id : str = None , image_set_id : str = None , header_only : bool = False , order : str = "instance_number" , max_instances_in_flight : int = None , htj2k_passthrough : bool = False , selection : AHIInstanceSelection = None , lazy : bool = False , resolution_level : int = 0 , preview_size : int = None):
+        """
+        iterDICOMizeImageSet(datastore_id : str = None , image_set_id : str = None).
+        Generator version of DICOMizeImageSet : the pydicom datasets are yielded as soon as they are DICOMized, instead of being returned all at once.
+        Only max_instances_in_flight instances are fetched, DICOMized or buffered at any time, so the memory used does not grow with the size of the series.
 
+        :param datastore_id: The datastoreId containing the DICOM Study.
+        :param image_set_id: The ImageSetID of the data to be DICOMized from AHI.
+        :param header_only: Optional, only the DICOM headers are DICOMized if set to True.
+        :param order: Optional, "instance_number" (default) to yield the instances of each series ordered by InstanceNumber, or "completion" to yield them as soon as they are ready.
+        :param max_instances_in_flight: Optional maximum number of instances being processed or waiting to be reordered. Will default to the network concurrency.
+        :param htj2k_passthrough: Optional, if set to True the HTJ2K frames are not decoded : they are stored as encapsulated PixelData with the HTJ2K transfer syntax.
+        :param selection: Optional AHIInstanceSelection of the series , instances and frames to export. Will default to all of them.
+        :param lazy: Optional , if set to True the PixelData of each dataset is only fetched when it is first accessed. See DICOMizeImageSet.
+        :param resolution_level: Optional , the frames are decoded with their width and height divided by 2 ** resolution_level. See DICOMizeImageSet.
+        :param preview_size: Optional , the frames are decoded at the lowest resolution level whose width or height is still preview_size or more. See DICOMizeImageSet.
+        :return: A generator of pydicom DICOM objects.
+        """ 
+        if order not in ["instance_number" , "completion"]:
+            raise ValueError(f"order must be 'instance_number' or 'completion' , not '{order}'")
+        client = self._getClient()
+        AHI_metadata = self.getMetadata(datastore_id, image_set_id, client) 
+        if AHI_metadata is None:
+            self.logger.error(f"[{__name__}] - No metadata found for datastore_id : {datastore_id} , imageset_id : {image_set_id}")
+            return
+        for job , ds in self._iterDICOMize(datastore_id , [ { "imagesetId" : image_set_id , "Metadata" : AHI_metadata , "Selection" : selection } ] , header_only , order , max_instances_in_flight , htj2k_passthrough , lazy = lazy , resolution_level = resolution_level , preview_size = preview_size):
+            yield ds
+
+    def exportImageSetToDirectory(self, datastore_id : str , image_set_id : str , destination : str , layout : str = DEFAULT_LAYOUT , header_only : bool = False , htj2k_passthrough : bool = False , writer_count : int = 4 , fsync_batch_size : int = 64 , max_instances_in_flight : int = None , selection : AHIInstanceSelection = None , resolution_level : int = 0 , preview_size : int = None) -> dict:
+        """
+        exportImageSetToDirectory(datastore_id : str , image_set_id : str , destination : str).
+        Writes all the instances of the ImageSet as DICOM Part10 files, each file being written by a pool of writer threads as soon as its instance is DICOMized.
+        Only max_instances_in_flight instances and 2 per writer thread are held in memory at any time, whatever the size of the ImageSet.
+
+        :param datastore_id: The datastoreId containing the DICOM Study.
+        :param image_set_id: The ImageSetID of the data to be exported.
+        :param destination: The folder the files are written to.
+        :param layout: Optional path of each file relative to destination, formatted with the attributes of the instance. Will default to {StudyInstanceUID}/{SeriesInstanceUID}/{SOPInstanceUID}.dcm
+        :param writer_count: Optional number of writer threads. Will default to 4.
+        :param fsync_batch_size: Optional number of files flushed to the disk together before being renamed to their final name. Will default to 64, 0 to not flush them.
+        :param selection: Optional AHIInstanceSelection of the series , instances and frames to export. Will default to all of them.
+        :param resolution_level: Optional , the frames are decoded with their width and height divided by 2 ** resolution_level. See DICOMizeImageSet.
+        :param preview_size: Optional , the frames are decoded at the lowest resolution level whose width or height is still preview_size or more. See DICOMizeImageSet.
+        :return: The number of files and bytes written , the number of errors , and the paths of the files written.
+        """ 
+        if header_only: # the Part10 headers are built in-process , see iterImageSetHeaders.
+            files = ( header for job , header in self._iterHeaders(datastore_id , [ { "imagesetId" : image_set_id , "Selection" : selection } ] , "part10" , fields = True) )
         else:
-            while(len(self.ImageFrames)> 0):
-                self.frameToDICOMize.append(self.ImageFrames.popleft())
-        for x in range(self.fetcherProcessCount):
-            self.logger.debug(f"[{__name__}] - Disposing frame fetcher thread # {x}")
-            self.frameFetcherThreadList[x].Dispose()
-            self.logger.debug(f"[{__name__}] - frame fetcher thread # {x} disposed.")
-
-        while(self.still_processing  == True):
-            self.logger.debug(f"[{__name__}] - Still processing DICOMizing...")
-            sleep(0.1)
-
-        returnlist = list(self.DICOMizedFrames)
-        returnlist.sort( key= self.getInstanceNumberInDICOM)
-        return returnlist
-
-
-
-
-    def AssignDICOMizeJob(self):
-        #this function rounds robin accross all the dicomizer threads, until all the images are actually dicomized.
-        self.logger.debug(f"[AssignDICOMizeJob] - DICOMizer Thread Assigner started.")
-        keep_running = True
-
-
-        while( keep_running):
-            while( len(self.frameToDICOMize) > 0):
-                threadId = 0
-                self.frameDICOMizerThreadList[threadId].AddDICOMizeJob(self.frameToDICOMize.popleft())
-                threadId+=1 
-                if(threadId == self.DICOMizerProcessCount):
-                    threadId = 0
-
-            for x in range(self.DICOMizerProcessCount):
-                while( not self.frameDICOMizerThreadList[x].DICOMizeJobsCompleted.empty()):
-                    self.DICOMizedFrames.append(self.frameDICOMizerThreadList[x].getFramesDICOMized())
-            dc = len(self.DICOMizedFrames)
-            #print(dc)
-
-            if(len(self.DICOMizedFrames)  == self.CountToDICOMize):
-                keep_running = False
-                self.logger.debug(f"[{__name__}] - DICOMized count : {dc}")
-                for x in range(self.DICOMizerProcessCount):
-                    self.logger.debug(f"[{__name__}] - Disposing DICOMizer thread # {x}")
-                    self.frameDICOMizerThreadList[x].Dispose()
-                    self.logger.debug(f"[{__name__}] - DICOMizer thread # {x} Disposed.")
-                self.still_processing = False
-            else:
-                sleep(0.05)
+            files = ( ( ds , None ) for ds in self.iterDICOMizeImageSet(datastore_id , image_set_id , header_only , "completion" , max_instances_in_flight , htj2k_passthrough , selection , resolution_level = resolution_level , preview_size = preview_size) )
+        return self._exportToDirectory(files , destination , layout , writer_count , fsync_batch_size)
+
+    def exportStudyToDirectory(self, datastore_id : str , study_instance_uid : str , destination : str , layout : str = DEFAULT_LAYOUT , header_only : bool = False , htj2k_passthrough : bool = False , writer_count : int = 4 , fsync_batch_size : int = 64 , max_instances_in_flight : int = None , max_image_sets_in_flight : int = 4 , selection : AHIInstanceSelection = None , resolution_level : int = 0 , preview_size : int = None) -> dict:
+        """
+        exportStudyToDirectory(datastore_id : str , study_instance_uid : str , destination : str).
+        Same as exportImageSetToDirectory , for all the ImageSets of the study. See iterDICOMizeStudy.
+        """ 
+        if header_only:
+            files = ( header for job , header in self._iterHeaders(datastore_id , self._getStudySources(datastore_id , study_instance_uid , selection) , "part10" , max_image_sets_in_flight , fields = True) )
+        else:
+            files = ( ( ds , None ) for ds in self.iterDICOMizeStudy(datastore_id , study_instance_uid , header_only , "completion" , max_instances_in_flight , max_image_sets_in_flight , htj2k_passthrough , selection , resolution_level = resolution_level , preview_size = preview_size) )
+        return self._exportToDirectory(files , destination , layout , writer_count , fsync_batch_size)
+
+    def _exportToDirectory(self, files , destination , layout , writer_count , fsync_batch_size) -> dict:
+        # files : ( dataset , None ) tuples , or ( HeaderFields , Part10 header ) tuples of the header only exports.
+        writer = AHIDICOMWriter(destination , layout , writer_count , fsync_batch_size , metrics = self.metrics)
+        try:
+            for ds , data in files:
+                writer.submit(ds , data = data)
+        finally:
+            statistics = writer.close()
+        self.logger.debug(f"[{__name__}] - {statistics['Files']} files written to {destination} , {statistics['Errors']} errors.")
+        return statistics
+
+    def iterImageSetHeaders(self, datastore_id : str , image_set_id : str , output : str = "json" , selection : AHIInstanceSelection = None , version_id : str = None):
+        """
+        iterImageSetHeaders(datastore_id : str , image_set_id : str).
+        Yields the DICOM header of each instance of the ImageSet , built in the calling process from the ImageSet metadata only : no frame is fetched and no worker process is started.
+        The Patient , Study and Series levels are converted once per series and the Instance level elements are cached by value , so tens of thousands of headers are built per second on one core for the JSON and Part10 outputs.
+        The instances of each series are yielded ordered by InstanceNumber.
+
+        :param datastore_id: The datastoreId containing the DICOM Study.
+        :param image_set_id: The ImageSetID of the data to be exported.
+        :param output: Optional , "json" (default) for the DICOM JSON object ( PS3.18 F.2 ) of each instance serialized as a string , "part10" for a DICOM Part10 file without PixelData as bytes ,
+        or "dataset" for a pydicom dataset , the same as DICOMizeImageSet with header_only.
+        :param selection: Optional AHIInstanceSelection of the series , instances and frames to export. Will default to all of them.
+        :param version_id: Optional version of the ImageSet. Will default to the latest version.
+        :return: A generator of strings , bytes or pydicom datasets depending on output.
+        """ 
+        if output not in HEADER_OUTPUTS:
+            raise ValueError(f"output must be one of {HEADER_OUTPUTS} , not '{output}'")
+        for job , header in self._iterHeaders(datastore_id , [ { "imagesetId" : image_set_id , "version" : version_id , "Selection" : selection } ] , output):
+            yield header
+
+    def iterStudyHeaders(self, datastore_id : str , study_instance_uid : str , output : str = "json" , selection : AHIInstanceSelection = None , max_image_sets_in_flight : int = 4):
+        """
+        iterStudyHeaders(datastore_id : str , study_instance_uid : str).
+        Same as iterImageSetHeaders , for all the ImageSets of the study. The metadata of the next max_image_sets_in_flight ImageSets is fetched while the headers of the current one are built.
+        """ 
+        if output not in HEADER_OUTPUTS:
+            raise ValueError(f"output must be one of {HEADER_OUTPUTS} , not '{output}'")
+        for job , header in self._iterHeaders(datastore_id , self._getStudySources(datastore_id , study_instance_uid , selection) , output , max_image_sets_in_flight):
+            yield header
+
+    def exportImageSetToDICOMJSON(self, datastore_id : str , image_set_id : str , destination : str , layout : str = DEFAULT_JSON_LAYOUT , selection : AHIInstanceSelection = None , version_id : str = None) -> dict:
+        """
+        exportImageSetToDICOMJSON(datastore_id : str , image_set_id : str , destination : str).
+        Writes the DICOM JSON headers of the instances of the ImageSet , one file per series holding the array of its instances ordered by InstanceNumber , like a DICOMweb series metadata response.
+        The headers are built in-process , see iterImageSetHeaders. Each file is written to a temporary file and renamed once complete.
+
+        :param destination: The folder the files are written to.
+        :param layout: Optional path of each file relative to destination , formatted with the attributes of the first instance of the series. Will default to {StudyInstanceUID}/{SeriesInstanceUID}.json
+        :param selection: Optional AHIInstanceSelection of the series , instances and frames to export. Will default to all of them.
+        :param version_id: Optional version of the ImageSet. Will default to the latest version.
+        :return: The number of files , instances and bytes written , and the paths of the files written.
+        """ 
+        return self._exportToDICOMJSON(datastore_id , [ { "imagesetId" : image_set_id , "version" : version_id , "Selection" : selection } ] , destination , layout)
+
+    def exportStudyToDICOMJSON(self, datastore_id : str , study_instance_uid : str , destination : str , layout : str = DEFAULT_JSON_LAYOUT , selection : AHIInstanceSelection = None , max_image_sets_in_flight : int = 4) -> dict:
+        """
+        exportStudyToDICOMJSON(datastore_id : str , study_instance_uid : str , destination : str).
+        Same as exportImageSetToDICOMJSON , for all the ImageSets of the study.
+        """ 
+        return self._exportToDICOMJSON(datastore_id , self._getStudySources(datastore_id , study_instance_uid , selection) , destination , layout , max_image_sets_in_flight)
+
+    def _exportToDICOMJSON(self, datastore_id , sources , destination , layout , max_image_sets_in_flight = 1) -> dict:
+        # the instances of a series are yielded one after the other , so a single file is open at any time.
+        statistics = { "Files" : 0 , "Instances" : 0 , "Bytes" : 0 }
+        written = []
+        series = None # ( ImageSet and series , path , temporary file , temporary path ) of the file being written.
+        complete = False
+        try:
+            for job , ( fields , header ) in self._iterHeaders(datastore_id , sources , "json" , max_image_sets_in_flight , fields = True):
+                key = ( job["imagesetId"] , job["SeriesUID"] )
+                if series is not None and series[0] == key:
+                    series[2].write(b",")
+                else:
+                    if series is not None:
+                        self._closeDICOMJSON(series , True , statistics , written)
+                    series = self._openDICOMJSON(key , os.path.join(destination , layout.format_map(LayoutFields(fields))) , written)
+                series[2].write(header.encode("utf-8"))
+                statistics["Instances"] += 1
+            complete = True
+        finally:
+            if series is not None:
+                self._closeDICOMJSON(series , complete , statistics , written)
+        self.logger.debug(f"[{__name__}] - {statistics['Files']} DICOM JSON files written to {destination}.")
+        return dict(statistics , Paths = written)
+
+    def _openDICOMJSON(self, key , path , written) -> tuple:
+        if path in written: # a series split across several ImageSets.
+            root , extension = os.path.splitext(path)
+            path = f"{root}_{key[0]}{extension}"
+        folder = os.path.dirname(path)
+        os.makedirs(folder , exist_ok = True)
+        fd , temp_path = tempfile.mkstemp(dir = folder , prefix = "." , suffix = ".tmp")
+        f = os.fdopen(fd , "wb")
+        f.write(b"[")
+        return ( key , path , f , temp_path )
+
+    def _closeDICOMJSON(self, series , complete , statistics , written):
+        key , path , f , temp_path = series
+        if not complete: # the export failed or was stopped , the series is not written.
+            f.close()
+            os.remove(temp_path)
+            return
+        f.write(b"]")
+        statistics["Bytes"] += f.tell()
+        f.close()
+        os.replace(temp_path , path)
+        statistics["Files"] += 1
+        written.append(path)
+        self.metrics.count("Files")
+
+    def _getStudySources(self, datastore_id , study_instance_uid , selection = None) -> list:
+        return [ { "imagesetId" : imageset["imageSetId"] , "version" : imageset.get("version") , "Selection" : selection } for imageset in self.searchImageSets(datastore_id , study_instance_uid , self._getClient()) ]
+
+    def getVolume(self, datastore_id : str , image_set_id : str , series_instance_uid : str = None , memmap_path : str = None , selection : AHIInstanceSelection = None , resolution_level : int = 0 , version_id : str = None , max_instances_in_flight : int = None) -> "AHIVolume":
+        """
+        getVolume(datastore_id : str , image_set_id : str).
+        Returns the frames of one series as a single ( slices , rows , columns ) array , along with its spacing , origin and orientation. The geometry is read from the ImageSet metadata,
+        the frames are sorted along the slice normal , and the decoder processes write each frame at its place in the volume : the instances are never DICOMized.
+
+        :param datastore_id: The datastoreId containing the DICOM Study.
+        :param image_set_id: The ImageSetID of the series.
+        :param series_instance_uid: Optional SeriesInstanceUID of the series. Will default to the series of the ImageSet with the most instances.
+        :param memmap_path: Optional file the volume is written to , and memory mapped from. Will default to an in memory array.
+        :param selection: Optional AHIInstanceSelection of the instances and frames of the series arranged in the volume. Will default to all of them.
+        :param resolution_level: Optional , the frames are decoded with their width and height divided by 2 ** resolution_level. The spacing is set accordingly.
+        :param version_id: Optional version of the ImageSet. Will default to the latest version.
+        :param max_instances_in_flight: Optional maximum number of instances being fetched and decoded. Will default to the network concurrency.
+        :return: An AHIVolume whose Volume holds the stored values , see AHIVolume.getRescaledVolume() , or None if the volume could not be built.
+        """ 
+        import numpy as np
+        from .AHIVolume import AHIVolume
+        client = self._getClient()
+        AHI_metadata = self.getMetadata(datastore_id , image_set_id , client , version_id)
+        if AHI_metadata is None:
+            self.logger.error(f"[{__name__}] - No metadata found for datastore_id : {datastore_id} , imageset_id : {image_set_id}")
+            return None
+        try:
+            if series_instance_uid is None:
+                series_instance_uid = max(self.getSeriesList(AHI_metadata , image_set_id) , key = lambda series : series["InstanceCount"])["SeriesInstanceUID"]
+            ImageFrames = list(self.getImageFrames(datastore_id , image_set_id , AHI_metadata , series_instance_uid))
+            if selection is not None:
+                ImageFrames = self.selectImageFrames(selection , ImageFrames)
+            volume = AHIVolume(ImageFrames , resolution_level)
+        except (KeyError , TypeError , ValueError) as err:
+            self.logger.error(f"[{__name__}][getVolume] - Series {series_instance_uid} of ImageSet {image_set_id} can not be arranged in a volume : {err}")
+            return None
+        path = memmap_path
+        if path is None:
+            # the volume is decoded in a temporary file , in shared memory when it fits , which is unlinked once mapped.
+            folder = "/dev/shm" if os.path.isdir("/dev/shm") else None
+            if folder is not None:
+                stats = os.statvfs(folder)
+                if stats.f_bavail * stats.f_frsize < volume.FrameLength * volume.shape[0]:
+                    folder = None
+            handle , path = tempfile.mkstemp(prefix = "AHIVolume" , suffix = ".raw" , dir = folder)
+            os.close(handle)
+        try:
+            with open(path , "wb") as f:
+                f.truncate(volume.FrameLength * volume.shape[0])
+            # the jobs only carry what the decoders need , the instances metadata stays in the parent process.
+            jobs = [ { "datastoreId" : datastore_id , "imagesetId" : image_set_id , "frameIds" : ImageFrame["frameIds"] , "SeriesUID" : ImageFrame["SeriesUID"] , "SOPInstanceUID" : ImageFrame["SOPInstanceUID"] , "InstanceNumber" : ImageFrame["InstanceNumber"] , "PixelData" : None , "FrameLength" : volume.FrameLength , "ResolutionLevel" : resolution_level , "Target" : path , "FrameOffsets" : volume.FrameOffsets[ImageFrame["SOPInstanceUID"]] } for ImageFrame in ImageFrames ]
+            if self._decodeVolume(jobs , max_instances_in_flight) > 0:
+                self.logger.error(f"[{__name__}][getVolume] - Some frames of series {series_instance_uid} could not be decoded , the volume is incomplete.")
+                return None
+            Volume = np.memmap(path , dtype = volume.dtype , mode = "r+" , shape = volume.shape)
+            volume.Volume = Volume if memmap_path is not None else np.asarray(Volume)
+        finally:
+            if memmap_path is None:
+                os.remove(path)
+        self.logger.debug(f"[{__name__}] - Volume {volume.shape} of series {series_instance_uid} decoded.")
+        return volume
+
+    def _decodeVolume(self, jobs , max_instances_in_flight = None) -> int:
+        # the decoder processes write the frames of each instance at their offsets in the volume file , the DICOMizer processes only report the instances back. Returns the number of instances in error.
+        dispose_processes = not self.processes_started
+        self.start()
+        try:
+            if max_instances_in_flight is None:
+                max_instances_in_flight = max(self.networkConcurrency , 2 * self.fetcherProcessCount)
+            self.exportId += 1
+            pending = collections.deque(jobs)
+            in_flight = 0
+            errors = 0
+            while len(pending) > 0 or in_flight > 0:
+                while len(pending) > 0 and in_flight < max_instances_in_flight:
+                    job = pending.popleft()
+                    job["ExportId"] = self.exportId
+                    self.frameScheduler.AddInstance(job)
+                    in_flight += 1
+                job = self._getCompletedJob()
+                self.frameScheduler.ReleaseInstance(job)
+                if job["ExportId"] != self.exportId:
+                    continue # left over from a previous export which was not iterated until the end.
+                in_flight -= 1
+                self._recordJob(job)
+                if job.get("Error") is not None:
+                    self.logger.error(f"[{__name__}] - Instance {job['SOPInstanceUID']} could not be decoded : {job['Error']}")
+                    errors += 1
+                self.metrics.push(self.getMetrics)
+            return errors
+        finally:
+            self.metrics.push(self.getMetrics , force = True)
+            if dispose_processes:
+                self.close()
+
+    def _iterDICOMize(self, datastore_id , sources , header_only = False , order = "instance_number" , max_instances_in_flight = None , htj2k_passthrough = False , max_image_sets_in_flight = 1 , lazy = False , resolution_level = 0 , preview_size = None):
+        # sources : one { "imagesetId" , "version" , "Metadata" , "Selection" , "Exclude" } dict per ImageSet , the metadata being fetched when it is missing, only the instances in Selection being exported and the SOPInstanceUIDs in Exclude being skipped. Yields ( job , dataset ) tuples.
+        # the lazy datasets are DICOMized as header only ones , their PixelData is loaded by the pixel data loader when it is accessed.
+        if header_only: # built in-process , without the worker processes.
+            yield from self._iterHeaders(datastore_id , sources , "dataset" , max_image_sets_in_flight)
+            return
+        if lazy:
+            from .AHILazyDataset import AHILazyDataset
+            loader = self.getPixelDataLoader()
+        else:
+            loader = None
+        #processes init for Frame fetching and DICOM encapsulation, unless they were already started by start() or the context manager.
+        dispose_processes = not self.processes_started
+        self.start()
+        client = self._getClient()
+        planner = ThreadPoolExecutor(max_workers = max(1 , max_image_sets_in_flight) , thread_name_prefix = "AHItoDICOM")
+        try:
+            if max_instances_in_flight is None:
+                max_instances_in_flight = max(self.networkConcurrency , 2 * self.fetcherProcessCount , 2 * self.DICOMizerProcessCount)
+            self.exportId += 1
+            sources = collections.deque(sources)
+            planned = collections.deque() # ImageSets whose metadata is being fetched, in the search order.
+            active = collections.deque() # instances not admitted yet of each ImageSet being exported, admitted in turns.
+            remaining = {} # instances not DICOMized yet, by ImageSet.
+            seriesRanks = {}
+            spans = {} # tracing spans of the ImageSets being exported.
+            imageSetCount = 0
+            DICOMized = {} # reorder buffer, indexed by the admission order of the instances.
+            next_index = 0
+            admitted = 0
+            in_flight = 0
+            reserved = 0 # bytes reserved in the memory budget by the instances in flight.
+            while True:
+                while len(sources) > 0 and len(planned) + len(remaining) < max(1 , max_image_sets_in_flight):
+                    planned.append(planner.submit(self._planImageSet , datastore_id , sources.popleft() , client))
+                # an ImageSet starts as soon as its metadata is ready , the main thread only waits for it when there is nothing else to do.
+                if len(planned) > 0 and (planned[0].done() or (len(active) == 0 and in_flight == 0)):
+                    ImageFrames = planned.popleft().result()
+                    if len(ImageFrames) > 0:
+                        imageSetCount += 1
+                        remaining[imageSetCount] = len(ImageFrames)
+                        for ImageFrame in ImageFrames:
+                            ImageFrame["ImageSetRank"] = imageSetCount
+                            ImageFrame["SeriesRank"] = seriesRanks.setdefault((ImageFrame["imagesetId"] , ImageFrame["SeriesUID"]) , len(seriesRanks))
+                            ImageFrame["ExportId"] = self.exportId
+                            ImageFrame["Passthrough"] = htj2k_passthrough
+                            if (resolution_level > 0 or preview_size is not None) and not htj2k_passthrough and not header_only:
+                                self.setResolutionLevel(ImageFrame , resolution_level , preview_size)
+                        active.append(ImageFrames)
+                        spans[imageSetCount] = self.metrics.startSpan("AHItoDICOM.exportImageSet" , { "imageSetId" : ImageFrames[0]["imagesetId"] , "instanceCount" : len(ImageFrames) })
+                        self.logger.debug(f"[{__name__}] - DICOMizing {len(ImageFrames)} instances of {ImageFrames[0]['imagesetId']}.")
+                    continue
+                if len(active) == 0 and in_flight == 0:
+                    break
+                while len(active) > 0 and in_flight < max_instances_in_flight:
+                    cost = self._estimateInstanceBytes(active[0][0] , header_only or loader is not None)
+                    if self.memoryBudget is not None and not self.memoryBudget.tryAcquire(cost):
+                        break # admitted once enough instances in flight are returned.
+                    ImageFrames = active.popleft()
+                    ImageFrame = ImageFrames.popleft()
+                    if len(ImageFrames) > 0:
+                        active.append(ImageFrames)
+                    ImageFrame["Reserved"] = cost
+                    reserved += cost
+                    ImageFrame["Index"] = admitted
+                    ImageFrame["Admitted"] = time.perf_counter()
+                    admitted += 1
+                    # the frame scheduler hands the decoded instances directly to the DICOMizer processes through the shared DICOMizeJobs queue.
+                    if header_only or loader is not None:
+                        ImageFrame["Enqueued"] = time.time()
+                        self.DICOMizeJobs.put(ImageFrame)
+                    else:
+                        self.frameScheduler.AddInstance(ImageFrame)
+                    in_flight += 1
+                job = self._getCompletedJob()
+                self.frameScheduler.ReleaseInstance(job)
+                if job["ExportId"] != self.exportId:
+                    continue # left over from a previous export which was not iterated until the end.
+                self._recordJob(job)
+                if job.get("Error") is not None:
+                    self.logger.error(f"[{__name__}] - Instance {job['SOPInstanceUID']} could not be DICOMized and is skipped : {job['Error']}")
+                remaining[job["ImageSetRank"]] -= 1
+                if remaining[job["ImageSetRank"]] == 0:
+                    del remaining[job["ImageSetRank"]]
+                    self.metrics.endSpan(spans.pop(job["ImageSetRank"] , None))
+                DICOMized[job["Index"]] = job
+                if order == "completion":
+                    ready = list(DICOMized.values())
+                    DICOMized.clear()
+                else:
+                    ready = []
+                    while next_index in DICOMized:
+                        ready.append(DICOMized.pop(next_index))
+                        next_index += 1
+                for job in ready:
+                    in_flight -= 1
+                    reserved -= job["Reserved"]
+                    if self.memoryBudget is not None:
+                        self.memoryBudget.release(job["Reserved"])
+                    ds = job.pop("Dataset")
+                    if ds is not None and loader is not None:
+                        ds = AHILazyDataset(ds , job , loader)
+                    self.metrics.observe("Instance" , time.perf_counter() - job["Admitted"])
+                    if ds is not None:
+                        yield job , ds
+                if len(ready) > 0:
+                    self.logger.debug(f"Done {admitted - in_flight}/{admitted + sum(len(ImageFrames) for ImageFrames in active)}")
+                self.metrics.push(self.getMetrics)
+        finally:
+            planner.shutdown(wait = False , cancel_futures = True)
+            for span in spans.values(): # ImageSets left unfinished.
+                self.metrics.endSpan(span , { "cancelled" : True })
+            if self.memoryBudget is not None: # the instances still in flight are skipped by the next export.
+                self.memoryBudget.release(reserved)
+            self.metrics.push(self.getMetrics , force = True)
+            if dispose_processes:
+                self.close()
+
+    def _iterHeaders(self, datastore_id , sources , output = "dataset" , max_image_sets_in_flight = 1 , fields = False):
+        # header only exports : the headers are built in the calling thread from the metadata , while the planner threads fetch the metadata of the next ImageSets. Same sources as _iterDICOMize.
+        # Yields ( job , header ) tuples , the header being a dataset , a DICOM JSON string or a Part10 header depending on output , or ( HeaderFields , header ) if fields is set.
+        encoder = self.getHeaderEncoder()
+        convert = { "dataset" : encoder.getDataset , "json" : encoder.getJSON , "part10" : encoder.getPart10 }[output]
+        client = self._getClient()
+        planner = ThreadPoolExecutor(max_workers = max(1 , max_image_sets_in_flight) , thread_name_prefix = "AHItoDICOM")
+        span = None
+        try:
+            self.exportId += 1
+            sources = collections.deque(sources)
+            planned = collections.deque() # ImageSets whose metadata is being fetched, in the search order.
+            seriesRanks = {}
+            imageSetCount = 0
+            admitted = 0
+            while len(sources) > 0 or len(planned) > 0:
+                while len(sources) > 0 and len(planned) < max(1 , max_image_sets_in_flight):
+                    planned.append(planner.submit(self._planImageSet , datastore_id , sources.popleft() , client))
+                ImageFrames = planned.popleft().result()
+                if len(ImageFrames) == 0:
+                    continue
+                imageSetCount += 1
+                span = self.metrics.startSpan("AHItoDICOM.exportImageSet" , { "imageSetId" : ImageFrames[0]["imagesetId"] , "instanceCount" : len(ImageFrames) })
+                self.logger.debug(f"[{__name__}] - Building the headers of {len(ImageFrames)} instances of {ImageFrames[0]['imagesetId']}.")
+                for ImageFrame in ImageFrames:
+                    ImageFrame["ImageSetRank"] = imageSetCount
+                    ImageFrame["SeriesRank"] = seriesRanks.setdefault((ImageFrame["imagesetId"] , ImageFrame["SeriesUID"]) , len(seriesRanks))
+                    ImageFrame["ExportId"] = self.exportId
+                    ImageFrame["Index"] = admitted
+                    admitted += 1
+                    start_time = time.perf_counter()
+                    try:
+                        elements = encoder.getElements(ImageFrame)
+                        header = convert(ImageFrame , elements)
+                        if fields:
+                            header = ( HeaderFields(elements) , header )
+                    except Exception as err:
+                        ImageFrame["Error"] = str(err)
+                        self.metrics.count("InstanceErrors")
+                        self.logger.error(f"[{__name__}] - Instance {ImageFrame['SOPInstanceUID']} could not be DICOMized and is skipped : {err}")
+                        continue
+                    finally:
+                        del ImageFrame["Metadata"]
+                    elapsed = time.perf_counter() - start_time
+                    self.metrics.observe("DICOMize" , elapsed)
+                    self.metrics.observe("Instance" , elapsed)
+                    self.metrics.count("Instances")
+                    yield ImageFrame , header
+                    self.metrics.push(self.getMetrics)
+                self.metrics.endSpan(span)
+                span = None
+        finally:
+            planner.shutdown(wait = False , cancel_futures = True)
+            if span is not None: # ImageSet left unfinished.
+                self.metrics.endSpan(span , { "cancelled" : True })
+            self.metrics.push(self.getMetrics , force = True)
+
+    def _planImageSet(self, datastore_id , source , client) -> collections.deque:
+        # runs in the planner threads : returns the instances of all the series of the ImageSet , each series ordered by InstanceNumber.
+        AHI_metadata = source.get("Metadata")
+        if AHI_metadata is None:
+            AHI_metadata = self.getMetadata(datastore_id , source["imagesetId"] , client , source.get("version"))
+        if AHI_metadata is None:
+            self.logger.error(f"[{__name__}] - No metadata found for datastore_id : {datastore_id} , imageset_id : {source['imagesetId']}")
+            return collections.deque()
+        ImageFrames = collections.deque()
+        selection = source.get("Selection")
+        try:
+            for series in self.getSeriesList(AHI_metadata , source["imagesetId"]):
+                if selection is None:
+                    ImageFrames.extend(self.getImageFrames(datastore_id , source["imagesetId"] , AHI_metadata , series["SeriesInstanceUID"]))
+                elif selection.isSeriesSelected(series["SeriesInstanceUID"]):
+                    ImageFrames.extend(self.selectImageFrames(selection , self.getImageFrames(datastore_id , source["imagesetId"] , AHI_metadata , series["SeriesInstanceUID"])))
+        except Exception as AHIErr:
+            self.logger.error(f"[{__name__}] - {AHIErr}")
+        # the caller can read the number of instances of the ImageSet , and exclude the ones it already has.
+        source["InstanceCount"] = len(ImageFrames)
+        exclude = source.get("Exclude")
+        if exclude:
+            ImageFrames = collections.deque( ImageFrame for ImageFrame in ImageFrames if ImageFrame["SOPInstanceUID"] not in exclude )
+        return ImageFrames
+
+    def selectImageFrames(self, selection : AHIInstanceSelection , ImageFrames) -> list:
+        # instances of one series selected , with only the frames selected.
+        selected = []
+        for ImageFrame in selection.selectInstances(ImageFrames):
+            frameIndexes = selection.selectFrames(len(ImageFrame["frameIds"]))
+            if frameIndexes is not None:
+                if len(frameIndexes) == 0:
+                    self.logger.debug(f"[{__name__}] - Instance {ImageFrame['SOPInstanceUID']} is skipped , none of its {len(ImageFrame['frameIds'])} frames is selected.")
+                    continue
+                ImageFrame["frameIds"] = [ ImageFrame["frameIds"][index] for index in frameIndexes ]
+                ImageFrame["FrameIndexes"] = frameIndexes
+            selected.append(ImageFrame)
+        return selected
+
+    def setResolutionLevel(self, ImageFrame : dict , resolution_level : int = 0 , preview_size : int = None):
+        # the frames of the instance are decoded at a reduced resolution , its FrameLength is the one of the reduced frames.
+        tags = dict(ImageFrame["Metadata"]["Series"] , **ImageFrame["Metadata"]["Instance"])
+        try:
+            if preview_size is not None:
+                resolution_level = GetResolutionLevel(int(tags["Rows"]) , int(tags["Columns"]) , preview_size)
+        except (KeyError , TypeError , ValueError):
+            return
+        if resolution_level > 0:
+            ImageFrame["ResolutionLevel"] = resolution_level
+            ImageFrame["FrameLength"] = GetFrameLength(tags , resolution_level)
+
+    def getPixelDataLoader(self) -> "AHIPixelDataLoader":
+        """
+        Returns the AHIPixelDataLoader shared by the lazy datasets of the helper, created on first use.
+        """
+        if self.pixelDataLoader is None:
+            from .AHIPixelDataLoader import AHIPixelDataLoader
+            self.pixelDataLoader = AHIPixelDataLoader(self._getClient() , self.frameCache , self.networkConcurrency , self.fetchController)
+        return self.pixelDataLoader
+
+    def getHeaderEncoder(self) -> AHIHeaderEncoder:
+        """
+        Returns the AHIHeaderEncoder building the headers of the header only exports , created on first use.
+        """
+        if self.headerEncoder is None:
+            self.headerEncoder = AHIHeaderEncoder()
+        return self.headerEncoder
 
-        self.logger.debug(f"[AssignDICOMizeJob] - DICOMizer Thread Assigner finished.")        
+    def _getClient(self):
+        if self.AHIclient is not None:
+            return self.AHIclient
+        # the client is shared by the frame requests , at most network_concurrency at a time , and by the metadata and search requests of the planner threads.
+        return AHIClientFactory(self.aws_access_key ,  self.aws_secret_key , self.AHI_endpoint , max_pool_connections = self.networkConcurrency + 16)
+
+    def _getCompletedJob(self):
+        # All the fetcher and DICOMizer processes report to the same queue, so a single blocking read wakes up as soon as any stage completes a job.
+        while True:
+            try:
+                return self.CompletedJobs.get(timeout = 10)
+            except Empty:
+                for worker in self.frameDecoderThreadList + self.frameDICOMizerThreadList:
+                    if not worker.process.is_alive():
+                        raise RuntimeError(f"[{__name__}] - A worker process exited unexpectedly with code {worker.process.exitcode}.")
+                if not self.frameScheduler.collector.is_alive():
+                    raise RuntimeError(f"[{__name__}] - The frame scheduler collector thread exited unexpectedly.")
+
+    def _estimateInstanceBytes(self, ImageFrame : dict , header_only : bool = False) -> int:
+        # the pixels are held twice in the parent process : decoded by the decoders in the instance buffer , then copied in its dataset.
+        if header_only or ImageFrame.get("FrameLength") is None:
+            return INSTANCE_HEADER_BYTES
+        return INSTANCE_HEADER_BYTES + 2 * ImageFrame["FrameLength"] * len(ImageFrame["frameIds"])
+
+    def _recordJob(self, job : dict):
+        # the timings measured by the DICOMizer processes , and the time the job waited in the CompletedJobs queue.
+        timings = job.pop("Timings" , None)
+        if timings is not None:
+            self.metrics.observe("DICOMizeQueueWait" , timings[0])
+            self.metrics.observe("DICOMize" , timings[1])
+        completed = job.pop("Completed" , None)
+        if completed is not None:
+            self.metrics.observe("ResultQueueWait" , max(0.0 , time.time() - completed))
+        self.metrics.count("InstanceErrors" if job.get("Error") is not None else "Instances")
+
+    def getMetrics(self) -> dict:
+        """
+        getMetrics().
+        Returns a snapshot of the metrics of the helper : the histograms of the duration of each stage of the pipeline , the bytes read and written , the depth of the queues between the processes,
+        the busy time of each worker process and the fetch statistics , see getFetchStatistics().
+        """ 
+        snapshot = self.metrics.getSnapshot()
+        snapshot["Fetch"] = self.getFetchStatistics()
+        snapshot["Queues"] = {}
+        snapshot["Workers"] = []
+        if self.processes_started:
+            for name , queue in [ ("DecodeJobs" , self.DecodeJobs) , ("DecodedFrames" , self.DecodedFrames) , ("DICOMizeJobs" , self.DICOMizeJobs) , ("CompletedJobs" , self.CompletedJobs) ]:
+                try:
+                    snapshot["Queues"][name] = queue.qsize()
+                except NotImplementedError: # macOS.
+                    snapshot["Queues"][name] = None
+            snapshot["Queues"]["InstancesInFlight"] = len(self.frameScheduler.instances)
+            snapshot["Workers"] = self.getWorkerUtilization()
+        snapshot["MemoryBudget"] = {}
+        if self.memoryBudget is not None:
+            snapshot["MemoryBudget"]["Instances"] = self.memoryBudget.getStatistics()
+        if self.processes_started and self.frameScheduler.memory_budget is not None:
+            snapshot["MemoryBudget"]["Frames"] = self.frameScheduler.memory_budget.getStatistics()
+        return snapshot
+
+    def getFetchStatistics(self) -> dict:
+        """
+        getFetchStatistics().
+        Returns the number of frame requests , retries , throttled requests and failures of the helper , and the current number of requests allowed in flight.
+        """ 
+        return self.fetchController.getStatistics()
+
+    def getWorkerUtilization(self) -> list:
+        """
+        getWorkerUtilization().
+        Returns, for each decoder and DICOMizer process, the number of jobs it processed, the time it spent busy and its utilization since the processes were started.
+        """ 
+        return [ worker.getUtilization() for worker in self.frameDecoderThreadList + self.frameDICOMizerThreadList ]
 
     def getImageFrames(self, datastoreId, imagesetId , AHI_metadata , seriesUid) -> collections.deque:
         instancesList = []
@@ -213,12 +877,17 @@ class AHItoDICOM:
                 for imageFrame in AHI_metadata["Study"]["Series"][seriesUid]["Instances"][instances]["ImageFrames"]:
                     frameIds.append(imageFrame["ID"])
                 InstanceNumber = AHI_metadata["Study"]["Series"][seriesUid]["Instances"][instances]["DICOM"]["InstanceNumber"]
-                instancesList.append( { "datastoreId" : datastoreId, "imagesetId" : imagesetId , "frameIds" : frameIds , "SeriesUID" : seriesUid , "SOPInstanceUID" : instances,  "InstanceNumber" : InstanceNumber , "PixelData" : None})
+                instancesList.append( { "datastoreId" : datastoreId, "imagesetId" : imagesetId , "frameIds" : frameIds , "SeriesUID" : seriesUid , "SOPInstanceUID" : instances,  "InstanceNumber" : InstanceNumber , "PixelData" : None , "FrameLength" : GetFrameLength(AHI_metadata["Study"]["Series"][seriesUid]["Instances"][instances]["DICOM"]) , "TransferSyntaxUID" : AHI_metadata["Study"]["Series"][seriesUid]["Instances"][instances].get("StoredTransferSyntaxUID" , HTJ2K_LOSSLESS_RPCL) , "Metadata" : self.getInstanceMetadata(AHI_metadata , seriesUid , instances)})
             except Exception as AHIErr: 
                 self.logger.error(f"[{__name__}] - {AHIErr}")
         instancesList.sort(key=self.getInstanceNumber)
         return collections.deque(instancesList)
 
+    def getInstanceMetadata(self, AHI_metadata , seriesUid , SOPInstanceUID):
+        # Only the metadata levels relevant to one instance are sent to the DICOMizer processes along with each job.
+        InstanceMetadata = AHI_metadata["Study"]["Series"][seriesUid]["Instances"][SOPInstanceUID]
+        return { "Patient" : AHI_metadata["Patient"]["DICOM"] , "Study" : AHI_metadata["Study"]["DICOM"] , "Series" : AHI_metadata["Study"]["Series"][seriesUid]["DICOM"] , "Instance" : InstanceMetadata["DICOM"] , "DICOMVRs" : InstanceMetadata["DICOMVRs"] }
+
     def getSeriesList(self, AHI_metadata , image_set_id : str):
         ###07/25/2023 - awsjpleger :  this function is from a time when there could be multiple series withing a single ImageSetId. Still works with new AHI metadata, but should be refactored.
         seriesList = []
@@ -231,40 +900,132 @@ class AHItoDICOM:
                 SeriesDescription = ""
             SeriesInstanceUID = series
             try:
-                instanceCount = len(AHI_metadata["Study"]["Series"][series]["Instances"])
+                instanceCount = AHI_metadata["Study"]["Series"][series].get("InstanceCount" , len(AHI_metadata["Study"]["Series"][series]["Instances"]))
             except:
                 instanceCount = 0
             seriesList.append({ "ImageSetId" : image_set_id, "SeriesNumber" : SeriesNumber , "Modality" : Modality ,  "SeriesDescription" : SeriesDescription , "SeriesInstanceUID" : SeriesInstanceUID , "InstanceCount" : instanceCount})
         return seriesList
 
-    def getMetadata(self, datastore_id, imageset_id , client = None):
+    def getMetadata(self, datastore_id, imageset_id , client = None , version_id = None):
         """
         getMetadata(datastore_id : str = None , image_set_id : str  , client : str = None).
 
         :param datastore_id: The datastoreId containtaining the DICOM Study.
         :param image_set_id: The ImageSetID of the data to be DICOMized from AHI.
         :param client: Optional boto3 medical-imaging client. The functions creates its own client by default.
-        :return: a JSON structure corresponding to the ImageSet Metadata.
+        :param version_id: Optional version of the ImageSet. Will default to the latest version. When a metadata cache is used without version_id , the latest version is first read with get_image_set ,
+        one more request per call : pass the version returned by searchImageSets to save it.
+        :return: a JSON structure corresponding to the ImageSet Metadata. When a metadata cache is used , the structure is shared and must not be modified.
         """ 
         try:
             if client is None:
-                client = AHIClientFactory(self.aws_access_key ,  self.aws_secret_key , self.AHI_endpoint )
-            AHI_study_metadata = client.get_image_set_metadata(datastoreId=datastore_id , imageSetId=imageset_id)
-            json_study_metadata = gzip.decompress(AHI_study_metadata["imageSetMetadataBlob"].read())
-            json_study_metadata = json.loads(json_study_metadata)  
+                client = self._getClient()
+            if self.metadataCache is not None:
+                if version_id is None:
+                    version_id = self.getImageSetVersion(datastore_id , imageset_id , client)
+                json_study_metadata = self.metadataCache.getMetadata(datastore_id , imageset_id , version_id)
+                if json_study_metadata is not None:
+                    return json_study_metadata
+            with self.metrics.span("AHItoDICOM.getMetadata" , { "imageSetId" : imageset_id }):
+                start = time.perf_counter()
+                blob = self._getMetadataBlob(datastore_id , imageset_id , client , version_id)
+                self.metrics.observe("MetadataFetch" , time.perf_counter() - start)
+                self.metrics.count("MetadataBytes" , len(blob))
+                start = time.perf_counter()
+                data = gzip.decompress(blob)
+                self.metrics.observe("MetadataGunzip" , time.perf_counter() - start)
+                start = time.perf_counter()
+                json_study_metadata = loadJSON(data)
+                self.metrics.observe("MetadataParse" , time.perf_counter() - start)
+            if self.metadataCache is not None:
+                self.metadataCache.putMetadata(datastore_id , imageset_id , version_id , json_study_metadata , blob , len(data))
             return json_study_metadata
         except Exception as AHIErr :
             self.logger.error(f"[{__name__}] - {AHIErr}")
             return None
+
+    def getImageSetSummary(self, datastore_id , imageset_id , client = None , version_id = None):
+        """
+        getImageSetSummary(datastore_id : str = None , image_set_id : str  , client : str = None).
+        Lighter version of getMetadata for the callers which only need the Patient , Study and Series attributes : the instances are left out and each series holds an InstanceCount instead.
+        The whole document is still gunzipped and parsed before the instances are dropped , as the C JSON parsers can not skip them and a streaming parser in Python is slower : a first call takes about as long
+        as getMetadata ( about 0.3 s for the 15 MB of metadata of 20,000 instances , 10 ms of which for the gunzip ) , but the summary returned and cached is a few KB , and the next calls are served from the cache.
+
+        :param datastore_id: The datastoreId containtaining the DICOM Study.
+        :param image_set_id: The ImageSetID of the ImageSet.
+        :param client: Optional boto3 medical-imaging client. The functions creates its own client by default.
+        :param version_id: Optional version of the ImageSet. Will default to the latest version , read with get_image_set when a metadata cache is used. See getMetadata.
+        :return: a JSON structure corresponding to the ImageSet Metadata without the instances.
+        """ 
+        try:
+            if client is None:
+                client = self._getClient()
+            if self.metadataCache is not None:
+                if version_id is None:
+                    version_id = self.getImageSetVersion(datastore_id , imageset_id , client)
+                summary = self.metadataCache.getSummary(datastore_id , imageset_id , version_id)
+                if summary is not None:
+                    return summary
+            start = time.perf_counter()
+            blob = self._getMetadataBlob(datastore_id , imageset_id , client , version_id)
+            self.metrics.observe("MetadataFetch" , time.perf_counter() - start)
+            self.metrics.count("MetadataBytes" , len(blob))
+            start = time.perf_counter()
+            summary = loadMetadataSummary(blob)
+            self.metrics.observe("MetadataParse" , time.perf_counter() - start)
+            if self.metadataCache is not None:
+                self.metadataCache.putBlob(datastore_id , imageset_id , version_id , blob)
+                self.metadataCache.putSummary(datastore_id , imageset_id , version_id , summary)
+            return summary
+        except Exception as AHIErr :
+            self.logger.error(f"[{__name__}] - {AHIErr}")
+            return None
+
+    def getImageSetVersion(self, datastore_id , imageset_id , client = None) -> str:
+        """
+        Returns the latest version of the ImageSet.
+        """ 
+        if client is None:
+            client = self._getClient()
+        return str(client.get_image_set(datastoreId=datastore_id , imageSetId=imageset_id)["versionId"])
+
+    def _getMetadataBlob(self, datastore_id , imageset_id , client , version_id = None) -> bytes:
+        if version_id is None:
+            AHI_study_metadata = client.get_image_set_metadata(datastoreId=datastore_id , imageSetId=imageset_id)
+        else:
+            AHI_study_metadata = client.get_image_set_metadata(datastoreId=datastore_id , imageSetId=imageset_id , versionId=str(version_id))
+        return AHI_study_metadata["imageSetMetadataBlob"].read()
     
-    def getImageSetToSeriesUIDMap(self, datastore_id : str, study_instance_uid : str ):
+    def getImageSetToSeriesUIDMap(self, datastore_id : str, study_instance_uid : str , max_image_sets_in_flight : int = 4):
         """
         getImageSetToSeriesUIDMap(datastore_id : str = None , study_instance_uid : str).
 
         :param datastore_id: The datastoreId containtaining the DICOM Study.
         :param study_instance_uid: The StudyInstanceUID (0020,000d) of the Study to be DICOMized from AHI.
+        :param max_image_sets_in_flight: Optional maximum number of ImageSets metadata fetched at the same time. Will default to 4.
         :return: An array of Series descriptors associated to their ImageSetIDs for all the ImageSets related to the DICOM Study.
         """ 
+        client = self._getClient()
+        imagesets = self.searchImageSets(datastore_id , study_instance_uid , client)
+        with ThreadPoolExecutor(max_workers = max(1 , max_image_sets_in_flight)) as executor:
+            summaries = list(executor.map(lambda imageset : self.getImageSetSummary(datastore_id , imageset["imageSetId"] , client , imageset.get("version")) , imagesets))
+        series_map = []
+        for imageset , summary in zip(imagesets , summaries):
+            if summary is None:
+                self.logger.error(f"[{__name__}] - No metadata found for datastore_id : {datastore_id} , imageset_id : {imageset['imageSetId']}")
+                continue
+            series_map += self.getSeriesList(summary , imageset["imageSetId"])
+        return series_map
+
+    def searchImageSets(self, datastore_id : str , study_instance_uid : str = None , client = None) -> list:
+        """
+        searchImageSets(datastore_id : str , study_instance_uid : str).
+
+        :param datastore_id: The datastoreId containtaining the DICOM Study.
+        :param study_instance_uid: Optional StudyInstanceUID (0020,000d) of the Study. All the ImageSets of the datastore are returned if it is None.
+        :param client: Optional boto3 medical-imaging client. The functions creates its own client by default.
+        :return: The summaries of all the ImageSets of the study , the search result pages being followed until the last one.
+        """ 
         search_criteria = {
             'filters': [
                 {
@@ -277,40 +1038,103 @@ class AHItoDICOM:
                 }
             ]
         }
-        client = AHIClientFactory(self.aws_access_key ,  self.aws_secret_key , self.AHI_endpoint )
-        search_result = client.search_image_sets(datastoreId=datastore_id, searchCriteria = search_criteria) ### in theory we should check if a continuation token is returned and loop until we have all the results...
-        series_map = []
-        for imageset in search_result["imageSetsMetadataSummaries"]:  
-            current_imageset = imageset["imageSetId"]
-            series_map.append(self.getSeriesList(self.getMetadata(datastore_id, current_imageset ) , current_imageset)[0])
-        return series_map
-
+        if client is None:
+            client = self._getClient()
+        summaries = []
+        page = { "datastoreId" : datastore_id }
+        if study_instance_uid is not None:
+            page["searchCriteria"] = search_criteria
+        while True:
+            search_result = client.search_image_sets(**page)
+            summaries += search_result["imageSetsMetadataSummaries"]
+            if not search_result.get("nextToken"):
+                return summaries
+            page["nextToken"] = search_result["nextToken"]
 
     def getInstanceNumber(self, elem):
         return int(elem["InstanceNumber"])
     
+    def getSeriesRankAndInstanceNumber(self, elem):
+        # ( job , dataset ) tuples yielded by _iterDICOMize.
+        return ( elem[0]["SeriesRank"] , int(elem[0]["InstanceNumber"]) )
+
     def getInstanceNumberInDICOM(self, elem):
         return int(elem["InstanceNumber"].value)
 
-    def saveAsPngPIL(self, ds: Dataset , destination : str):
+    def saveThumbnails(self, datastore_id : str , image_set_id : str , destination : str , size : int = 128 , selection : AHIInstanceSelection = None) -> list:
+        """
+        saveThumbnails(datastore_id : str , image_set_id : str , destination : str).
+        Saves PNG thumbnails of the ImageSet instances as destination/SeriesInstanceUID/SOPInstanceUID.png . The frames are decoded at the lowest resolution level still larger than size , see preview_size in DICOMizeImageSet , and scaled down to fit in size x size.
+
+        :param datastore_id: The datastoreId containing the DICOM Study.
+        :param image_set_id: The ImageSetID of the thumbnails.
+        :param destination: The folder the thumbnails are saved to.
+        :param size: Optional maximum width and height of the thumbnails. Will default to 128.
+        :param selection: Optional AHIInstanceSelection of the instances to save a thumbnail of. Will default to the middle instance of each series.
+        :return: The paths of the thumbnails saved.
+        """ 
+        if selection is None:
+            selection = AHIInstanceSelection(middle_only = True)
+        paths = []
+        for ds in self.iterDICOMizeImageSet(datastore_id , image_set_id , order = "completion" , selection = selection , preview_size = size):
+            path = os.path.join(destination , str(ds.SeriesInstanceUID) , f"{ds.SOPInstanceUID}.png")
+            if self.saveAsPngPIL(ds , path , size):
+                paths.append(path)
+        return paths
+
+    def saveSeriesAsImages(self, datasets : list , destination : str , image_format : str = "png" , window : tuple = None , quality : int = 90) -> list:
+        """
+        saveSeriesAsImages(datasets : list , destination : str).
+        Saves an image of each frame of the datasets as destination/SeriesInstanceUID/SOPInstanceUID.ext with an AHISeriesRenderer : the Modality LUT and the VOI window are applied to each series as a whole , and the images are encoded by a pool of processes.
+
+        :param datasets: The pydicom datasets , e.g. the list returned by DICOMizeImageSet.
+        :param destination: The folder the images are saved to.
+        :param image_format: Optional format of the images , "png" , "jpeg" or "webp". Will default to "png".
+        :param window: Optional ( center , width ) VOI window used for all the series. Will default to the WindowCenter and WindowWidth of each series , or to the range of its rescaled values.
+        :param quality: Optional quality of the JPEG and WebP images. Will default to 90.
+        :return: The paths of the images saved , None for the frames which could not be saved.
+        """ 
+        from .AHISeriesRenderer import AHISeriesRenderer
+        series = {}
+        for ds in datasets:
+            series.setdefault(str(ds.SeriesInstanceUID) , []).append(ds)
+        paths = []
+        with AHISeriesRenderer(self.DICOMizerProcessCount , image_format , quality) as renderer:
+            for seriesUid , seriesDatasets in series.items():
+                seriesDatasets.sort(key = self.getInstanceNumberInDICOM)
+                try:
+                    paths += renderer.renderSeries(seriesDatasets , os.path.join(destination , seriesUid) , window)
+                except Exception as err:
+                    self.logger.error(f"[{__name__}][saveSeriesAsImages] - Series {seriesUid} could not be rendered : {err}")
+        return paths
+
+    def saveAsPngPIL(self, ds: Dataset , destination : str , max_size : int = None):
         """
         saveAsPngPIL(ds : pydicom.Dataset , destination : str).
         Saves a PNG representation of the DICOM object to the specified destination.
 
         :param ds: The pydicom Dataset representing the DICOM object.
         :param destination: the file path where the file needs to be dumped to. the file path must include the file name and extension.
+        :param max_size: Optional , the image is scaled down to fit in max_size x max_size.
         """ 
         try:
             folder_path = os.path.dirname(destination)
             os.makedirs( folder_path  , exist_ok=True)
             import numpy as np
-            shape = ds.pixel_array.shape
-            image_2d = ds.pixel_array.astype(float)
-            image_2d_scaled = (np.maximum(image_2d,0) / image_2d.max()) * 255.0
-            image_2d_scaled = np.uint8(image_2d_scaled)
+            from PIL import Image
+            pixels = ds.pixel_array
+            maximum = max(pixels.max() , 0)
+            if np.issubdtype(pixels.dtype , np.integer) and maximum < 65536:
+                # the stored values are scaled with a LUT , without a float copy of the image.
+                lut = (np.arange(maximum + 1 , dtype = np.float32) * np.float32(255.0 / max(maximum , 1))).astype(np.uint8)
+                image_2d_scaled = lut[np.maximum(pixels , 0)]
+            else:
+                image_2d_scaled = (np.maximum(pixels , 0).astype(np.float32) * np.float32(255.0 / maximum if maximum > 0 else 0.0)).astype(np.uint8)
             if 'PhotometricInterpretation' in ds and ds.PhotometricInterpretation == "MONOCHROME1":
                 image_2d_scaled = np.max(image_2d_scaled) - image_2d_scaled
             img = Image.fromarray(image_2d_scaled)
+            if max_size is not None:
+                img.thumbnail((max_size , max_size))
             img.save(destination, 'png')
         except Exception as err:
             self.logger.error(f"[{__name__}][saveAsPngPIL] - {err}")
@@ -322,17 +1146,26 @@ class AHItoDICOM:
     #     seriesList = self.getSeriesList(AHI_metadata=AHI_metadata)
     #     return seriesList  
 
-    def _initFetchAndDICOMizeProcesses(self, AHI_metadata):
-        self.frameDICOMizerThreadList = []
-        self.frameDICOMizerThreadList = []
-        self.frameFetcherThreadList.clear()
+    def _initFetchAndDICOMizeProcesses(self):
+        self.frameDecoderThreadList.clear()
         self.frameDICOMizerThreadList.clear()
+        # Shared work queues : any idle process takes the next job, so a slow instance does not hold back the jobs queued after it.
+        self.DecodeJobs = self.context.Queue()
+        self.DecodedFrames = self.context.Queue()
+        self.DICOMizeJobs = self.context.Queue()
+        self.CompletedJobs = self.context.Queue()
+        if self.sharedMemoryTransport:
+            # the processes share the resource tracker of the parent process , which unlinks the segments left over if the parent process dies.
+            resource_tracker.ensure_running()
         for x in range(self.fetcherProcessCount): 
-            self.logger.debug("[DICOMize] - Spawning AHIFrameFetcher thread # "+str(x))
-            self.frameFetcherThreadList.append(AHIFrameFetcher(str(x), self.aws_access_key , self.aws_access_key , self.AHI_endpoint  )) 
+            self.logger.debug("[DICOMize] - Spawning AHIFrameDecoder thread # "+str(x))
+            self.frameDecoderThreadList.append(AHIFrameDecoder(str(x) , self.DecodeJobs , self.DecodedFrames , context = self.context)) 
         for x in range(self.DICOMizerProcessCount):
             self.logger.debug("[DICOMize] - Spawning AHIDICOMizer thread # "+str(x))
-            self.frameDICOMizerThreadList.append(AHIDataDICOMizer(str(x) , AHI_metadata )) 
+            self.frameDICOMizerThreadList.append(AHIDataDICOMizer(str(x) , DICOMizeJobsCompleted = self.CompletedJobs , DICOMizeJobs = self.DICOMizeJobs , context = self.context)) 
+        # the network threads are started once all the processes are forked.
+        self.frameScheduler = AHIFrameScheduler(self._getClient() , self.DecodeJobs , self.DecodedFrames , self.DICOMizeJobs , self.networkConcurrency , self.frameCache , self.sharedMemoryTransport , self.fetchController , self.metrics , AHIMemoryBudget(self.memoryBudgetSize // 4) if self.memoryBudgetSize is not None else None)
+        self.processes_started = True
     
     def saveAsDICOM(self, ds : pydicom.Dataset , destination : str = './out' ) -> bool:
         """
@@ -343,9 +1176,11 @@ class AHItoDICOM:
         :param destination: the folder path where to save the DICOM file to. The file name will be the SOPInstanceUID of the DICOM object suffixed by '.dcm'.
         """ 
         try:
-            os.makedirs( destination  , exist_ok=True)
+            if destination not in self.createdFolders:
+                os.makedirs( destination  , exist_ok=True)
+                self.createdFolders.add(destination)
             filename = os.path.join( destination , ds["SOPInstanceUID"].value)
-            ds.save_as(f"{filename}.dcm", write_like_original=False)
+            saveAs(ds , f"{filename}.dcm")
         except Exception as err:
             self.logger.error(f"[{__name__}][saveAsDICOM] - {err}")
             return False
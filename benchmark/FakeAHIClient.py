@@ -0,0 +1,174 @@
+"""
+FakeAHIClient : A local stand-in for the boto3 medical-imaging client, serving generated ImageSets.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import gzip
+import io
+import json
+import random
+import threading
+import time
+import numpy as np
+from botocore.exceptions import ClientError
+from openjpeg import encode
+try: # HTJ2K encoder , the J2K frames are generated without it.
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+
+# transfer syntaxes of the generated frames , stored in the metadata as StoredTransferSyntaxUID.
+TRANSFER_SYNTAXES = { "j2k" : "1.2.840.10008.1.2.4.90" , "htj2k" : "1.2.840.10008.1.2.4.202" }
+
+
+class FakeAHIClient:
+
+    def __init__(self, instance_count : int = 10 , rows : int = 64 , columns : int = 64 , frames_per_instance : int = 1 , latency : float = 0.0 , datastore_id : str = "fakedatastore" , image_set_id : str = "fakeimageset" , image_set_count : int = 1 , series_per_image_set : int = 1 , search_page_size : int = 50 , metadata_latency : float = 0.0 , throttle_rate : float = 0.0 , max_concurrent_requests : int = None , bandwidth : float = None , codec : str = "j2k" , pattern : str = "ramp"):
+        """
+        Local stand-in for the medical-imaging client. It serves one study of image_set_count ImageSets , each holding series_per_image_set series of instance_count instances of rows x columns 16 bits frames.
+        The first ImageSet is image_set_id , the next ones are suffixed with their number.
+
+        :param instance_count: Number of instances in the series.
+        :param rows: Number of rows of each frame.
+        :param columns: Number of columns of each frame.
+        :param frames_per_instance: Number of frames in each instance.
+        :param latency: Time in seconds added to each get_image_frame call.
+        :param metadata_latency: Time in seconds added to each get_image_set_metadata call.
+        :param search_page_size: Number of ImageSets returned by each search_image_sets page.
+        :param throttle_rate: Ratio of the get_image_frame calls failing with a ThrottlingException , at random.
+        :param max_concurrent_requests: Number of get_image_frame calls served at the same time , the calls over it failing with a ThrottlingException.
+        :param bandwidth: Bytes per second each frame and metadata response is transferred at , added to the latency. None for an instant transfer.
+        :param codec: "j2k" for frames encoded by OpenJPEG , or "htj2k" for frames encoded by OpenJPH like the ones stored by AHI , which requires imagecodecs.
+        :param pattern: "ramp" for a gradient compressing to a few KB , or "phantom" for a noisy disc compressing about as much as a CT slice.
+        """
+        self.instance_count = instance_count
+        self.rows = rows
+        self.columns = columns
+        self.frames_per_instance = frames_per_instance
+        self.latency = latency
+        self.datastore_id = datastore_id
+        self.image_set_id = image_set_id
+        self.image_set_ids = [image_set_id] + [ f"{image_set_id}{n}" for n in range(1 , image_set_count) ]
+        self.series_per_image_set = series_per_image_set
+        self.search_page_size = search_page_size
+        self.metadata_latency = metadata_latency
+        self.throttle_rate = throttle_rate
+        self.max_concurrent_requests = max_concurrent_requests
+        self.bandwidth = bandwidth
+        if codec not in TRANSFER_SYNTAXES:
+            raise ValueError(f"Unknown codec {codec} , expected one of {list(TRANSFER_SYNTAXES)}.")
+        if codec == "htj2k" and imagecodecs is None:
+            raise ValueError("imagecodecs is required to generate HTJ2K frames.")
+        self.codec = codec
+        self.study_instance_uid = "1.2.826.0.1.3680043.8.498.1"
+        self.lock = threading.Lock()
+        self.concurrent_requests = 0
+        self.statistics = { "Requests" : 0 , "Throttled" : 0 , "MaxConcurrentRequests" : 0 }
+        pixels = self.buildPixels(pattern)
+        self.frameBlob = imagecodecs.htj2k_encode(pixels) if codec == "htj2k" else encode(pixels , bits_stored=16)
+        self.metadataBlobs = { current_image_set : gzip.compress(json.dumps(self.buildMetadata(n)).encode()) for n , current_image_set in enumerate(self.image_set_ids) }
+        self.metadataBlob = self.metadataBlobs[image_set_id]
+
+    def buildPixels(self, pattern : str):
+        if pattern == "phantom":
+            # a disc of soft tissue in air with Gaussian noise , fixed seed so all the runs serve the same frames.
+            y , x = np.ogrid[:self.rows , :self.columns]
+            disc = (y - self.rows / 2) ** 2 + (x - self.columns / 2) ** 2 < (min(self.rows , self.columns) * 0.4) ** 2
+            noise = np.random.default_rng(0).normal(0 , 20 , (self.rows , self.columns))
+            return (np.where(disc , 40 , -1000) + noise).astype(np.int16)
+        return (np.arange(self.rows * self.columns , dtype=np.int16).reshape(self.rows , self.columns) % 2048) - 1024
+
+    def transfer(self, size : int):
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+
+    def buildMetadata(self, image_set_number : int = 0):
+        study_uid = self.study_instance_uid
+        series = {}
+        for s in range(self.series_per_image_set):
+            series_number = image_set_number * self.series_per_image_set + s + 1
+            series_uid = f"{study_uid}.{series_number}"
+            series[series_uid] = {
+                "DICOM" : { "SeriesInstanceUID" : series_uid , "SeriesNumber" : str(series_number) , "Modality" : "CT" , "SeriesDescription" : "Fake series" },
+                "Instances" : self.buildInstances(series_uid)
+            }
+        return {
+            "SchemaVersion" : "1.1",
+            "DatastoreID" : self.datastore_id,
+            "ImageSetID" : self.image_set_ids[image_set_number],
+            "Patient" : { "DICOM" : { "PatientName" : "FAKE^PATIENT" , "PatientID" : "FAKE001" , "PatientSex" : "O" , "PatientBirthDate" : "19700101" } },
+            "Study" : {
+                "DICOM" : { "StudyInstanceUID" : study_uid , "StudyDate" : "20230101" , "StudyTime" : "120000" , "StudyID" : "1" , "AccessionNumber" : "ACC001" , "StudyDescription" : "Fake study" },
+                "Series" : series
+            }
+        }
+
+    def buildInstances(self, series_uid : str):
+        instances = {}
+        for x in range(self.instance_count):
+            sop_uid = f"{series_uid}.{x + 1}"
+            tags = {
+                "SOPClassUID" : "1.2.840.10008.5.1.4.1.1.2",
+                "SOPInstanceUID" : sop_uid,
+                "InstanceNumber" : str(x + 1),
+                "Rows" : self.rows,
+                "Columns" : self.columns,
+                "BitsAllocated" : 16,
+                "BitsStored" : 16,
+                "HighBit" : 15,
+                "PixelRepresentation" : 1,
+                "SamplesPerPixel" : 1,
+                "PhotometricInterpretation" : "MONOCHROME2",
+                "ImagePositionPatient" : ["0", "0", str(x)],
+                "ImageOrientationPatient" : ["1", "0", "0", "0", "1", "0"],
+                "PixelSpacing" : ["0.5", "0.5"],
+                "SliceThickness" : "1",
+                "RescaleIntercept" : "0",
+                "RescaleSlope" : "1",
+                "WindowCenter" : ["40"],
+                "WindowWidth" : ["400"],
+            }
+            if self.frames_per_instance > 1:
+                tags["NumberOfFrames"] = str(self.frames_per_instance)
+            frames = [ { "ID" : f"{x}-{f}" , "FrameSizeInBytes" : self.rows * self.columns * 2 } for f in range(self.frames_per_instance) ]
+            instances[sop_uid] = { "DICOM" : tags , "DICOMVRs" : {} , "StoredTransferSyntaxUID" : TRANSFER_SYNTAXES[self.codec] , "ImageFrames" : frames }
+        return instances
+
+    def search_image_sets(self, datastoreId : str , searchCriteria : dict = None , nextToken : str = None , **kwargs):
+        start = int(nextToken) if nextToken is not None else 0
+        end = start + self.search_page_size
+        result = { "imageSetsMetadataSummaries" : [ { "imageSetId" : current_image_set , "version" : 1 } for current_image_set in self.image_set_ids[start:end] ] }
+        if end < len(self.image_set_ids):
+            result["nextToken"] = str(end)
+        return result
+
+    def get_image_set(self, datastoreId : str , imageSetId : str , **kwargs):
+        return { "datastoreId" : datastoreId , "imageSetId" : imageSetId , "versionId" : "1" , "imageSetState" : "ACTIVE" }
+
+    def get_image_set_metadata(self, datastoreId : str , imageSetId : str , **kwargs):
+        if self.metadata_latency > 0:
+            time.sleep(self.metadata_latency)
+        blob = self.metadataBlob if imageSetId == self.image_set_id else self.metadataBlobs[imageSetId]
+        self.transfer(len(blob))
+        return { "imageSetMetadataBlob" : io.BytesIO(blob) , "contentType" : "application/json" , "contentEncoding" : "gzip" }
+
+    def get_image_frame(self, datastoreId : str , imageSetId : str , imageFrameInformation : dict):
+        with self.lock:
+            self.statistics["Requests"] += 1
+            throttled = random.random() < self.throttle_rate or (self.max_concurrent_requests is not None and self.concurrent_requests >= self.max_concurrent_requests)
+            if throttled:
+                self.statistics["Throttled"] += 1
+            else:
+                self.concurrent_requests += 1
+                self.statistics["MaxConcurrentRequests"] = max(self.statistics["MaxConcurrentRequests"] , self.concurrent_requests)
+        if throttled:
+            raise ClientError({ "Error" : { "Code" : "ThrottlingException" , "Message" : "Rate exceeded" } , "ResponseMetadata" : { "HTTPStatusCode" : 429 } } , "GetImageFrame")
+        try:
+            if self.latency > 0:
+                time.sleep(self.latency)
+            self.transfer(len(self.frameBlob))
+        finally:
+            with self.lock:
+                self.concurrent_requests -= 1
+        return { "imageFrameBlob" : io.BytesIO(self.frameBlob) , "contentType" : "application/octet-stream" }
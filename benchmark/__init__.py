@@ -0,0 +1,5 @@
+"""
+Benchmarks for the AHItoDICOMInterface module. They run offline against FakeAHIClient, a local stand-in for the medical-imaging client.
+
+SPDX-License-Identifier: Apache-2.0
+"""
@@ -0,0 +1,40 @@
+"""
+client_benchmark.py : Compares the time and the memory of 50 AHIClientFactory calls, with a new client created for each call and with the client cached by the process.
+
+Usage : python -m benchmark.client_benchmark
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import time
+import tracemalloc
+from AHItoDICOMInterface.AHIClientFactory import AHIClientFactory
+
+
+def run(name : str , call_count : int , cached : bool):
+    tracemalloc.start()
+    clients = []
+    start_time = time.perf_counter()
+    for x in range(call_count):
+        if not cached:
+            AHIClientFactory.clear()
+        # the clients are kept , as the callers holding them do.
+        clients.append(AHIClientFactory())
+    elapsed = time.perf_counter() - start_time
+    current , peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>10} {call_count:>8} {elapsed:>10.3f} {elapsed / call_count * 1000:>12.2f} {current / 1024 ** 2:>12.1f}")
+    AHIClientFactory.clear()
+
+
+def main():
+    # the clients are only created , no request is sent : any region will do.
+    os.environ.setdefault("AWS_DEFAULT_REGION" , "us-east-1")
+    call_count = 50
+    print(f"{'client':>10} {'calls':>8} {'time (s)':>10} {'ms per call':>12} {'memory (MB)':>12}")
+    run("new" , call_count , False)
+    run("cached" , call_count , True)
+
+
+if __name__ == "__main__":
+    main()
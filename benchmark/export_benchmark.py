@@ -0,0 +1,50 @@
+"""
+export_benchmark.py : Compares the time and peak memory of writing an ImageSet to the file system with DICOMizeImageSet followed by saveAsDICOM, and with exportImageSetToDirectory.
+
+Usage : python -m benchmark.export_benchmark
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+from benchmark.FakeAHIClient import FakeAHIClient
+
+
+def run(method : str , instance_count : int , fsync_batch_size : int):
+    # each method is measured in its own interpreter, so the peak RSS of one does not hide the other.
+    client = FakeAHIClient(instance_count=instance_count , rows=512 , columns=512 , latency=0.01)
+    destination = tempfile.mkdtemp()
+    try:
+        with AHItoDICOM(fetcher_process_count=2 , dicomizer_process_count=2 , ahi_client=client) as helper:
+            start_time = time.perf_counter()
+            if method == "saveAsDICOM":
+                for ds in helper.DICOMizeImageSet(datastore_id=client.datastore_id , image_set_id=client.image_set_id):
+                    helper.saveAsDICOM(ds , destination)
+            else:
+                helper.exportImageSetToDirectory(client.datastore_id , client.image_set_id , destination , fsync_batch_size=fsync_batch_size)
+            elapsed = time.perf_counter() - start_time
+    finally:
+        shutil.rmtree(destination)
+    # ru_maxrss is in KiB on Linux.
+    parent_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    name = method if method == "saveAsDICOM" else f"{method} fsync={fsync_batch_size}"
+    print(f"{name:>34} {instance_count:>10} {elapsed:>10.2f} {parent_rss:>12.0f}")
+
+
+def main():
+    instance_count = 500
+    print(f"{'method':>34} {'instances':>10} {'time (s)':>10} {'parent (MB)':>12}")
+    for method , fsync_batch_size in [ ("saveAsDICOM" , 0) , ("exportImageSetToDirectory" , 0) , ("exportImageSetToDirectory" , 64) ]:
+        subprocess.run([sys.executable , "-m" , "benchmark.export_benchmark" , method , str(instance_count) , str(fsync_batch_size)] , check=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(sys.argv[1] , int(sys.argv[2]) , int(sys.argv[3]))
+    else:
+        main()
@@ -0,0 +1,91 @@
+"""
+header_benchmark.py : Compares the DICOM header build rate of a 2,000 instances series, with the per instance build used before and with the per series templates.
+
+Usage : python -m benchmark.header_benchmark
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import base64
+import time
+import pydicom
+from pydicom import Dataset , DataElement
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+from AHItoDICOMInterface.AHIDataDICOMizer import AHIDataDICOMizer
+from benchmark.FakeAHIClient import FakeAHIClient
+
+
+def enrich(metadata : dict):
+    # The generated ImageSet only holds a few tags per level, the levels are filled up to the size of a typical CT series.
+    metadata["Patient"]["DICOM"].update({ "PatientAge" : "052Y" , "PatientWeight" : "70" , "PatientSize" : "1.75" , "OtherPatientIDs" : "OTHER001" , "EthnicGroup" : "" , "PatientComments" : "none" })
+    metadata["Study"]["DICOM"].update({ "ReferringPhysicianName" : "REF^PHYSICIAN" , "InstitutionName" : "Fake hospital" , "InstitutionAddress" : "1 fake street" , "StationName" : "CT01" , "NameOfPhysiciansReadingStudy" : "READ^PHYSICIAN" , "AdmittingDiagnosesDescription" : "none" , "RequestingPhysician" : "REQ^PHYSICIAN" , "RequestedProcedureDescription" : "CT chest" , "ProcedureCodeSequence" : [ { "CodeValue" : "CT0101" , "CodingSchemeDesignator" : "LOCAL" , "CodeMeaning" : "CT chest" } ] })
+    for series in metadata["Study"]["Series"].values():
+        series["DICOM"].update({ "Manufacturer" : "FAKE" , "ManufacturerModelName" : "Fake CT" , "DeviceSerialNumber" : "12345" , "SoftwareVersions" : "1.0" , "ProtocolName" : "Chest" , "BodyPartExamined" : "CHEST" , "PatientPosition" : "HFS" , "FrameOfReferenceUID" : "1.2.826.0.1.3680043.8.498.2" , "PositionReferenceIndicator" : "" , "KVP" : "120" , "DataCollectionDiameter" : "500" , "ReconstructionDiameter" : "350" , "DistanceSourceToDetector" : "1040" , "DistanceSourceToPatient" : "570" , "GantryDetectorTilt" : "0" , "TableHeight" : "150" , "RotationDirection" : "CW" , "ExposureTime" : "500" , "XRayTubeCurrent" : "200" , "FilterType" : "BODY FILTER" , "GeneratorPower" : "24" , "FocalSpots" : "1.2" , "ConvolutionKernel" : "B30f" , "SeriesDate" : "20230101" , "SeriesTime" : "120000" , "RequestAttributesSequence" : [ { "RequestedProcedureID" : "1" , "ScheduledProcedureStepID" : "1" } ] , "00091001" : "private creator value" , "00091002" : base64.b64encode(bytes(256)).decode() })
+        for instance in series["Instances"].values():
+            instance["DICOMVRs"] = { "00091001" : "LO" , "00091002" : "OB" }
+
+
+def legacy_header(InstanceMetadata : dict):
+    # the header build used before : every level is compiled for every instance , with a dictionary lookup per tag and a linear scan of the private tags VRs.
+    vrlist = [ [ key , value ] for key , value in InstanceMetadata["DICOMVRs"].items() ]
+    ds = FileDataset(None, {}, file_meta=FileMetaDataset(), preamble=b"\0" * 128)
+    for level in ["Patient" , "Study" , "Series" , "Instance"]:
+        legacy_tags(InstanceMetadata[level] , ds , vrlist)
+    return ds
+
+
+def legacy_tags(tagLevel : dict , ds , vrlist : list):
+    for theKey in tagLevel:
+        try:
+            tagvr = pydicom.datadict.dictionary_VR(theKey)
+        except:
+            tagvr = None
+            for vr in vrlist:
+                if theKey == vr[0]:
+                    tagvr = vr[1]
+        datavalue = tagLevel[theKey]
+        if tagvr == 'SQ':
+            seqs = []
+            for underSeq in tagLevel[theKey]:
+                seqds = Dataset()
+                legacy_tags(underSeq , seqds , vrlist)
+                seqs.append(seqds)
+            datavalue = Sequence(seqs)
+        if tagvr in [ 'OB' , 'OD' , 'OF', 'OL', 'OW', 'UN' , 'OB or OW' ]:
+            datavalue = base64.decodebytes(datavalue.encode('utf-8'))
+        ds.add(DataElement(theKey , tagvr , datavalue))
+
+
+def main():
+    client = FakeAHIClient(instance_count=2000 , rows=64 , columns=64)
+    metadata = client.buildMetadata()
+    enrich(metadata)
+    helper = AHItoDICOM(ahi_client=client)
+    series_uid = list(metadata["Study"]["Series"].keys())[0]
+    jobs = list(helper.getImageFrames(client.datastore_id , client.image_set_id , metadata , series_uid))
+    dicomizer = AHIDataDICOMizer("benchmark")
+    try:
+        print(f"{'build':>24} {'instances':>10} {'time (ms)':>12} {'instances/s':>12}")
+        start_time = time.perf_counter()
+        for job in jobs:
+            legacy_header(job["Metadata"])
+        report("per instance (before)" , len(jobs) , time.perf_counter() - start_time)
+        start_time = time.perf_counter()
+        for job in jobs:
+            dicomizer.DICOMizeJob(dict(job))
+        report("no template" , len(jobs) , time.perf_counter() - start_time)
+        start_time = time.perf_counter()
+        for job in jobs:
+            dicomizer.DICOMizeJob(dict(job , ExportId = 1))
+        report("series template" , len(jobs) , time.perf_counter() - start_time)
+    finally:
+        dicomizer.Dispose()
+
+
+def report(name : str , count : int , elapsed : float):
+    print(f"{name:>24} {count:>10} {elapsed * 1000:>12.1f} {count / elapsed:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
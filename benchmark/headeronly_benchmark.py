@@ -0,0 +1,64 @@
+"""
+headeronly_benchmark.py : Builds the headers of an ImageSet of 4 series of 5,000 instances , from a fake service answering instantly , with the in-process header only path : as pydicom datasets , DICOM JSON and Part10 headers ,
+then as the same datasets serialized by pydicom one by one , and exports them as DICOM JSON series files and Part10 files. The headers are built on one core , without any worker process.
+
+Usage : python -m benchmark.headeronly_benchmark [instances per series]
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import io
+import json
+import shutil
+import sys
+import tempfile
+import time
+from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+from AHItoDICOMInterface.AHIDICOMWriter import saveAs
+from benchmark.FakeAHIClient import FakeAHIClient
+
+
+def measure(label : str , function) -> float:
+    start_time = time.perf_counter()
+    count = function()
+    elapsed = time.perf_counter() - start_time
+    print(f"{label:>36} {count:>10} {elapsed:>10.2f} {count / elapsed:>10.0f}")
+    return elapsed
+
+
+def serializeAll(datasets , serialize) -> int:
+    count = 0
+    for ds in datasets:
+        serialize(ds)
+        count += 1
+    return count
+
+
+def toPart10(ds) -> bytes:
+    f = io.BytesIO()
+    saveAs(ds , f)
+    return f.getvalue()
+
+
+def main():
+    instance_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    client = FakeAHIClient(instance_count=instance_count , series_per_image_set=4)
+    helper = AHItoDICOM(ahi_client=client)
+    start_time = time.perf_counter()
+    helper.getMetadata(client.datastore_id , client.image_set_id)
+    print(f"metadata of {4 * instance_count} instances fetched and parsed in {(time.perf_counter() - start_time) * 1000:.0f} ms , included in each measure below.")
+    print(f"{'output':>36} {'instances':>10} {'time (s)':>10} {'inst/s':>10}")
+    for output in [ "dataset" , "json" , "part10" ]:
+        measure(f"iterImageSetHeaders {output}" , lambda : serializeAll(helper.iterImageSetHeaders(client.datastore_id , client.image_set_id , output) , lambda header : None))
+    measure("datasets + pydicom to_json" , lambda : serializeAll(helper.iterImageSetHeaders(client.datastore_id , client.image_set_id , "dataset") , lambda ds : json.dumps(ds.to_json_dict())))
+    measure("datasets + pydicom save_as" , lambda : serializeAll(helper.iterImageSetHeaders(client.datastore_id , client.image_set_id , "dataset") , toPart10))
+    destination = tempfile.mkdtemp()
+    try:
+        measure("exportImageSetToDICOMJSON" , lambda : helper.exportImageSetToDICOMJSON(client.datastore_id , client.image_set_id , f"{destination}/json")["Instances"])
+        measure("exportImageSetToDirectory header_only" , lambda : helper.exportImageSetToDirectory(client.datastore_id , client.image_set_id , f"{destination}/dcm" , header_only=True , fsync_batch_size=0)["Files"])
+    finally:
+        shutil.rmtree(destination)
+    print(f"worker processes started : {helper.processes_started} , {helper.getHeaderEncoder().getStatistics()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+latency_benchmark.py : Measures the time-to-first-instance and the total time to DICOMize small ImageSets with a warm process pool.
+
+Usage : python -m benchmark.latency_benchmark
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import statistics
+import time
+from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+from benchmark.FakeAHIClient import FakeAHIClient
+
+
+def measure(helper : AHItoDICOM , client : FakeAHIClient , header_only : bool , repeat : int):
+    first_times = []
+    total_times = []
+    for x in range(repeat):
+        start_time = time.perf_counter()
+        first_time = None
+        count = 0
+        for ds in helper.iterDICOMizeImageSet(datastore_id=client.datastore_id , image_set_id=client.image_set_id , header_only=header_only):
+            if first_time is None:
+                first_time = time.perf_counter() - start_time
+            count += 1
+        total_times.append(time.perf_counter() - start_time)
+        first_times.append(first_time)
+    return statistics.median(first_times) , statistics.median(total_times) , count
+
+
+def main():
+    repeat = 5
+    print(f"{'instances':>10} {'header_only':>12} {'first (ms)':>12} {'total (ms)':>12}")
+    for instance_count in [1, 5, 20]:
+        client = FakeAHIClient(instance_count=instance_count , rows=64 , columns=64 , latency=0.005)
+        with AHItoDICOM(fetcher_process_count=4 , dicomizer_process_count=2 , ahi_client=client) as helper:
+            for header_only in [True, False]:
+                first_time , total_time , count = measure(helper , client , header_only , repeat)
+                print(f"{count:>10} {str(header_only):>12} {first_time * 1000:>12.1f} {total_time * 1000:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+memory_benchmark.py : Stress test of the memory budget. Exports 12 instances of 64 512x512 frames (400 MB of pixels) from a fake service answering instantly to a consumer slower than the pipeline ,
+without budget and with budgets of 128 and 256 MB , and reports the peak of the memory held by the data in flight : the RSS of the parent and worker processes over their RSS before the export ,
+plus the shared memory segments of the instances. The instance held by the consumer is part of it , the budget only covering the instances in the pipeline.
+With a budget , the run fails when the peak goes over the budget plus BASELINE_ALLOWANCE : the instance held by the consumer and 32 MB for the memory the processes keep once warmed up ( imported codecs , allocator arenas ).
+
+Usage : python -m benchmark.memory_benchmark
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import subprocess
+import sys
+import threading
+import time
+from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+from benchmark.FakeAHIClient import FakeAHIClient , imagecodecs
+
+
+INSTANCE_BYTES = 64 * 512 * 512 * 2
+BASELINE_ALLOWANCE = INSTANCE_BYTES + 32 * 1024 * 1024
+
+
+def getRSS(pid : int) -> int:
+    # resident bytes of the process but its shared memory pages , counted once in getSharedMemoryUsed() , 0 once it exited.
+    rss = 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("RssAnon:") or line.startswith("RssFile:"):
+                    rss += int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return rss
+
+
+def getSharedMemoryUsed() -> int:
+    stats = os.statvfs("/dev/shm")
+    return (stats.f_blocks - stats.f_bfree) * stats.f_frsize
+
+
+class MemorySampler(threading.Thread):
+
+    def __init__(self, pids : list):
+        super().__init__(daemon=True)
+        self.pids = pids
+        self.baseline = sum(getRSS(pid) for pid in pids) + getSharedMemoryUsed()
+        self.peak = 0
+        self.stopping = False
+
+    def run(self):
+        while not self.stopping:
+            self.peak = max(self.peak , sum(getRSS(pid) for pid in self.pids) + getSharedMemoryUsed() - self.baseline)
+            time.sleep(0.005)
+
+
+def run(budget_mb : int):
+    client = FakeAHIClient(instance_count=12 , frames_per_instance=64 , rows=512 , columns=512 , pattern="phantom" , codec="htj2k" if imagecodecs is not None else "j2k")
+    budget = budget_mb * 1024 * 1024 if budget_mb > 0 else None
+    with AHItoDICOM(fetcher_process_count=1 , dicomizer_process_count=1 , ahi_client=client , memory_budget=budget) as helper:
+        pids = [ os.getpid() ] + [ worker.process.pid for worker in helper.frameDecoderThreadList + helper.frameDICOMizerThreadList ]
+        sampler = MemorySampler(pids)
+        sampler.start()
+        start_time = time.perf_counter()
+        count = 0
+        for ds in helper.iterDICOMizeImageSet(datastore_id=client.datastore_id , image_set_id=client.image_set_id , order="completion"):
+            time.sleep(1.0) # e.g. a slow upload of each instance.
+            count += 1
+            del ds
+        elapsed = time.perf_counter() - start_time
+        sampler.stopping = True
+        sampler.join()
+        statistics = helper.getMetrics()["MemoryBudget"]
+    label = f"{budget_mb} MB" if budget is not None else "none"
+    waits = sum(budget_statistics["Waits"] for budget_statistics in statistics.values()) if budget is not None else 0
+    print(f"{label:>10} {count:>10} {elapsed:>10.2f} {sampler.peak / 1024 / 1024:>12.0f} {waits:>8}")
+    if budget is not None and sampler.peak > budget + BASELINE_ALLOWANCE:
+        sys.exit(f"peak of {sampler.peak / 1024 / 1024:.0f} MB over the {budget_mb} MB budget plus its {BASELINE_ALLOWANCE / 1024 / 1024:.0f} MB allowance.")
+
+
+def main():
+    print(f"{'budget':>10} {'instances':>10} {'time (s)':>10} {'peak (MB)':>12} {'waits':>8}")
+    for budget_mb in [ 0 , 256 , 128 ]:
+        subprocess.run([ sys.executable , "-m" , "benchmark.memory_benchmark" , str(budget_mb) ] , check=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,48 @@
+"""
+metrics_benchmark.py : Prints the per stage breakdown of the export of a 300 instances ImageSet to the file system against a fake service answering each frame in 20 ms , and the cost of recording one duration.
+
+Usage : python -m benchmark.metrics_benchmark
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import shutil
+import tempfile
+import time
+from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+from AHItoDICOMInterface.AHIMetrics import AHIMetrics , STAGES
+from benchmark.FakeAHIClient import FakeAHIClient
+
+
+def main():
+    client = FakeAHIClient(instance_count=300 , rows=256 , columns=256 , latency=0.02 , metadata_latency=0.1)
+    snapshots = []
+    metrics = AHIMetrics(callback=snapshots.append , interval=1.0)
+    destination = tempfile.mkdtemp()
+    try:
+        with AHItoDICOM(fetcher_process_count=2 , dicomizer_process_count=2 , ahi_client=client , metrics=metrics) as helper:
+            start_time = time.perf_counter()
+            helper.exportImageSetToDirectory(client.datastore_id , client.image_set_id , destination)
+            elapsed = time.perf_counter() - start_time
+            snapshot = helper.getMetrics()
+    finally:
+        shutil.rmtree(destination , ignore_errors=True)
+    print(f"export of 300 instances : {elapsed:.2f} s , {len(snapshots)} snapshots pushed to the callback")
+    print(f"{'stage':>18} {'count':>8} {'total (s)':>10} {'p50 (ms)':>10} {'p90 (ms)':>10} {'p99 (ms)':>10}")
+    for stage in STAGES:
+        histogram = snapshot["Stages"][stage]
+        if histogram["Count"] == 0:
+            continue
+        print(f"{stage:>18} {histogram['Count']:>8} {histogram['Sum']:>10.2f} {histogram['P50'] * 1000:>10.1f} {histogram['P90'] * 1000:>10.1f} {histogram['P99'] * 1000:>10.1f}")
+    for worker in snapshot["Workers"]:
+        print(f"{worker['Worker']:>18} {worker['JobsDone']:>8} jobs , busy {worker['Utilization'] * 100:.0f}%")
+
+    # cost of one observe() call , made a few times per frame and per instance.
+    count = 200000
+    start_time = time.perf_counter()
+    for x in range(count):
+        metrics.observe("Decode" , 0.001)
+    print(f"observe() : {(time.perf_counter() - start_time) / count * 1e9:.0f} ns per call")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+pixeldata_benchmark.py : Compares the multi-frame PixelData assembly by bytes concatenation with the decode into a preallocated buffer.
+
+Usage : python -m benchmark.pixeldata_benchmark
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import io
+import time
+import tracemalloc
+from openjpeg import decode
+from AHItoDICOMInterface.AHIFrameFetcher import DecodeFrame
+from benchmark.FakeAHIClient import FakeAHIClient
+
+
+def concatenation_path(blob : bytes , frame_count : int):
+    # the assembly used before : copy of the blob in a BytesIO, copy of the decoded array in bytes, and concatenation of each frame to the previous ones.
+    pixels = b''
+    for x in range(frame_count):
+        b = io.BytesIO()
+        b.write(blob)
+        b.seek(0)
+        pixels = pixels + decode(b).tobytes()
+    return pixels
+
+
+def preallocated_path(blob : bytes , frame_count : int , frame_length : int):
+    pixels = bytearray(frame_length * frame_count)
+    view = memoryview(pixels)
+    for x in range(frame_count):
+        DecodeFrame(blob , out = view[x * frame_length : (x + 1) * frame_length])
+    return pixels
+
+
+def measure(function , *args):
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start_time
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed , peak
+
+
+def main():
+    rows = columns = 64
+    client = FakeAHIClient(instance_count=1 , rows=rows , columns=columns)
+    frame_length = rows * columns * 2
+    print(f"{'frames':>8} {'path':>14} {'time (ms)':>12} {'peak (MB)':>12}")
+    for frame_count in [100, 500, 1000]:
+        for name , function , args in [ ("concatenation" , concatenation_path , (client.frameBlob , frame_count)) , ("preallocated" , preallocated_path , (client.frameBlob , frame_count , frame_length)) ]:
+            elapsed , peak = measure(function , *args)
+            print(f"{frame_count:>8} {name:>14} {elapsed * 1000:>12.1f} {peak / 1048576:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
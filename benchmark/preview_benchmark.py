@@ -0,0 +1,41 @@
+"""
+preview_benchmark.py : Measures the decode time and the decoded size of one 512x512 16 bits frame at each resolution level.
+
+Usage : python -m benchmark.preview_benchmark
+
+The HTJ2K frames are only decoded at a reduced resolution by OpenJPH when imagecodecs is installed : without it , or for the J2K frames , the frame is decoded at full resolution and averaged down.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import time
+import numpy as np
+from openjpeg import encode
+from AHItoDICOMInterface.AHIFrameFetcher import DecodeFrame , GetImagecodecs
+
+
+def measure(blob : bytes , resolution_level : int , repeat : int = 20):
+    DecodeFrame(blob , resolution_level = resolution_level) # warm up.
+    start_time = time.perf_counter()
+    for x in range(repeat):
+        pixels = DecodeFrame(blob , resolution_level = resolution_level)
+    return (time.perf_counter() - start_time) / repeat , len(pixels)
+
+
+def main():
+    pixels = np.random.default_rng(0).normal(1000 , 50 , (512 , 512)).astype(np.uint16)
+    frames = [ ("J2K" , encode(pixels , bits_stored = 16)) ]
+    imagecodecs = GetImagecodecs()
+    if imagecodecs is not None:
+        frames.append(("HTJ2K" , imagecodecs.htj2k_encode(pixels)))
+    else:
+        print("imagecodecs is not installed : the HTJ2K frames can not be generated.")
+    print(f"{'frame':>8} {'level':>6} {'size':>10} {'time (ms)':>10} {'KB':>8}")
+    for name , blob in frames:
+        for resolution_level in range(4):
+            elapsed , length = measure(blob , resolution_level)
+            size = 512 // 2 ** resolution_level
+            print(f"{name:>8} {resolution_level:>6} {f'{size}x{size}':>10} {elapsed * 1000:>10.2f} {length / 1024:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+render_benchmark.py : Compares the rendering rate of a 200 slices 512x512 CT series, with saveAsPngPIL called for each slice and with saveSeriesAsImages.
+
+Usage : python -m benchmark.render_benchmark
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import pydicom
+from pydicom.dataset import FileDataset , FileMetaDataset
+from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+
+
+def build_series(slice_count : int , rows : int , columns : int) -> list:
+    # CT like slices : air around a soft tissue ellipse with a bone ring , stored as signed 16 bits values rescaled to Hounsfield units , with a soft tissue window.
+    rng = np.random.default_rng(0)
+    y , x = np.ogrid[-1 : 1 : rows * 1j , -1 : 1 : columns * 1j]
+    radius = (x / 0.9) ** 2 + (y / 0.7) ** 2
+    phantom = np.where(radius < 1 , 1064 , 24) + np.where((radius > 0.8) & (radius < 0.9) , 700 , 0)
+    datasets = []
+    for number in range(1 , slice_count + 1):
+        file_meta = FileMetaDataset()
+        file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        ds = FileDataset(None , {} , file_meta = file_meta , preamble = b"\0" * 128)
+        ds.SeriesInstanceUID = "1.2.826.0.1.3680043.8.498.3"
+        ds.SOPInstanceUID = f"1.2.826.0.1.3680043.8.498.3.{number}"
+        ds.InstanceNumber = number
+        ds.Rows = rows
+        ds.Columns = columns
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.RescaleSlope = 1
+        ds.RescaleIntercept = -1024
+        ds.WindowCenter = 40
+        ds.WindowWidth = 400
+        ds.PixelData = (phantom + rng.normal(0 , 20 , (rows , columns))).astype(np.int16).tobytes()
+        datasets.append(ds)
+    return datasets
+
+
+def main():
+    slice_count = 200
+    datasets = build_series(slice_count , 512 , 512)
+    helper = AHItoDICOM(fetcher_process_count=1 , dicomizer_process_count=os.cpu_count())
+    destination = tempfile.mkdtemp()
+    print(f"{slice_count} slices of 512x512 , {os.cpu_count()} encoder processes")
+    print(f"{'method':>30} {'time (s)':>10} {'slices/s':>10}")
+    try:
+        start_time = time.perf_counter()
+        for ds in datasets:
+            helper.saveAsPngPIL(ds , os.path.join(destination , "pil" , f"{ds.SOPInstanceUID}.png"))
+        elapsed = time.perf_counter() - start_time
+        print(f"{'saveAsPngPIL':>30} {elapsed:>10.2f} {slice_count / elapsed:>10.1f}")
+        for image_format in ["png" , "jpeg" , "webp"]:
+            start_time = time.perf_counter()
+            helper.saveSeriesAsImages(datasets , os.path.join(destination , image_format) , image_format)
+            elapsed = time.perf_counter() - start_time
+            print(f"{f'saveSeriesAsImages {image_format}':>30} {elapsed:>10.2f} {slice_count / elapsed:>10.1f}")
+    finally:
+        shutil.rmtree(destination)
+
+
+if __name__ == "__main__":
+    main()
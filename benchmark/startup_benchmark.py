@@ -0,0 +1,63 @@
+"""
+startup_benchmark.py : Measures the import time of the module , the heavy dependencies it imports , and for each start method of the worker processes the time to start them and to DICOMize a first small ImageSet.
+Each measure runs in a new interpreter , like a CLI run or a Lambda cold start.
+
+Usage : python -m benchmark.startup_benchmark
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import json
+import multiprocessing
+import statistics
+import subprocess
+import sys
+import time
+
+
+HEAVY_MODULES = [ "boto3" , "botocore" , "pydicom" , "numpy" , "openjpeg" , "imagecodecs" , "PIL" ]
+
+
+def measureImport():
+    start_time = time.perf_counter()
+    import AHItoDICOMInterface.AHItoDICOM
+    elapsed = time.perf_counter() - start_time
+    print(json.dumps({ "import" : elapsed , "modules" : [ module for module in HEAVY_MODULES if module in sys.modules ] }))
+
+
+def measureStartup(start_method : str):
+    start_time = time.perf_counter()
+    from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+    from benchmark.FakeAHIClient import FakeAHIClient
+    imported = time.perf_counter() - start_time
+    client = FakeAHIClient(instance_count=1 , rows=512 , columns=512)
+    helper = AHItoDICOM(fetcher_process_count=2 , dicomizer_process_count=2 , ahi_client=client , start_method=start_method)
+    helper.start()
+    started = time.perf_counter() - start_time
+    datasets = helper.DICOMizeImageSet(datastore_id=client.datastore_id , image_set_id=client.image_set_id)
+    first = time.perf_counter() - start_time
+    helper.close()
+    print(json.dumps({ "import" : imported , "start" : started , "first" : first , "instances" : len(datasets) }))
+
+
+def run(arguments : list) -> dict:
+    output = subprocess.run([ sys.executable , "-m" , "benchmark.startup_benchmark" ] + arguments , check=True , stdout=subprocess.PIPE , text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    repeat = 5
+    results = [ run(["import"]) for x in range(repeat) ]
+    print(f"import AHItoDICOMInterface.AHItoDICOM : {statistics.median(result['import'] for result in results) * 1000:.0f} ms , heavy modules imported : {', '.join(results[0]['modules'])}")
+    print(f"{'start method':>14} {'import (ms)':>12} {'started (ms)':>13} {'first instance (ms)':>20}")
+    for start_method in multiprocessing.get_all_start_methods():
+        results = [ run(["startup" , start_method]) for x in range(repeat) ]
+        print(f"{start_method:>14} {statistics.median(result['import'] for result in results) * 1000:>12.0f} {statistics.median(result['start'] for result in results) * 1000:>13.0f} {statistics.median(result['first'] for result in results) * 1000:>20.0f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "startup":
+        measureStartup(sys.argv[2])
+    elif len(sys.argv) > 1 and sys.argv[1] == "import":
+        measureImport()
+    else:
+        main()
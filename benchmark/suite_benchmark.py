@@ -0,0 +1,99 @@
+"""
+suite_benchmark.py : Runs the export scenarios against FakeAHIClient for several numbers of fetcher and DICOMizer processes , and reports the throughput , the time-to-first-instance and the peak RSS of each run.
+Each run is measured in its own interpreter , so the peak RSS of one run does not hide the next one. The results can be saved as JSON , to compare two versions of the module offline.
+
+Usage : python -m benchmark.suite_benchmark [--scenarios ct_slices,study] [--processes 1x1,2x2] [--latency 0.02] [--bandwidth 50] [--codec htj2k] [--json results.json]
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+from benchmark.FakeAHIClient import FakeAHIClient , imagecodecs
+
+
+# the FakeAHIClient parameters and the export method of each scenario.
+SCENARIOS = {
+    "ct_slices" : { "description" : "400 single frame 512x512 CT slices" , "method" : "image_set" , "client" : { "instance_count" : 400 , "rows" : 512 , "columns" : 512 } },
+    "multiframe" : { "description" : "4 instances of 100 frames of 512x512" , "method" : "image_set" , "client" : { "instance_count" : 4 , "frames_per_instance" : 100 , "rows" : 512 , "columns" : 512 } },
+    "header_only" : { "description" : "5,000 instances , headers only" , "method" : "header_only" , "client" : { "instance_count" : 5000 , "rows" : 512 , "columns" : 512 } },
+    "study" : { "description" : "study of 4 ImageSets of 2 series of 50 256x256 slices" , "method" : "study" , "client" : { "instance_count" : 50 , "rows" : 256 , "columns" : 256 , "image_set_count" : 4 , "series_per_image_set" : 2 } },
+}
+
+
+def run(scenario_name : str , fetcher_process_count : int , dicomizer_process_count : int , service : dict) -> dict:
+    scenario = SCENARIOS[scenario_name]
+    client = FakeAHIClient(pattern="phantom" , **scenario["client"] , **service)
+    start_time = time.perf_counter()
+    helper = AHItoDICOM(fetcher_process_count=fetcher_process_count , dicomizer_process_count=dicomizer_process_count , ahi_client=client)
+    helper.start()
+    startup_time = time.perf_counter() - start_time
+    try:
+        if scenario["method"] == "study":
+            datasets = helper.iterDICOMizeStudy(datastore_id=client.datastore_id , study_instance_uid=client.study_instance_uid , order="completion")
+        else:
+            datasets = helper.iterDICOMizeImageSet(datastore_id=client.datastore_id , image_set_id=client.image_set_id , header_only=scenario["method"] == "header_only" , order="completion")
+        start_time = time.perf_counter()
+        first_time = None
+        instance_count = 0
+        for ds in datasets:
+            if first_time is None:
+                first_time = time.perf_counter() - start_time
+            instance_count += 1
+        elapsed = time.perf_counter() - start_time
+        metrics = helper.getMetrics()
+    finally:
+        helper.close()
+    # ru_maxrss is in KiB on Linux , and the children value is the largest of the worker processes waited for.
+    return { "scenario" : scenario_name , "fetchers" : fetcher_process_count , "dicomizers" : dicomizer_process_count , "instances" : instance_count ,
+             "startup" : startup_time , "first" : first_time , "elapsed" : elapsed , "instances_per_second" : instance_count / elapsed ,
+             "decoded_mb_per_second" : metrics["Counters"]["DecodedBytes"] / elapsed / 1e6 , "requests" : client.statistics["Requests"] , "throttled" : client.statistics["Throttled"] ,
+             "parent_rss_mb" : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 , "worker_rss_mb" : resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024 }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export benchmarks against a local fake HealthImaging service.")
+    parser.add_argument("--scenarios" , default=",".join(SCENARIOS) , help=f"Comma separated scenarios among {','.join(SCENARIOS)}.")
+    parser.add_argument("--processes" , default="1x1,2x2" , help="Comma separated fetcher_process_count x dicomizer_process_count settings , e.g. 1x1,4x2.")
+    parser.add_argument("--latency" , type=float , default=0.02 , help="Seconds added to each frame request.")
+    parser.add_argument("--metadata-latency" , type=float , default=0.1 , help="Seconds added to each metadata request.")
+    parser.add_argument("--bandwidth" , type=float , default=50 , help="MB per second each response is transferred at , 0 for an instant transfer.")
+    parser.add_argument("--throttle-rate" , type=float , default=0.0 , help="Ratio of the frame requests throttled at random.")
+    parser.add_argument("--max-concurrent-requests" , type=int , default=None , help="Number of frame requests served at the same time , the others being throttled.")
+    parser.add_argument("--codec" , default="htj2k" if imagecodecs is not None else "j2k" , choices=["htj2k" , "j2k"] , help="Encoding of the frames. Defaults to HTJ2K when imagecodecs is installed.")
+    parser.add_argument("--json" , default=None , help="Path of a JSON file the results are written to.")
+    parser.add_argument("--run" , default=None , help=argparse.SUPPRESS) # a single run , in the child interpreter.
+    args = parser.parse_args()
+
+    service = { "latency" : args.latency , "metadata_latency" : args.metadata_latency , "bandwidth" : args.bandwidth * 1e6 if args.bandwidth > 0 else None ,
+                "throttle_rate" : args.throttle_rate , "max_concurrent_requests" : args.max_concurrent_requests , "codec" : args.codec }
+    if args.run is not None:
+        scenario_name , processes = args.run.split(":")
+        fetchers , dicomizers = processes.split("x")
+        print(json.dumps(run(scenario_name , int(fetchers) , int(dicomizers) , service)))
+        return
+
+    results = []
+    print(f"codec {args.codec} , latency {args.latency * 1000:.0f} ms , bandwidth {args.bandwidth:g} MB/s , throttle rate {args.throttle_rate:g}")
+    print(f"{'scenario':>12} {'processes':>10} {'instances':>10} {'startup (s)':>12} {'first (ms)':>11} {'total (s)':>10} {'inst/s':>8} {'MB/s':>8} {'parent (MB)':>12} {'worker (MB)':>12}")
+    for scenario_name in args.scenarios.split(","):
+        for processes in args.processes.split(","):
+            command = [ sys.executable , "-m" , "benchmark.suite_benchmark" , "--run" , f"{scenario_name}:{processes}" , "--latency" , str(args.latency) , "--metadata-latency" , str(args.metadata_latency) ,
+                        "--bandwidth" , str(args.bandwidth) , "--throttle-rate" , str(args.throttle_rate) , "--codec" , args.codec ]
+            if args.max_concurrent_requests is not None:
+                command += [ "--max-concurrent-requests" , str(args.max_concurrent_requests) ]
+            output = subprocess.run(command , check=True , stdout=subprocess.PIPE , text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            results.append(result)
+            print(f"{scenario_name:>12} {processes:>10} {result['instances']:>10} {result['startup']:>12.2f} {result['first'] * 1000:>11.0f} {result['elapsed']:>10.2f} {result['instances_per_second']:>8.0f} {result['decoded_mb_per_second']:>8.1f} {result['parent_rss_mb']:>12.0f} {result['worker_rss_mb']:>12.0f}")
+    if args.json is not None:
+        with open(args.json , "w") as f:
+            json.dump({ "service" : service , "results" : results } , f , indent=2)
+
+
+if __name__ == "__main__":
+    main()
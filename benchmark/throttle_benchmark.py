@@ -0,0 +1,36 @@
+"""
+throttle_benchmark.py : Compares the time and the number of throttled requests of a 1,000 instances export against a service serving 16 requests at a time, with a fixed number of requests in flight and with the adaptive AHIFetchController.
+
+Usage : python -m benchmark.throttle_benchmark
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import logging
+import time
+from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+from AHItoDICOMInterface.AHIFetchController import AHIFetchController
+from benchmark.FakeAHIClient import FakeAHIClient
+
+
+def run(name : str , controller : AHIFetchController , instance_count : int):
+    client = FakeAHIClient(instance_count=instance_count , rows=64 , columns=64 , latency=0.02 , max_concurrent_requests=16)
+    with AHItoDICOM(fetcher_process_count=1 , dicomizer_process_count=1 , ahi_client=client , network_concurrency=64 , fetch_controller=controller) as helper:
+        start_time = time.perf_counter()
+        datasets = helper.DICOMizeImageSet(datastore_id=client.datastore_id , image_set_id=client.image_set_id)
+        elapsed = time.perf_counter() - start_time
+        statistics = helper.getFetchStatistics()
+    print(f"{name:>10} {len(datasets):>10} {elapsed:>10.2f} {client.statistics['Requests']:>10} {client.statistics['Throttled']:>10} {statistics['Failures']:>10} {statistics['Concurrency']:>12}")
+
+
+def main():
+    # the frames which can not be fetched after all the retries are logged as errors , they are counted in the failed column.
+    logging.getLogger("AHItoDICOMInterface").setLevel(logging.CRITICAL)
+    instance_count = 1000
+    print(f"{'limit':>10} {'instances':>10} {'time (s)':>10} {'requests':>10} {'throttled':>10} {'failed':>10} {'concurrency':>12}")
+    # the fixed limit retries the throttled requests the same way , but never lowers the number of requests in flight.
+    run("fixed" , AHIFetchController(max_concurrency=64 , decrease_ratio=1.0 , latency_tolerance=None) , instance_count)
+    run("adaptive" , AHIFetchController(max_concurrency=64) , instance_count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+transport_benchmark.py : Compares the throughput and peak memory of large multi-frame exports, with the pixels pickled through the queues and with the shared memory transport.
+
+Usage : python -m benchmark.transport_benchmark
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import resource
+import subprocess
+import sys
+import time
+from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+from benchmark.FakeAHIClient import FakeAHIClient
+
+
+def run(shared_memory_transport : bool , instance_count : int , frames_per_instance : int):
+    # each transport is measured in its own interpreter, so the peak RSS of one does not hide the other.
+    client = FakeAHIClient(instance_count=instance_count , rows=512 , columns=512 , frames_per_instance=frames_per_instance)
+    with AHItoDICOM(fetcher_process_count=2 , dicomizer_process_count=2 , ahi_client=client , shared_memory_transport=shared_memory_transport) as helper:
+        start_time = time.perf_counter()
+        size = 0
+        for ds in helper.iterDICOMizeImageSet(datastore_id=client.datastore_id , image_set_id=client.image_set_id , max_instances_in_flight=2):
+            size += len(ds.PixelData)
+        elapsed = time.perf_counter() - start_time
+    # ru_maxrss is in KiB on Linux. The children are joined by close() , so their peak is known.
+    parent_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    name = "shared memory" if shared_memory_transport else "queues"
+    print(f"{name:>14} {size / 1048576:>10.0f} {elapsed:>10.2f} {size / 1048576 / elapsed:>10.1f} {parent_rss:>12.0f} {children_rss:>14.0f}")
+
+
+def main():
+    instance_count = 8
+    frames_per_instance = 100
+    print(f"{instance_count} instances of {frames_per_instance} 512x512 16 bits frames")
+    print(f"{'transport':>14} {'MB':>10} {'time (s)':>10} {'MB/s':>10} {'parent (MB)':>12} {'worker (MB)':>14}")
+    for shared_memory_transport in [False, True]:
+        subprocess.run([sys.executable , "-m" , "benchmark.transport_benchmark" , str(shared_memory_transport) , str(instance_count) , str(frames_per_instance)] , check=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(sys.argv[1] == "True" , int(sys.argv[2]) , int(sys.argv[3]))
+    else:
+        main()
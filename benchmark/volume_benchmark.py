@@ -0,0 +1,45 @@
+"""
+volume_benchmark.py : Compares the time and peak memory of building the 3D array of a 300 slices 512x512 series with DICOMizeImageSet followed by numpy.stack, and with getVolume.
+
+Usage : python -m benchmark.volume_benchmark
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+from benchmark.FakeAHIClient import FakeAHIClient
+
+
+def run(method : str , instance_count : int):
+    # each method is measured in its own interpreter, so the peak RSS of one does not hide the other.
+    client = FakeAHIClient(instance_count=instance_count , rows=512 , columns=512)
+    with AHItoDICOM(fetcher_process_count=2 , dicomizer_process_count=2 , ahi_client=client) as helper:
+        start_time = time.perf_counter()
+        if method == "DICOMizeImageSet":
+            datasets = helper.DICOMizeImageSet(datastore_id=client.datastore_id , image_set_id=client.image_set_id)
+            volume = np.stack([ ds.pixel_array for ds in datasets ])
+        else:
+            volume = helper.getVolume(client.datastore_id , client.image_set_id).Volume
+        elapsed = time.perf_counter() - start_time
+        volume.sum() # the pages of the volume are only counted in the RSS once read.
+    # ru_maxrss is in KiB on Linux.
+    parent_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{method:>20} {str(volume.shape):>16} {elapsed:>10.2f} {instance_count / elapsed:>10.1f} {parent_rss:>12.0f}")
+
+
+def main():
+    instance_count = 300
+    print(f"{'method':>20} {'shape':>16} {'time (s)':>10} {'slices/s':>10} {'parent (MB)':>12}")
+    for method in [ "DICOMizeImageSet" , "getVolume" ]:
+        subprocess.run([sys.executable , "-m" , "benchmark.volume_benchmark" , method , str(instance_count)] , check=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(sys.argv[1] , int(sys.argv[2]))
+    else:
+        main()
@@ -10,13 +10,20 @@ setup(
     author_email='jpleger@amazon.com',
     license='MIT-0',
     packages=['AHItoDICOMInterface'],
+    entry_points={
+        'console_scripts': ['ahi-bulk-export=AHItoDICOMInterface.AHIBulkExporter:main'],
+    },
     install_requires=[  'boto3',
                         'botocore',
-                        'pydicom',
+                        'pydicom<4',
                         'pylibjpeg-openjpeg>=1.3.0',
                         'numpy',
                         'pillow ',                 
                       ],
+    extras_require={
+        'preview': ['imagecodecs'],
+        'fast-json': ['orjson'],
+    },
 
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -0,0 +1,104 @@
+"""
+Tests of the resumption of a bulk export from its manifest , against a local fake HealthImaging client.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import collections
+import tempfile
+import unittest
+from unittest import mock
+from botocore.exceptions import ClientError
+from AHItoDICOMInterface.AHIBulkExporter import AHIBulkExporter
+from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+from benchmark.FakeAHIClient import FakeAHIClient
+
+
+class RecordingClient(FakeAHIClient):
+    # counts the metadata and frame requests of each ImageSet , the frames of the ImageSets in failing being denied.
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.failing = set()
+        self.metadataRequests = collections.Counter()
+        self.frameRequests = collections.Counter()
+
+    def get_image_set_metadata(self, datastoreId : str , imageSetId : str , **kwargs):
+        with self.lock:
+            self.metadataRequests[imageSetId] += 1
+        return super().get_image_set_metadata(datastoreId , imageSetId , **kwargs)
+
+    def get_image_frame(self, datastoreId : str , imageSetId : str , imageFrameInformation : dict):
+        with self.lock:
+            self.frameRequests[imageSetId] += 1
+        if imageSetId in self.failing:
+            raise ClientError({ "Error" : { "Code" : "AccessDeniedException" , "Message" : "Denied" } , "ResponseMetadata" : { "HTTPStatusCode" : 403 } } , "GetImageFrame")
+        return super().get_image_frame(datastoreId , imageSetId , imageFrameInformation)
+
+
+class Interrupted(Exception):
+    pass
+
+
+class BulkExportResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.destination = tempfile.TemporaryDirectory()
+        self.client = RecordingClient(instance_count = 5 , image_set_count = 3)
+        self.helper = AHItoDICOM(ahi_client = self.client , fetcher_process_count = 1 , dicomizer_process_count = 1)
+        self.helper.start()
+
+    def tearDown(self):
+        self.helper.close()
+        self.destination.cleanup()
+
+    def export(self) -> dict:
+        exporter = AHIBulkExporter(self.helper , self.destination.name , max_image_sets_in_flight = 1)
+        try:
+            return exporter.export(self.client.datastore_id , image_set_ids = self.client.image_set_ids)
+        finally:
+            exporter.close()
+
+    def resume(self) -> dict:
+        self.client.metadataRequests.clear()
+        self.client.frameRequests.clear()
+        return self.export()
+
+    def test_resume_after_interruption(self):
+        # the export is stopped after 7 instances : the first ImageSet is complete and 2 instances of the second one are written.
+        iterDICOMizeSources = self.helper.iterDICOMizeSources
+        def interruptedAfter(*args , **kwargs):
+            for count , item in enumerate(iterDICOMizeSources(*args , **kwargs)):
+                if count == 7:
+                    raise Interrupted()
+                yield item
+        with mock.patch.object(self.helper , "iterDICOMizeSources" , interruptedAfter):
+            with self.assertRaises(Interrupted):
+                self.export()
+        report = self.resume()
+        first , second , third = self.client.image_set_ids
+        self.assertEqual(report["ImageSetsSkipped"] , 1)
+        self.assertEqual(report["InstancesSkipped"] , 2)
+        self.assertEqual(report["Instances"] , 8)
+        self.assertEqual(report["Errors"] , 0)
+        self.assertNotIn(first , self.client.metadataRequests)
+        self.assertEqual(dict(self.client.frameRequests) , { second : 3 , third : 5 })
+        self.assertEqual(self.resume()["ImageSetsSkipped"] , 3)
+        self.assertEqual(sum(self.client.metadataRequests.values()) + sum(self.client.frameRequests.values()) , 0)
+
+    def test_failed_image_sets_are_retried(self):
+        first , second , third = self.client.image_set_ids
+        self.client.failing.add(second)
+        report = self.export()
+        self.assertEqual(report["Instances"] , 10)
+        self.assertEqual(report["Errors"] , 5)
+        self.client.failing.clear()
+        report = self.resume()
+        self.assertEqual(report["ImageSetsSkipped"] , 2)
+        self.assertEqual(report["Instances"] , 5)
+        self.assertEqual(report["Errors"] , 0)
+        self.assertEqual(set(self.client.metadataRequests) , { second })
+        self.assertEqual(dict(self.client.frameRequests) , { second : 5 })
+
+
+if __name__ == "__main__":
+    unittest.main()
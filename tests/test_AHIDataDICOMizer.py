@@ -0,0 +1,62 @@
+"""
+Tests of the DICOMization of several instances of one series , which share the series template.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import collections
+import logging
+import unittest
+from AHItoDICOMInterface.AHIDataDICOMizer import AHIDataDICOMizer
+
+
+def newDICOMizer() -> AHIDataDICOMizer:
+    # the jobs are DICOMized in this process : no worker process is started.
+    dicomizer = AHIDataDICOMizer.__new__(AHIDataDICOMizer)
+    dicomizer.logger = logging.getLogger(AHIDataDICOMizer.__module__)
+    dicomizer.InstanceId = 0
+    dicomizer.templates = collections.OrderedDict()
+    return dicomizer
+
+
+def newJob(index : int , resolution_level : int = 0 , frame_indexes : list = None) -> dict:
+    functionalGroups = [ { "FrameContentSequence" : [ { "InStackPositionNumber" : frame + 1 } ] } for frame in range(4) ]
+    return {
+        "ExportId" : 1 ,
+        "imagesetId" : "imageset" ,
+        "SeriesUID" : "1.2.3.4" ,
+        "SOPInstanceUID" : f"1.2.3.4.{index}" ,
+        "TransferSyntaxUID" : "1.2.840.10008.1.2.1" ,
+        "ResolutionLevel" : resolution_level ,
+        "FrameIndexes" : frame_indexes ,
+        "Metadata" : {
+            "DICOMVRs" : {} ,
+            "Patient" : { "PatientID" : "patient" } ,
+            "Study" : { "StudyInstanceUID" : "1.2.3" } ,
+            "Series" : { "SeriesInstanceUID" : "1.2.3.4" , "Rows" : 512 , "Columns" : 256 , "NumberOfFrames" : 4 , "PixelSpacing" : [ 0.5 , 0.5 ] , "PerFrameFunctionalGroupsSequence" : functionalGroups } ,
+            "Instance" : { "SOPInstanceUID" : f"1.2.3.4.{index}" , "InstanceNumber" : index } ,
+        } ,
+    }
+
+
+class SeriesTemplateTest(unittest.TestCase):
+
+    def test_reduced_resolution_and_frame_selection_do_not_modify_the_template(self):
+        dicomizer = newDICOMizer()
+        for index in range(3):
+            ds = dicomizer.DICOMizeJob(newJob(index , resolution_level = 1 , frame_indexes = [ 1 , 3 ]))
+            self.assertEqual(ds.Rows , 256)
+            self.assertEqual(ds.Columns , 128)
+            self.assertEqual([ float(spacing) for spacing in ds.PixelSpacing ] , [ 1.0 , 1.0 ])
+            self.assertEqual(int(ds.NumberOfFrames) , 2)
+            self.assertEqual([ item.FrameContentSequence[0].InStackPositionNumber for item in ds.PerFrameFunctionalGroupsSequence ] , [ 2 , 4 ])
+        template = next(iter(dicomizer.templates.values()))
+        self.assertEqual(template.Rows , 512)
+        self.assertEqual(template.Columns , 256)
+        self.assertEqual(int(template.NumberOfFrames) , 4)
+        self.assertEqual(len(template.PerFrameFunctionalGroupsSequence) , 4)
+        ds = dicomizer.DICOMizeJob(newJob(3))
+        self.assertEqual(( ds.Rows , ds.Columns , int(ds.NumberOfFrames) ) , ( 512 , 256 , 4 ))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+Tests of the adaptive concurrency and the retries of the frame requests , against a local fake HealthImaging client injecting throttling.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import random
+import threading
+import unittest
+from botocore.exceptions import ClientError
+from AHItoDICOMInterface.AHIFetchController import AHIFetchController
+from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+from benchmark.FakeAHIClient import FakeAHIClient
+
+
+def getFrame(client : FakeAHIClient):
+    return client.get_image_frame(client.datastore_id , client.image_set_id , { "imageFrameId" : "frame" })
+
+
+class FetchControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+
+    def test_limit_shrinks_on_throttling_and_grows_back(self):
+        client = FakeAHIClient(throttle_rate = 1.0)
+        controller = AHIFetchController(max_concurrency = 16 , latency_tolerance = None , max_attempts = 3 , base_delay = 0.001)
+        with self.assertRaises(ClientError):
+            controller.call(getFrame , client)
+        statistics = controller.getStatistics()
+        self.assertEqual(statistics["Throttled"] , 3)
+        self.assertEqual(statistics["Concurrency"] , 2) # halved by each of the 3 attempts.
+        client.throttle_rate = 0.0
+        for request in range(200):
+            controller.call(getFrame , client)
+        self.assertEqual(controller.getStatistics()["Concurrency"] , 16)
+
+    def test_limit_shrinks_under_concurrent_throttling(self):
+        client = FakeAHIClient(max_concurrent_requests = 4 , latency = 0.005)
+        controller = AHIFetchController(max_concurrency = 32 , latency_tolerance = None , max_attempts = 20 , base_delay = 0.001)
+        threads = [ threading.Thread(target = lambda : [ controller.call(getFrame , client) for request in range(20) ]) for thread in range(32) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        statistics = controller.getStatistics()
+        self.assertGreater(statistics["Throttled"] , 0)
+        self.assertEqual(statistics["Failures"] , 0)
+        self.assertLess(statistics["Concurrency"] , 32)
+
+    def test_throttled_frames_are_retried(self):
+        client = FakeAHIClient(instance_count = 8 , frames_per_instance = 2 , throttle_rate = 0.3)
+        controller = AHIFetchController(max_concurrency = 8 , max_attempts = 20 , base_delay = 0.001)
+        with AHItoDICOM(ahi_client = client , fetcher_process_count = 1 , dicomizer_process_count = 1 , fetch_controller = controller) as helper:
+            datasets = helper.DICOMizeImageSet(client.datastore_id , image_set_id = client.image_set_id)
+        self.assertEqual(len(datasets) , 8)
+        self.assertTrue(all( len(ds.PixelData) == 2 * 64 * 64 * 2 for ds in datasets ))
+        statistics = controller.getStatistics()
+        self.assertGreater(statistics["Retries"] , 0)
+        self.assertEqual(statistics["Failures"] , 0)
+
+    def test_frames_failing_every_attempt_are_reported(self):
+        client = FakeAHIClient(instance_count = 4 , throttle_rate = 1.0)
+        controller = AHIFetchController(max_concurrency = 4 , max_attempts = 2 , base_delay = 0.001)
+        result = {}
+        with AHItoDICOM(ahi_client = client , fetcher_process_count = 1 , dicomizer_process_count = 1 , fetch_controller = controller) as helper:
+            export = threading.Thread(target = lambda : result.update(datasets = helper.DICOMizeImageSet(client.datastore_id , image_set_id = client.image_set_id)) , daemon = True)
+            export.start()
+            export.join(timeout = 60)
+            self.assertFalse(export.is_alive() , "the export is left hanging on the failed frames")
+            counters = helper.getMetrics()["Counters"]
+        self.assertEqual(result["datasets"] , [])
+        self.assertEqual(counters.get("InstanceErrors") , 4)
+        self.assertEqual(controller.getStatistics()["Failures"] , 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+"""
+Tests of the LRU eviction and the size accounting of the frame cache.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+from AHItoDICOMInterface.AHIFrameCache import AHIFrameCache
+
+
+def putFrames(cache : AHIFrameCache , frame_ids : list , size : int = 1000):
+    # the frames are written with increasing modification times , the LRU order , whatever the resolution of the file system clock.
+    for age , frame_id in enumerate(frame_ids):
+        cache.putBlob("datastore" , "imageset" , frame_id , b"x" * size)
+        path = cache._path("datastore" , "imageset" , frame_id , ".j2c")
+        os.utime(path , (1000000 + age , 1000000 + age))
+
+
+def test_least_recently_used_frames_are_evicted(tmp_path):
+    cache = AHIFrameCache(str(tmp_path) , max_size = 10000)
+    putFrames(cache , [ f"frame{n}" for n in range(10) ])
+    assert cache.getStatistics()["Evictions"] == 0
+    assert cache.getBlob("datastore" , "imageset" , "frame0") is not None # frame0 becomes the most recently used.
+    cache.putBlob("datastore" , "imageset" , "frame10" , b"x" * 1000)
+    # over max_size : the least recently used frames are evicted down to 90% of it.
+    assert cache.getStatistics()["Evictions"] == 2
+    assert cache.getBlob("datastore" , "imageset" , "frame1") is None
+    assert cache.getBlob("datastore" , "imageset" , "frame2") is None
+    for frame_id in [ "frame0" , "frame10" ] + [ f"frame{n}" for n in range(3 , 10) ]:
+        assert cache.getBlob("datastore" , "imageset" , frame_id) is not None
+    assert cache.size == 9000
+    assert cache._scan()[0] == 9000
+
+
+def test_overwritten_frames_are_counted_once(tmp_path):
+    cache = AHIFrameCache(str(tmp_path) , max_size = 10000)
+    for attempt in range(20):
+        cache.putBlob("datastore" , "imageset" , "frame" , b"x" * 1000)
+    assert cache.size == 1000
+    cache.putBlob("datastore" , "imageset" , "frame" , b"x" * 400)
+    cache.putPixels("datastore" , "imageset" , "frame" , b"x" * 600)
+    assert cache.size == 1000
+    assert cache.getStatistics()["Evictions"] == 0
+    assert cache._scan()[0] == 1000
+    assert AHIFrameCache(str(tmp_path) , max_size = 10000).size == 1000
@@ -0,0 +1,73 @@
+"""
+Tests of the ImageSet metadata cache : entries keyed by version and evicted within the size limits.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import collections
+import gzip
+import json
+import os
+from AHItoDICOMInterface.AHIMetadataCache import AHIMetadataCache
+from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+from benchmark.FakeAHIClient import FakeAHIClient
+
+
+class VersionedClient(FakeAHIClient):
+    # serves the ImageSet at the version in self.version , and counts the metadata requests of each version.
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.version = "1"
+        self.metadataRequests = collections.Counter()
+
+    def get_image_set(self, datastoreId : str , imageSetId : str , **kwargs):
+        return dict(super().get_image_set(datastoreId , imageSetId , **kwargs) , versionId = self.version)
+
+    def get_image_set_metadata(self, datastoreId : str , imageSetId : str , **kwargs):
+        self.metadataRequests[kwargs.get("versionId")] += 1
+        return super().get_image_set_metadata(datastoreId , imageSetId , **kwargs)
+
+
+def test_entries_are_keyed_by_version():
+    cache = AHIMetadataCache()
+    cache.putMetadata("datastore" , "imageset" , "1" , { "version" : 1 } , size = 10)
+    assert cache.getMetadata("datastore" , "imageset" , "1") == { "version" : 1 }
+    assert cache.getMetadata("datastore" , "imageset" , "2") is None
+    assert cache.getMetadata("datastore" , "otherimageset" , "1") is None
+    statistics = cache.getStatistics()
+    assert ( statistics["Hits"] , statistics["Misses"] ) == ( 1 , 2 )
+
+
+def test_updated_image_set_is_fetched_again():
+    client = VersionedClient(instance_count = 3)
+    helper = AHItoDICOM(ahi_client = client , metadata_cache = AHIMetadataCache())
+    for call in range(3):
+        assert helper.getMetadata(client.datastore_id , client.image_set_id) is not None
+    client.version = "2"
+    assert helper.getMetadata(client.datastore_id , client.image_set_id) is not None
+    assert helper.getImageSetSummary(client.datastore_id , client.image_set_id)["Study"]["Series"]
+    assert client.metadataRequests == { "1" : 1 , "2" : 1 }
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = AHIMetadataCache(max_memory_size = 1000)
+    cache.putMetadata("datastore" , "imageset" , "a" , { "name" : "a" } , size = 400)
+    cache.putMetadata("datastore" , "imageset" , "b" , { "name" : "b" } , size = 400)
+    assert cache.getMetadata("datastore" , "imageset" , "a") is not None # b becomes the least recently used.
+    cache.putMetadata("datastore" , "imageset" , "c" , { "name" : "c" } , size = 400)
+    assert cache.getMetadata("datastore" , "imageset" , "b") is None
+    assert cache.getMetadata("datastore" , "imageset" , "a") is not None
+    assert cache.getMetadata("datastore" , "imageset" , "c") is not None
+    statistics = cache.getStatistics()
+    assert ( statistics["Evictions"] , statistics["Entries"] , statistics["MemorySize"] ) == ( 1 , 2 , 800 )
+
+
+def test_disk_cache_stays_within_its_size(tmp_path):
+    blobs = { version : gzip.compress(json.dumps({ "version" : version , "data" : os.urandom(300).hex() }).encode()) for version in range(10) }
+    max_disk_size = 3 * max( len(blob) for blob in blobs.values() )
+    cache = AHIMetadataCache(cache_dir = str(tmp_path) , max_disk_size = max_disk_size)
+    for version , blob in blobs.items():
+        cache.putBlob("datastore" , "imageset" , str(version) , blob)
+        assert sum( size for path , size , mtime in cache._scan() ) <= max_disk_size
+    # the last blob written is kept , and read back from the disk by a new cache object.
+    assert AHIMetadataCache(cache_dir = str(tmp_path) , max_disk_size = max_disk_size).getMetadata("datastore" , "imageset" , "9")["version"] == 9
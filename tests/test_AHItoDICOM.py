@@ -0,0 +1,25 @@
+"""
+Tests of the metrics of the helper , against a local fake HealthImaging client.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import unittest
+from AHItoDICOMInterface.AHItoDICOM import AHItoDICOM
+from benchmark.FakeAHIClient import FakeAHIClient
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_workers_are_reported_without_memory_budget(self):
+        client = FakeAHIClient(instance_count = 4)
+        with AHItoDICOM(ahi_client = client , fetcher_process_count = 1 , dicomizer_process_count = 1) as helper:
+            datasets = helper.DICOMizeImageSet(client.datastore_id , image_set_id = client.image_set_id)
+            metrics = helper.getMetrics()
+        self.assertEqual(len(datasets) , 4)
+        self.assertEqual(metrics["MemoryBudget"] , {})
+        self.assertEqual(sorted( worker["Worker"] for worker in metrics["Workers"] ) , [ "decoder-0" , "dicomizer-0" ])
+        self.assertEqual(sum( worker["JobsDone"] for worker in metrics["Workers"] if worker["Worker"] == "dicomizer-0" ) , 4)
+
+
+if __name__ == "__main__":
+    unittest.main()